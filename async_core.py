@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import random
+import time
+import aiohttp
+import config as cfg
+from bot_api import TokenBucket
+from metrics import inc, span
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBotApi:
+    """Asyncio counterpart of bot_api.BotApiClient.
+
+    Shares one pooled aiohttp session, paces chat-targeted calls with the same
+    token buckets and retries 429, 5xx and connection errors. Every call has a
+    timeout and can be cancelled.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self._global = TokenBucket(cfg.TELEGRAM_GLOBAL_RATE, cfg.TELEGRAM_GLOBAL_RATE)
+        self._chats = {}
+        self._last_sweep = time.monotonic()
+
+    def _chat_bucket(self, chat_id):
+        now = time.monotonic()
+        if now - self._last_sweep > 60:
+            self._chats = {cid: b for cid, b in self._chats.items() if not b.is_idle(now)}
+            self._last_sweep = now
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(cfg.TELEGRAM_GROUP_RATE, cfg.TELEGRAM_GROUP_BURST)
+            else:
+                bucket = TokenBucket(cfg.TELEGRAM_CHAT_RATE, cfg.TELEGRAM_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id):
+        now = time.monotonic()
+        wait = self._global.reserve(now)
+        if chat_id is not None:
+            wait = max(wait, self._chat_bucket(chat_id).reserve(now))
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    @staticmethod
+    def _form(data, files):
+        form = aiohttp.FormData()
+        for name, value in (data or {}).items():
+            if value is not None:
+                form.add_field(name, str(value))
+        for name, file in (files or {}).items():
+            file.seek(0)
+            form.add_field(name, file.read(), filename=getattr(file, "name", name))
+        return form
+
+    async def call(self, method, data=None, files=None, chat_id=None, limited=True, timeout=30):
+        """Calls a Bot API method and returns the decoded response.
+
+        Raises:
+            aiohttp.ClientError: If the call failed after all retries
+            asyncio.TimeoutError: If the last attempt timed out
+        """
+        url = f"{cfg.TELEGRAM_API_URL}/{method}"
+        attempt = 0
+        while True:
+            if limited:
+                await self._acquire(chat_id)
+            try:
+                async with self._session.post(
+                    url, data=self._form(data, files), timeout=aiohttp.ClientTimeout(total=timeout)
+                ) as response:
+                    if response.status == 429 and attempt < cfg.TELEGRAM_MAX_RETRIES:
+                        body = await response.json(content_type=None)
+                        retry_after = int((body or {}).get("parameters", {}).get("retry_after", 1))
+                        logger.warning("Telegram rate limit hit on %s, retrying after %ss", method, retry_after)
+                        if chat_id is not None:
+                            self._chat_bucket(chat_id).penalize(time.monotonic(), retry_after)
+                        else:
+                            self._global.penalize(time.monotonic(), retry_after)
+                        delay = 0 if limited else retry_after
+                    elif response.status >= 500 and attempt < cfg.TELEGRAM_MAX_RETRIES:
+                        delay = self._backoff(attempt)
+                        logger.warning("Telegram returned %s on %s, retrying in %.1fs", response.status, method, delay)
+                    else:
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= cfg.TELEGRAM_MAX_RETRIES:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning("Error when calling %s: %s, retrying in %.1fs", method, e, delay)
+            attempt += 1
+            if delay:
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    def _backoff(attempt):
+        return random.uniform(0, min(cfg.TELEGRAM_MAX_BACKOFF, cfg.TELEGRAM_BASE_BACKOFF * 2 ** attempt))
+
+
+# Set by async_main.run for the lifetime of the event loop
+api = None
+
+
+async def send_message(chat_id, text, reply_markup=None):
+    """Async version of core.send_message."""
+    payload = {
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": "Markdown",
+    }
+    if reply_markup:
+        payload["reply_markup"] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
+    try:
+        logger.debug("Sending message using method sendMessage: %s", payload)
+        with span("telegram_send_message"):
+            return await api.call("sendMessage", data=payload, chat_id=chat_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error when sending message: %s", e)
+        inc("errors", kind="telegram")
+        return None
+
+
+async def send_photo(chat_id, photo, caption=None):
+    """Async version of core.send_photo, photo is a file object or a file_id."""
+    payload = {
+        "chat_id": chat_id,
+        "caption": caption,
+        "has_spoiler": True,
+        "parse_mode": "Markdown",
+    }
+    if isinstance(photo, str):
+        payload["photo"] = photo
+        files = None
+    else:
+        files = {"photo": photo}
+    try:
+        logger.debug("Sending photo")
+        with span("telegram_send_photo"):
+            return await api.call("sendPhoto", data=payload, files=files, chat_id=chat_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error when sending photo: %s", e)
+        inc("errors", kind="telegram")
+        return None
+
+
+async def answer_callback_query(callback_query_id):
+    """Async version of core.answer_callback_query."""
+    try:
+        with span("telegram_answer_callback"):
+            return await api.call("answerCallbackQuery", data={"callback_query_id": callback_query_id})
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error when sending answerCallbackQuery: %s", e)
+        inc("errors", kind="telegram")
+        return None
+
+
+async def get_updates():
+    """Async version of main.get_updates."""
+    logger.debug("Getting updates with offset=%s", cfg.LAST_UPDATE_ID)
+    params = {"timeout": 100, "offset": cfg.LAST_UPDATE_ID}
+    try:
+        return await api.call("getUpdates", data=params, limited=False, timeout=110)
+    except aiohttp.ClientResponseError as e:
+        if e.status == 409:
+            logger.warning("Conflict with previous bot instance detected")
+        else:
+            logger.error("Error when getting updates: %s", e)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error when getting updates: %s", e)
+    return {"result": []}
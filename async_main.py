@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import aiohttp
+import config as cfg
+import async_core
+import async_vpn
+import updates_log
+from dispatcher import update_chat_id
+from metrics import inc, metrics, span
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedRunner:
+    """Runs update handlers as tasks, in order per chat and concurrently across chats.
+
+    At most cfg.ASYNC_CONCURRENCY handlers run at a time. A handler waiting on
+    a slow panel only holds a coroutine, not a thread. At most
+    cfg.ASYNC_MAX_PENDING updates are queued or running, ``submit`` waits
+    for a free slot beyond that, so a burst of updates pauses polling.
+    """
+
+    def __init__(self, handle, concurrency, max_pending):
+        self._handle = handle
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._slots = asyncio.Semaphore(max_pending)
+        self._chat_locks = {}
+        self._tasks = set()
+
+    async def submit(self, update):
+        await self._slots.acquire()
+        task = asyncio.create_task(self._run(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda _: self._slots.release())
+
+    async def _run(self, update):
+        chat_id = update_chat_id(update)
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        # Number of updates of the chat holding or waiting for the lock
+        entry[1] += 1
+        inc("updates")
+        try:
+            async with entry[0], self._semaphore:
+                with span("update"):
+                    await self._handle(update)
+        except asyncio.CancelledError:
+            # Left unfinished, so it is resumed on the next start
+            raise
+        except Exception:
+            logger.exception("Error when processing update %s", update.get("update_id"))
+            inc("errors", kind="handler")
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chat_locks[chat_id]
+        # A failing update is not retried on every restart
+        await asyncio.to_thread(updates_log.get_update_log().mark_done, update["update_id"])
+
+    @property
+    def pending(self):
+        return len(self._tasks)
+
+    async def shutdown(self, timeout):
+        """Waits up to timeout seconds for running handlers, then cancels them."""
+        if not self._tasks:
+            return
+        _, still_running = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            logger.warning("Cancelled %d unfinished updates", len(still_running))
+            await asyncio.gather(*still_running, return_exceptions=True)
+
+
+def make_handler(handle_update):
+    """Returns the coroutine handling one update.
+
+    Country selection, the path that waits on the panels, runs natively on the
+    event loop. Every other update goes to the sync handle_update in a thread.
+    """
+
+    async def handle(update):
+        callback_query = update.get("callback_query")
+        if callback_query is not None and callback_query.get("data", "").startswith("country_"):
+            chat_id = callback_query["message"]["chat"]["id"]
+            username = callback_query["from"].get("username")
+            country = callback_query["data"].split("_", 1)[1]
+            await async_vpn.create_vpn_account(chat_id, username, country, idempotency_key=callback_query["id"])
+        else:
+            await asyncio.to_thread(handle_update, update)
+
+    return handle
+
+
+# Callback answers in flight, referenced until they finish
+_answers = set()
+
+
+def answer_callback_query(callback_query_id):
+    """Answers a callback query in a background task, see main.accept_update."""
+    task = asyncio.create_task(async_core.answer_callback_query(callback_query_id))
+    _answers.add(task)
+    task.add_done_callback(_answers.discard)
+
+
+async def poll_updates(runner):
+    """Async version of main.poll_updates."""
+    try:
+        await async_core.api.call("deleteWebhook", limited=False)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error when deleting webhook: %s", e)
+    # The update log is SQLite, its calls run in threads to keep the loop responsive
+    update_log = updates_log.get_update_log()
+    cfg.LAST_UPDATE_ID = await asyncio.to_thread(update_log.load_offset)
+    while True:
+        updates = await async_core.get_updates()
+        if not updates.get("result"):
+            await asyncio.sleep(1)
+            continue
+        for update in updates["result"]:
+            if await asyncio.to_thread(update_log.record, update):
+                if "callback_query" in update:
+                    answer_callback_query(update["callback_query"]["id"])
+                # Waits while the runner is full, the offset only moves past accepted updates
+                await runner.submit(update)
+            else:
+                logger.info("Skipping already processed update %s", update["update_id"])
+            cfg.LAST_UPDATE_ID = update["update_id"] + 1
+            await asyncio.to_thread(update_log.save_offset, cfg.LAST_UPDATE_ID)
+
+
+async def run(handle_update):
+    """Runs the bot on an event loop until it is cancelled.
+
+    handle_update is the sync router of main.py, used for updates without an
+    async handler.
+    """
+    connector = aiohttp.TCPConnector(limit=cfg.ASYNC_POOL_SIZE)
+    session = aiohttp.ClientSession(connector=connector, connector_owner=False)
+    async_core.api = async_core.AsyncBotApi(session)
+    async_vpn.configure(connector)
+    runner = ChatOrderedRunner(make_handler(handle_update), cfg.ASYNC_CONCURRENCY, cfg.ASYNC_MAX_PENDING)
+    metrics.gauge("pending_updates", lambda: runner.pending)
+    try:
+        unfinished = await asyncio.to_thread(updates_log.get_update_log().unfinished)
+        if unfinished:
+            logger.info("Resuming %d unfinished updates", len(unfinished))
+        for update in unfinished:
+            await runner.submit(update)
+        await poll_updates(runner)
+    finally:
+        logger.info("Stopping bot, waiting for %d pending updates", runner.pending)
+        await runner.shutdown(30)
+        await async_vpn.close_sessions()
+        await session.close()
+        await connector.close()
@@ -0,0 +1,356 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime
+import aiohttp
+import config as cfg
+import async_core
+import file_id_cache
+import qr
+import state
+import subscriptions
+import updates_log
+import vpn
+from state import PendingSelection, DeliveredConfig
+from registry import registry, resolve_servers
+from placement import placement
+from metrics import inc, span
+import ui
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncPanelSession:
+    """Asyncio counterpart of panel.PanelSession.
+
+    Shares the pooled aiohttp session of the runtime, keeps the auth cookie of
+    the panel in its own cookie jar and logs in again when the cookie is older
+    than cfg.PANEL_SESSION_MAX_AGE or when the panel reports an auth failure.
+    """
+
+    def __init__(self, server, connector):
+        self.server = server
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            connector_owner=False,
+            # Panels are often reached by IP address, the default jar ignores their cookies
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            timeout=aiohttp.ClientTimeout(total=cfg.PANEL_TIMEOUT),
+        )
+        self._lock = asyncio.Lock()
+        self._logged_in_at = None
+        self._generation = 0
+        self.stats = {"logins": 0, "reuses": 0, "relogins": 0, "failures": 0}
+
+    async def _login_locked(self):
+        login_url = f"{self.server.api_url}/login"
+        login_data = {"username": cfg.API_USERNAME, "password": cfg.API_PASSWORD}
+        logger.debug("Authenticating with 3xui API of server %s", self.server.country)
+        # Requests in flight keep the old cookie, a successful login replaces it through Set-Cookie
+        self._logged_in_at = None
+        try:
+            with span("panel_login"):
+                async with self._session.post(login_url, data=login_data) as response:
+                    response.raise_for_status()
+                    result = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            self.stats["failures"] += 1
+            raise
+        if not result.get('success'):
+            self.stats["failures"] += 1
+            logger.error("Failed to login to 3xui API: %s", result.get('msg'))
+            return False, result.get('msg')
+        self.stats["logins"] += 1
+        self._logged_in_at = time.monotonic()
+        self._generation += 1
+        return True, None
+
+    async def ensure_login(self):
+        """Logs in unless a fresh auth cookie is cached.
+
+        Returns:
+            tuple: (success, error message)
+        """
+        async with self._lock:
+            if (
+                self._logged_in_at is not None
+                and time.monotonic() - self._logged_in_at < cfg.PANEL_SESSION_MAX_AGE
+            ):
+                return True, None
+            return await self._login_locked()
+
+    async def _relogin(self, generation):
+        async with self._lock:
+            if generation != self._generation:
+                return True, None
+            self.stats["relogins"] += 1
+            return await self._login_locked()
+
+    async def _send(self, method, url, **kwargs):
+        """Returns the decoded JSON response or None on an auth failure, failed logins are counted by _login_locked."""
+        try:
+            async with self._session.request(method, url, allow_redirects=False, **kwargs) as response:
+                content_type = response.headers.get("Content-Type", "")
+                if response.status in (401, 403, 404) or 300 <= response.status < 400 or "text/html" in content_type:
+                    return None
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.stats["failures"] += 1
+            raise
+
+    async def request(self, method, url, **kwargs):
+        """Sends an authenticated request, logging in again once on auth failure.
+
+        Returns:
+            dict: Decoded JSON response of the panel
+
+        Raises:
+            aiohttp.ClientError: If the request or the login failed
+            asyncio.TimeoutError: If the panel did not answer within cfg.PANEL_TIMEOUT
+        """
+        success, error_msg = await self.ensure_login()
+        if not success:
+            raise aiohttp.ClientError(f"3xui login failed: {error_msg}")
+        generation = self._generation
+        data = await self._send(method, url, **kwargs)
+        if data is None:
+            logger.info("3xui session of server %s expired, logging in again", self.server.country)
+            success, error_msg = await self._relogin(generation)
+            if not success:
+                raise aiohttp.ClientError(f"3xui login failed: {error_msg}")
+            data = await self._send(method, url, **kwargs)
+            if data is None:
+                self.stats["failures"] += 1
+                raise aiohttp.ClientError("3xui rejected the request after login")
+        else:
+            self.stats["reuses"] += 1
+        return data
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def close(self):
+        await self._session.close()
+
+
+# Set up by async_main.run for the lifetime of the event loop
+_connector = None
+_sessions = {}
+
+
+def configure(connector):
+    """Sets the pooled connector that panel sessions share."""
+    global _connector
+    _connector = connector
+    _sessions.clear()
+
+
+def get_session(server):
+    """Returns the AsyncPanelSession of the server, creating it on first use."""
+    session = _sessions.get(server)
+    if session is None:
+        session = AsyncPanelSession(server, _connector)
+        _sessions[server] = session
+    return session
+
+
+async def close_sessions():
+    for session in list(_sessions.values()):
+        await session.close()
+    _sessions.clear()
+
+
+async def get_reality_inbounds(server):
+    """Async version of vpn.get_reality_inbounds, shares vpn.inbound_cache."""
+    reality_inbounds = vpn.inbound_cache.get(server)
+    if reality_inbounds is not None:
+        return reality_inbounds, None
+    with span("inbound_fetch"):
+        data = await get_session(server).get(f"{server.api_url}/panel/api/inbounds/list")
+    return vpn.reality_inbounds_from_list(server, data)
+
+
+async def place_client(servers, chat_id, prefer=None):
+    """Chooses the panel and inbound like vpn.find_placement, the inbounds of the panels are loaded concurrently."""
+    results = await asyncio.gather(
+        *(get_reality_inbounds(server) for server in servers), return_exceptions=True
+    )
+    inbounds_by_server = {}
+    error_msg = "Нет доступных VLESS inbounds с flow=xtls-rprx-vision для добавления пользователя."
+    for server, result in zip(servers, results):
+        if isinstance(result, (aiohttp.ClientError, asyncio.TimeoutError)):
+            logger.error("Error when accessing 3xui API of server %s: %s", server.api_url, result)
+            _record_failure(server, result)
+            error_msg = vpn.UNAVAILABLE_MESSAGE
+            continue
+        if isinstance(result, BaseException):
+            raise result
+        reality_inbounds, server_error = result
+        if reality_inbounds is None:
+            error_msg = server_error
+            continue
+        inbounds_by_server[server] = reality_inbounds
+    if prefer is not None:
+        preferred = vpn.find_inbound(inbounds_by_server, *prefer)
+        if preferred is not None:
+            return preferred
+    chosen = placement.choose(inbounds_by_server, chat_id)
+    if chosen is None:
+        await async_core.send_message(chat_id, error_msg)
+    return chosen
+
+
+async def load_inbound_clients(session, server, inbound_id):
+    """Async version of vpn.load_inbound_clients, shares vpn.client_index."""
+    with span("client_fetch"):
+        data = await session.get(f"{server.api_url}/panel/api/inbounds/get/{inbound_id}")
+    return vpn.index_inbound_clients(server, inbound_id, data)
+
+
+async def get_matching_clients(session, server, inbound_id, chat_id):
+    """Async version of vpn.get_matching_clients."""
+    clients = vpn.client_index.get(server, inbound_id)
+    if clients is None:
+        clients = await load_inbound_clients(session, server, inbound_id)
+        if clients is None:
+            await async_core.send_message(chat_id, "Не удалось получить детали inbound.")
+            return []
+    return list(clients.by_tg_id.get(str(chat_id), []))
+
+
+async def add_new_client(session, server, inbound_id, chat_id, username, idempotency_key=None):
+    """Adds a new client like vpn.add_client_stage."""
+    if idempotency_key is not None:
+        client_uuid = await asyncio.to_thread(vpn.idempotent_client_uuid, idempotency_key, server, inbound_id)
+        if client_uuid is not None:
+            clients = vpn.client_index.get(server, inbound_id) or await load_inbound_clients(
+                session, server, inbound_id
+            )
+            if clients is not None and client_uuid in clients.by_uuid:
+                logger.info("Reusing client created earlier for idempotency key %s", idempotency_key)
+                return client_uuid
+    store = await asyncio.to_thread(subscriptions.get_store)
+    client = vpn.new_client(chat_id, username, await asyncio.to_thread(store.sub_id, chat_id))
+    payload = {"id": inbound_id, "settings": json.dumps({"clients": [client]})}
+    with span("add_client"):
+        data = await session.post(f"{server.api_url}/panel/api/inbounds/addClient", json=payload)
+    error_msg = vpn.clients_added(server, inbound_id, [client], data)
+    if error_msg is not None:
+        await async_core.send_message(chat_id, f"Не удалось добавить клиента: {error_msg}")
+        return None
+    if idempotency_key is not None:
+        idempotency_keys = await asyncio.to_thread(updates_log.get_idempotency_keys)
+        await asyncio.to_thread(
+            idempotency_keys.put, idempotency_key, server.country, inbound_id, client["id"], server.api_url
+        )
+    logger.info("Client successfully added for user %s", chat_id)
+    return client["id"]
+
+
+async def send_qr_photo(chat_id, vless_link, caption):
+    """Async version of vpn.send_qr_photo, the QR code is rendered and file_ids are stored off the event loop."""
+    file_ids = await asyncio.to_thread(file_id_cache.get_cache)
+    file_id = file_ids.get(vless_link)
+    if file_id is not None:
+        with span("photo_resend"):
+            response = await async_core.send_photo(chat_id, file_id, caption=caption)
+        if response is not None:
+            return
+        logger.warning("Cached file_id was rejected, uploading QR code again")
+        await asyncio.to_thread(file_ids.discard, vless_link)
+    photo = await asyncio.to_thread(qr.qr_photo, vless_link)
+    with span("upload"):
+        response = await async_core.send_photo(chat_id, photo, caption=caption)
+    file_id = file_id_cache.photo_file_id(response)
+    if file_id is not None:
+        await asyncio.to_thread(file_ids.put, vless_link, file_id)
+
+
+async def send_vpn_configuration(chat_id, server, client_uuid, server_port, public_key, sni, short_id, username):
+    """Delivers the configuration like vpn.render_stage and vpn.deliver_stage."""
+    vless_link = vpn.build_vless_link(server, client_uuid, server_port, public_key, sni, short_id, username)
+    sub_url = await asyncio.to_thread(vpn.record_configuration, chat_id, vless_link)
+    await send_qr_photo(chat_id, vless_link, vpn.configuration_caption(vless_link, sub_url))
+    await asyncio.to_thread(state.store.put, chat_id, DeliveredConfig(vless_link))
+
+
+def _record_failure(server, error):
+    """Async version of vpn._record_failure."""
+    inc("panel_failures", country=server.country)
+    if isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+        registry.record(server, error=error)
+
+
+async def create_vpn_account(chat_id, telegram_username, country="nl", idempotency_key=None):
+    """Creates a VPN account inline like the stages of vpn.create_vpn_account, without a job queue."""
+    logger.info("Creating VPN account for user %s with country %s", chat_id, country)
+    servers = resolve_servers(country)
+    if servers is None:
+        await async_core.send_message(chat_id, "Неизвестная страна. Используется сервер по умолчанию.")
+        servers = resolve_servers(cfg.DEFAULT_COUNTRY) or []
+    if not servers:
+        await async_core.send_message(chat_id, vpn.UNAVAILABLE_MESSAGE, reply_markup=ui.country_menu())
+        return
+
+    # Idempotency keys, rate limits and conversation state may be in SQLite, which must not block the event loop
+    retried, prefer = False, None
+    if idempotency_key is not None:
+        idempotency_keys = await asyncio.to_thread(updates_log.get_idempotency_keys)
+        retried = await asyncio.to_thread(idempotency_keys.get, idempotency_key) is not None
+        if retried:
+            prefer = await asyncio.to_thread(vpn.idempotent_placement, idempotency_key)
+    if not retried and not await asyncio.to_thread(vpn.check_rate_limit, chat_id, servers[0]):
+        await async_core.send_message(chat_id, vpn.rate_limit_message(servers[0]))
+        return
+
+    timestamp = int(datetime.utcnow().timestamp())
+    if telegram_username:
+        email = f"{telegram_username}_{timestamp}"
+    else:
+        email = f"user{chat_id}_{timestamp}"
+
+    placed = await place_client(servers, chat_id, prefer)
+    if placed is None:
+        return
+    server, inbound = placed
+    inbound_id, server_port, public_key, short_id, sni = (
+        inbound.id, inbound.port, inbound.public_key, inbound.short_id, inbound.sni
+    )
+    session = get_session(server)
+    try:
+        success, _ = await session.ensure_login()
+        if not success:
+            await async_core.send_message(chat_id, "Не удалось войти в API 3xui. Проверьте логин и пароль.")
+            return
+        matching_clients = await get_matching_clients(session, server, inbound_id, chat_id)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error when accessing 3xui API: %s", e)
+        _record_failure(server, e)
+        await async_core.send_message(chat_id, vpn.FAILED_MESSAGE)
+        return
+
+    if matching_clients and not retried:
+        await asyncio.to_thread(state.store.put, chat_id, PendingSelection(
+            server.country, inbound_id, server_port, public_key, short_id, sni, email, matching_clients,
+            server.api_url,
+        ))
+        msg = "Найдены следующие существующие клиенты с вашими данными:\n"
+        for i, client in enumerate(matching_clients, start=1):
+            msg += f"{i}. ID: {client.get('id')}\n"
+        msg += "\nВведите номер клиента для использования или введите 'новый' для создания нового клиента."
+        await async_core.send_message(chat_id, msg)
+        return
+    try:
+        client_uuid = await add_new_client(session, server, inbound_id, chat_id, email, idempotency_key)
+        if client_uuid is None:
+            return
+        await send_vpn_configuration(chat_id, server, client_uuid, server_port, public_key, sni, short_id, email)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error("Error when adding client: %s", e)
+        _record_failure(server, e)
+        await async_core.send_message(chat_id, vpn.FAILED_MESSAGE)
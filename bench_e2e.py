@@ -0,0 +1,240 @@
+"""End-to-end benchmark of update handling against local fake backends.
+
+Feeds a synthetic (or recorded) stream of updates through main.accept_update
+and the real Dispatcher, so every update runs process_message /
+handle_callback_query with the real panel, QR and Bot API code against
+fakes.FakePanel and fakes.FakeBotApi. The mix contains /start messages,
+help_* lookups, country_* account creations and numeric client selections
+of users that already have a client.
+
+Reports updates per second, latency histograms of the stages recorded by
+metrics.span (panel login, inbound fetch, client fetch, addClient, QR render,
+upload and the whole update) and peak RSS, and saves them as JSON. --compare
+prints the change against an earlier result.
+
+Usage:
+    python bench_e2e.py [--updates 2000] [--users 500] [--mix start=30,help=30,create=30,select=10]
+        [--workers 8] [--panel-latency 0.02] [--telegram-latency 0.01] [--output bench_e2e.json]
+    python bench_e2e.py --record stream.jsonl ...        # save the generated stream
+    python bench_e2e.py --replay stream.jsonl ...        # replay a recorded stream
+    python bench_e2e.py --compare old.json ...
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+PLATFORMS = ("android", "ios", "windows", "macos")
+KINDS = ("start", "help", "create", "select")
+
+
+def parse_mix(text):
+    """Parses "start=30,help=30,..." into weights per update kind."""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in KINDS:
+            raise ValueError(f"Unknown update kind {kind}, expected one of {', '.join(KINDS)}")
+        mix[kind] = float(weight)
+    return mix
+
+
+def generate_stream(count, users, mix, seed):
+    """Returns a list of about count updates of the mix.
+
+    Creations come from chats without a client. A selection is a country_
+    click of a chat that already has a client, answered by "1".
+    """
+    from fakes import callback_update, message_update
+
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    existing_users = list(range(1, users + 1))
+    next_new_user = users + 1
+    updates = []
+    while len(updates) < count:
+        kind = rng.choices(kinds, weights)[0]
+        if kind == "start":
+            updates.append(message_update(rng.choice(existing_users), "/start"))
+        elif kind == "help":
+            updates.append(callback_update(rng.choice(existing_users), f"help_{rng.choice(PLATFORMS)}"))
+        elif kind == "create":
+            updates.append(callback_update(next_new_user, "country_nl"))
+            next_new_user += 1
+        else:
+            chat_id = rng.choice(existing_users)
+            updates.append(callback_update(chat_id, "country_nl"))
+            updates.append(message_update(chat_id, "1"))
+    return updates
+
+
+def git_version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return round(rss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10), 1)
+
+
+def compare(result, baseline):
+    """Prints the change of throughput and stage p95 latencies against a baseline result."""
+    def change(new, old):
+        if not old or new is None:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"against {baseline.get('label') or baseline.get('version')}:")
+    print(
+        f"  updates/s {baseline['updates_per_second']} -> {result['updates_per_second']} "
+        f"({change(result['updates_per_second'], baseline['updates_per_second'])})"
+    )
+    print(f"  peak RSS {baseline['peak_rss_mb']} -> {result['peak_rss_mb']} MiB")
+    for stage, stats in sorted(result["stages"].items()):
+        old = baseline["stages"].get(stage)
+        if old is not None:
+            print(f"  {stage:<14} p95 {old['p95']} -> {stats['p95']} ({change(stats['p95'], old['p95'])})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end update handling benchmark")
+    parser.add_argument("--updates", type=int, default=2000, help="Number of synthetic updates")
+    parser.add_argument("--users", type=int, default=500, help="Number of users that already have a client")
+    parser.add_argument("--mix", default="start=30,help=30,create=30,select=10", help="Weights of the update kinds")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the synthetic stream")
+    parser.add_argument("--replay", help="JSONL file of updates to replay instead of a synthetic stream")
+    parser.add_argument("--record", help="Saves the stream as JSONL for later replays")
+    parser.add_argument("--workers", type=int, default=8, help="Number of dispatcher workers")
+    parser.add_argument("--max-pending", type=int, default=100, help="Dispatcher queue bound")
+    parser.add_argument("--slow-workers", type=int, default=8, help="Dispatcher workers for slow updates")
+    parser.add_argument("--max-pending-slow", type=int, default=100, help="Dispatcher queue bound of slow updates")
+    parser.add_argument("--job-workers", type=int, default=8, help="Threads running provisioning jobs")
+    parser.add_argument("--inbounds", type=int, default=2, help="Reality inbounds of the fake panel")
+    parser.add_argument("--panel-latency", type=float, default=0.02, help="Seconds of delay per panel call")
+    parser.add_argument("--telegram-latency", type=float, default=0.01, help="Seconds of delay per Bot API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a 5xx from either fake")
+    parser.add_argument("--telegram-pacing", action="store_true", help="Keep the real Bot API rate limits of bot_api")
+    parser.add_argument("--qr-processes", type=int, default=0, help="QR rendering processes, 0 renders in the workers")
+    parser.add_argument("--label", help="Name of this run in the result")
+    parser.add_argument("--output", default="bench_e2e.json", help="Where the JSON result is written")
+    parser.add_argument("--compare", help="Earlier JSON result to compare with")
+    args = parser.parse_args()
+
+    for key in ("replay", "record", "output", "compare"):
+        if getattr(args, key):
+            setattr(args, key, os.path.abspath(getattr(args, key)))
+
+    # Everything persistent goes to a throwaway directory
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    os.chdir(workdir)
+    import config as cfg
+    cfg.DB_PATH = os.path.join(workdir, "bench.db")
+    cfg.QR_PROCESSES = args.qr_processes
+    cfg.RATE_LIMITS = {"create_account": (10 ** 9, 1)}
+    if not args.telegram_pacing:
+        cfg.TELEGRAM_GLOBAL_RATE = cfg.TELEGRAM_CHAT_RATE = cfg.TELEGRAM_GROUP_RATE = 10 ** 6
+        cfg.TELEGRAM_CHAT_BURST = cfg.TELEGRAM_GROUP_BURST = 10 ** 6
+    import jobs
+    import main
+    import message_handler
+    import qr
+    import vpn
+    # Per-request debug logging would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+    from dispatcher import Dispatcher
+    from fakes import FakeBotApi, FakePanel
+    from metrics import metrics
+
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = generate_stream(args.updates, args.users, parse_mix(args.mix), args.seed)
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as f:
+            for update in updates:
+                f.write(json.dumps(update) + "\n")
+
+    panel = FakePanel(inbounds=args.inbounds, latency=args.panel_latency, error_rate=args.error_rate)
+    # Existing users have a client in every inbound, so a selection finds one wherever it is placed
+    for inbound_id, inbound in panel.inbounds.items():
+        inbound["clients"].extend(
+            {"id": f"00000000-0000-4000-{inbound_id:04d}-{chat_id:012d}", "flow": "xtls-rprx-vision",
+             "email": f"user{chat_id}_{inbound_id}", "tgId": str(chat_id)}
+            for chat_id in range(1, args.users + 1)
+        )
+    telegram = FakeBotApi(latency=args.telegram_latency, error_rate=args.error_rate)
+    with panel, telegram:
+        cfg.SERVERS = {"nl": panel.url}
+        cfg.DEFAULT_COUNTRY = "nl"
+        cfg.TELEGRAM_API_URL = telegram.url
+        dispatcher = Dispatcher(
+            main.process_update, args.workers, args.max_pending,
+            classify=message_handler.update_cost,
+            slow_workers=args.slow_workers,
+            max_pending_slow=args.max_pending_slow,
+        )
+        runner = jobs.JobRunner(jobs.get_queue(), vpn.PROVISIONING_STAGES, vpn.provisioning_failed, args.job_workers)
+        runner.start()
+        metrics.reset()
+        start = time.perf_counter()
+        for update in updates:
+            main.accept_update(dispatcher, update)
+        dispatcher.drain()
+        # Account creations finish in the provisioning jobs
+        runner.drain()
+        elapsed = time.perf_counter() - start
+        dispatcher.shutdown()
+        runner.stop()
+        qr.get_renderer().shutdown()
+
+    result = {
+        "label": args.label,
+        "version": git_version(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {
+            key: getattr(args, key) for key in (
+                "updates", "users", "mix", "seed", "replay", "workers", "max_pending", "slow_workers",
+                "max_pending_slow", "job_workers", "inbounds",
+                "panel_latency", "telegram_latency", "error_rate", "telegram_pacing", "qr_processes",
+            )
+        },
+        "updates": len(updates),
+        "elapsed": round(elapsed, 3),
+        "updates_per_second": round(len(updates) / elapsed, 1),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": metrics.snapshot(),
+        "panel_calls": dict(panel.calls),
+        "telegram_calls": dict(telegram.calls),
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"{result['updates']} updates in {result['elapsed']}s: {result['updates_per_second']} updates/s, "
+          f"peak RSS {result['peak_rss_mb']} MiB")
+    for stage, stats in sorted(result["stages"].items()):
+        mean = f"{stats['mean'] * 1000:.1f}ms" if stats["mean"] is not None else "n/a"
+        print(f"  {stage:<14} n={stats['count']:<6} mean={mean:<9} p50<={stats['p50']}s p95<={stats['p95']}s max={stats['max']:.3f}s")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Benchmark of bulk provisioning against local fake 3x-ui panels.
+
+Starts --servers fake panels, each with two VLESS+Reality inbounds and
+--latency seconds of delay per API call, and provisions --users users with
+single-client addClient calls (--chunk-size 1, like the bot) and with
+multi-client chunks. Reports clients per second, addClient calls and QR codes
+rendered per second.
+
+Usage: python bench_provision.py [--users 2000] [--servers 2] [--latency 0.02] [--chunk-size 100]
+"""
+import argparse
+import json
+import os
+import tempfile
+from fakes import FakePanel
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk provisioning benchmark")
+    parser.add_argument("--users", type=int, default=2000, help="Number of users to provision")
+    parser.add_argument("--servers", type=int, default=2, help="Number of fake panels")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds of delay per panel API call")
+    parser.add_argument("--chunk-size", type=int, default=100, help="Clients per addClient call")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_provision_")
+    import config as cfg
+    cfg.DB_PATH = os.path.join(workdir, "bench.db")
+    import provision
+
+    panels = [FakePanel(inbounds=2, latency=args.latency).start() for _ in range(args.servers)]
+    cfg.SERVERS = {f"s{i}": panel.url for i, panel in enumerate(panels)}
+    cfg.DEFAULT_COUNTRY = "s0"
+    input_path = os.path.join(workdir, "users.jsonl")
+    with open(input_path, "w", encoding="utf-8") as f:
+        for i in range(args.users):
+            f.write(json.dumps({"username": f"user{i}", "tg_id": 100000 + i, "country": f"s{i % args.servers}"}) + "\n")
+
+    for chunk_size in (1, args.chunk_size):
+        report = provision.provision(input_path, os.path.join(workdir, f"out_{chunk_size}"), chunk_size=chunk_size)
+        qr_per_second = report["qr_rendered"] / report["qr_elapsed"] if report["qr_elapsed"] else 0.0
+        print(
+            f"chunk_size={chunk_size:<5} clients={report['added']} calls={report['calls']} "
+            f"elapsed={report['elapsed']}s throughput={report['per_second']:,.0f} clients/s "
+            f"qr={qr_per_second:,.0f}/s"
+        )
+
+
+if __name__ == "__main__":
+    main()
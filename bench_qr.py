@@ -0,0 +1,64 @@
+"""Micro-benchmark of the QR rendering stage.
+
+Reports renders per second for uncached rendering in one thread, rendering
+from the LRU cache, rendering with a fixed mask pattern, and uncached
+rendering from several threads with and without the process pool.
+
+Usage: python bench_qr.py [--count 200] [--threads 8] [--processes 4]
+"""
+import argparse
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import config as cfg
+from qr import QrRenderer
+
+
+def sample_link():
+    return (
+        f"vless://{uuid.uuid4()}@nl.example.com:443?type=tcp&security=reality&pbk=Z84J2IelR9ch3k8VtlVhhs5ycBUlXA7wHBWcBrjqnAw"
+        f"&fp=chrome&sni=www.google.com&sid=6ba85179e30d4fc2&spx=%2F&flow=xtls-rprx-vision#user_1700000000"
+    )
+
+
+def measure(name, renderer, links, threads):
+    start = time.perf_counter()
+    if threads > 1:
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(renderer.render, links))
+    else:
+        for link in links:
+            renderer.render(link)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {len(links) / elapsed:10.1f} renders/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QR rendering benchmark")
+    parser.add_argument("--count", type=int, default=200, help="Number of distinct links")
+    parser.add_argument("--threads", type=int, default=8, help="Number of concurrent callers")
+    parser.add_argument("--processes", type=int, default=4, help="Size of the process pool")
+    args = parser.parse_args()
+
+    links = [sample_link() for _ in range(args.count)]
+    print(f"box_size={cfg.QR_BOX_SIZE} border={cfg.QR_BORDER} error_correction={cfg.QR_ERROR_CORRECTION} mask_pattern={cfg.QR_MASK_PATTERN}")
+
+    renderer = QrRenderer(cache_size=args.count)
+    measure("uncached, 1 thread", renderer, links, 1)
+    measure("cached, 1 thread", renderer, links, 1)
+
+    measure(f"uncached, {args.threads} threads", QrRenderer(cache_size=args.count), links, args.threads)
+
+    mask_pattern, cfg.QR_MASK_PATTERN = cfg.QR_MASK_PATTERN, 0
+    measure("uncached, 1 thread, fixed mask pattern", QrRenderer(cache_size=args.count), links, 1)
+    cfg.QR_MASK_PATTERN = mask_pattern
+
+    renderer = QrRenderer(cache_size=args.count, processes=args.processes)
+    # Start the worker processes outside of the measurement
+    renderer.render(sample_link())
+    measure(f"uncached, {args.threads} threads, {args.processes} processes", renderer, links, args.threads)
+    renderer.shutdown()
+
+
+if __name__ == "__main__":
+    main()
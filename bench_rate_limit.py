@@ -0,0 +1,72 @@
+"""Benchmark of the rate limiter with many distinct chat IDs.
+
+Reports the memory held by the limiter state and the latency of a check for
+--keys distinct chat IDs, each making --requests requests. With --legacy the
+same load is run against the former per-chat list of datetimes for comparison.
+
+Usage: python bench_rate_limit.py [--keys 1000000] [--requests 2] [--legacy]
+"""
+import argparse
+from array import array
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from ratelimit import GcraLimiter
+
+
+def legacy_check(user_requests, chat_id, now):
+    """The former check_rate_limit: a list of request times per chat."""
+    if chat_id not in user_requests:
+        user_requests[chat_id] = []
+    user_requests[chat_id] = [t for t in user_requests[chat_id] if now - t < timedelta(hours=1)]
+    if len(user_requests[chat_id]) >= 3:
+        return False
+    user_requests[chat_id].append(now)
+    return True
+
+
+def run(name, check, keys, requests):
+    tracemalloc.start()
+    # Raw int64 storage, so the samples add no Python objects to the traced memory
+    samples = array("q")
+    start = time.perf_counter()
+    for _ in range(requests):
+        for chat_id in range(keys):
+            t = time.perf_counter_ns()
+            check(chat_id)
+            samples.append(time.perf_counter_ns() - t)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    state_bytes = current - samples.buffer_info()[1] * samples.itemsize
+    samples = sorted(samples)
+    print(
+        f"{name:<8} keys={keys} checks={len(samples)} "
+        f"state={state_bytes / 2 ** 20:.1f} MiB ({state_bytes / keys:.0f} B/key) "
+        f"throughput={len(samples) / elapsed:,.0f} checks/s "
+        f"mean={statistics.fmean(samples):.0f}ns p50={samples[len(samples) // 2]}ns "
+        f"p99={samples[int(len(samples) * 0.99)]}ns"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rate limiter benchmark")
+    parser.add_argument("--keys", type=int, default=1_000_000, help="Number of distinct chat IDs")
+    parser.add_argument("--requests", type=int, default=2, help="Requests per chat ID")
+    parser.add_argument("--legacy", action="store_true", help="Also run the former list based limiter")
+    args = parser.parse_args()
+
+    limiter = GcraLimiter()
+    run("gcra", lambda chat_id: limiter.allow("create_account", chat_id), args.keys, args.requests)
+    start = time.perf_counter()
+    limiter.evict(now=time.monotonic() + 3600)
+    print(f"eviction of {args.keys} idle keys took {time.perf_counter() - start:.2f}s, {len(limiter)} keys left")
+
+    if args.legacy:
+        user_requests = {}
+        run("legacy", lambda chat_id: legacy_check(user_requests, chat_id, datetime.utcnow()), args.keys, args.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import config as cfg
+
+logger = logging.getLogger(__name__)
+
+# Content type of bodies that were form-encoded in advance, see ui.Reply
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of rejecting calls.
+
+    The balance may go negative, the deficit is the queue of callers that
+    already reserved a token and are waiting for it.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """Takes a token and returns the number of seconds to wait before using it."""
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def penalize(self, now, seconds):
+        """Blocks the bucket for the given number of seconds, e.g. after a 429."""
+        self._refill(now)
+        # The next reservation waits at least the given number of seconds
+        self.tokens = min(self.tokens, 1) - seconds * self.rate
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class BotApiClient:
+    """Paced, retrying client used for every outbound Bot API call.
+
+    Calls that target a chat are limited by a global and a per-chat token
+    bucket. A 429 answer blocks the affected bucket for parameters.retry_after
+    seconds and the call is retried, 5xx answers and connection errors are
+    retried with exponential backoff and jitter.
+    """
+
+    def __init__(self):
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cfg.TELEGRAM_POOL_SIZE)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._global = TokenBucket(cfg.TELEGRAM_GLOBAL_RATE, cfg.TELEGRAM_GLOBAL_RATE)
+        self._chats = {}
+        self._last_sweep = time.monotonic()
+        self.stats = {
+            "calls": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "failures": 0,
+            "waiting": 0,
+            "max_waiting": 0,
+            "wait_seconds": 0.0,
+            "max_wait_seconds": 0.0,
+        }
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Negative chat IDs are groups and channels, which have a per-minute limit
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(cfg.TELEGRAM_GROUP_RATE, cfg.TELEGRAM_GROUP_BURST)
+            else:
+                bucket = TokenBucket(cfg.TELEGRAM_CHAT_RATE, cfg.TELEGRAM_CHAT_BURST)
+            self._chats[chat_id] = bucket
+        if now - self._last_sweep > 60:
+            # Drop buckets of chats that have been idle long enough to be full again
+            self._chats = {cid: b for cid, b in self._chats.items() if cid == chat_id or not b.is_idle(now)}
+            self._last_sweep = now
+        return bucket
+
+    def _acquire(self, chat_id):
+        """Waits until the global and the chat bucket allow another call."""
+        with self._lock:
+            now = time.monotonic()
+            wait = self._global.reserve(now)
+            if chat_id is not None:
+                wait = max(wait, self._chat_bucket(chat_id, now).reserve(now))
+            if wait <= 0:
+                return
+            self.stats["waiting"] += 1
+            self.stats["max_waiting"] = max(self.stats["max_waiting"], self.stats["waiting"])
+            self.stats["wait_seconds"] += wait
+            self.stats["max_wait_seconds"] = max(self.stats["max_wait_seconds"], wait)
+        try:
+            time.sleep(wait)
+        finally:
+            with self._lock:
+                self.stats["waiting"] -= 1
+
+    def _penalize(self, chat_id, seconds):
+        with self._lock:
+            now = time.monotonic()
+            if chat_id is not None:
+                self._chat_bucket(chat_id, now).penalize(now, seconds)
+            else:
+                self._global.penalize(now, seconds)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def call(self, method, data=None, files=None, chat_id=None, limited=True, timeout=30):
+        """Calls a Bot API method.
+
+        Args:
+            method: Bot API method name, e.g. sendMessage
+            data: Form fields of the request, or an already form-encoded body
+            files: Optional files to upload
+            chat_id: Chat the call targets, used for per-chat pacing
+            limited: False skips pacing, e.g. for getUpdates
+            timeout: Request timeout in seconds
+
+        Returns:
+            dict: Decoded response from Telegram API
+
+        Raises:
+            requests.exceptions.RequestException: If the call failed after all retries
+        """
+        url = f"{cfg.TELEGRAM_API_URL}/{method}"
+        headers = FORM_HEADERS if isinstance(data, bytes) else None
+        self._count("calls")
+        attempt = 0
+        while True:
+            if limited:
+                self._acquire(chat_id)
+            if files:
+                for file in files.values():
+                    if hasattr(file, "seek"):
+                        file.seek(0)
+            try:
+                response = self._session.post(url, data=data, files=files, headers=headers, timeout=timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= cfg.TELEGRAM_MAX_RETRIES:
+                    self._count("failures")
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning("Error when calling %s: %s, retrying in %.1fs", method, e, delay)
+            else:
+                if response.status_code == 429 and attempt < cfg.TELEGRAM_MAX_RETRIES:
+                    retry_after = self._retry_after(response)
+                    self._count("rate_limited")
+                    self._penalize(chat_id, retry_after)
+                    logger.warning("Telegram rate limit hit on %s, retrying after %ss", method, retry_after)
+                    # The penalized bucket delays this call as well, unless pacing is disabled
+                    delay = 0 if limited else retry_after
+                elif response.status_code >= 500 and attempt < cfg.TELEGRAM_MAX_RETRIES:
+                    delay = self._backoff(attempt)
+                    logger.warning("Telegram returned %s on %s, retrying in %.1fs", response.status_code, method, delay)
+                else:
+                    if not response.ok:
+                        self._count("failures")
+                    response.raise_for_status()
+                    return response.json()
+            attempt += 1
+            self._count("retries")
+            if delay:
+                time.sleep(delay)
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return int(response.json().get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            return 1
+
+    @staticmethod
+    def _backoff(attempt):
+        """Exponential backoff with full jitter."""
+        return random.uniform(0, min(cfg.TELEGRAM_MAX_BACKOFF, cfg.TELEGRAM_BASE_BACKOFF * 2 ** attempt))
+
+    def metrics(self):
+        """Returns call, retry and pacing counters including the current wait queue depth."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["tracked_chats"] = len(self._chats)
+        return stats
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the shared BotApiClient, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = BotApiClient()
+    return _client
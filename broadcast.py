@@ -0,0 +1,233 @@
+"""Broadcasts a message to every Telegram user that has a client on any panel.
+
+Recipients are collected from the tgId of the clients of every inbound on
+every server in cfg.SERVERS. Progress is checkpointed per recipient in the
+SQLite database, so an interrupted broadcast continues where it stopped when
+started again with --resume.
+
+Usage:
+    python broadcast.py --token TOKEN --servers '{"servers":{...},"default":"nl"}' \\
+        --username api_user --password api_pass --text "Maintenance tonight"
+    python broadcast.py ... --resume 1700000000
+    python broadcast.py ... --telegram-api-url http://127.0.0.1:8081/botTOKEN --text "test"
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+import config as cfg
+import bot_api
+import core
+import panel
+import storage
+from servers import all_servers
+
+logger = logging.getLogger(__name__)
+
+
+def collect_recipients():
+    """Returns the set of Telegram chat IDs of clients on every configured panel."""
+    recipients = set()
+    for server in all_servers():
+        session = panel.get_session(server)
+        try:
+            response = session.get(f"{server.api_url}/panel/api/inbounds/list")
+            response.raise_for_status()
+            data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error("Error when collecting recipients from server %s: %s", server.country, e)
+            continue
+        if not data.get('success'):
+            logger.error("Failed to get list of inbounds of server %s: %s", server.country, data.get('msg'))
+            continue
+        for inbound in data.get('obj') or []:
+            settings = json.loads(inbound.get('settings') or '{}')
+            for client in settings.get('clients', []):
+                tg_id = str(client.get('tgId') or '').strip()
+                if tg_id.lstrip('-').isdigit():
+                    recipients.add(int(tg_id))
+    return recipients
+
+
+class Broadcast:
+    """A checkpointed broadcast of one text to a fixed set of recipients."""
+
+    def __init__(self, db, broadcast_id):
+        self.db = db
+        self.broadcast_id = broadcast_id
+        self.stats = {"delivered": 0, "blocked": 0, "failed": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create_tables(db):
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS broadcasts ("
+            "id INTEGER PRIMARY KEY, text TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS broadcast_recipients ("
+            "broadcast_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, status TEXT NOT NULL, "
+            "PRIMARY KEY (broadcast_id, chat_id))"
+        )
+
+    @classmethod
+    def create(cls, db, text, recipients):
+        """Stores a new broadcast with all of its recipients pending."""
+        cls._create_tables(db)
+        with db.transaction() as conn:
+            broadcast_id = conn.execute(
+                "INSERT INTO broadcasts (text, created_at) VALUES (?, ?)", (text, time.time())
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO broadcast_recipients (broadcast_id, chat_id, status) VALUES (?, ?, 'pending')",
+                [(broadcast_id, chat_id) for chat_id in recipients],
+            )
+        return cls(db, broadcast_id)
+
+    @classmethod
+    def load(cls, db, broadcast_id):
+        """Loads an existing broadcast to resume it."""
+        cls._create_tables(db)
+        return cls(db, broadcast_id)
+
+    @property
+    def text(self):
+        rows = self.db.execute("SELECT text FROM broadcasts WHERE id = ?", (self.broadcast_id,))
+        if not rows:
+            raise KeyError(f"Unknown broadcast {self.broadcast_id}")
+        return rows[0][0]
+
+    def pending(self):
+        rows = self.db.execute(
+            "SELECT chat_id FROM broadcast_recipients WHERE broadcast_id = ? AND status = 'pending'",
+            (self.broadcast_id,),
+        )
+        return [row[0] for row in rows]
+
+    def counts(self):
+        """Returns the number of recipients per status over the whole broadcast."""
+        rows = self.db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status",
+            (self.broadcast_id,),
+        )
+        return dict(rows)
+
+    def _send(self, text, chat_id):
+        """Sends the text to the recipient, returns the status to record for it."""
+        try:
+            bot_api.get_client().call(
+                "sendMessage",
+                data={"chat_id": chat_id, "text": text, "parse_mode": "Markdown"},
+                chat_id=chat_id,
+            )
+            status = "delivered"
+        except requests.exceptions.HTTPError as e:
+            # 403: the user blocked the bot or deleted the account
+            status = "blocked" if e.response is not None and e.response.status_code == 403 else "failed"
+            logger.info("Broadcast %s to %s: %s", self.broadcast_id, chat_id, e)
+        except requests.exceptions.RequestException as e:
+            status = "failed"
+            logger.error("Broadcast %s to %s failed: %s", self.broadcast_id, chat_id, e)
+        return status
+
+    def run(self, concurrency):
+        """Sends the text to every pending recipient.
+
+        A recipient whose send raised an unexpected error stays pending, so a
+        resumed broadcast tries it again, and is counted in "errors".
+
+        Returns:
+            dict: delivered/blocked/failed/errors counts of this run, elapsed seconds and messages per second
+        """
+        text = self.text
+        recipients = self.pending()
+        logger.info("Broadcast %s: sending to %d recipients", self.broadcast_id, len(recipients))
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="broadcast") as pool:
+            futures = {pool.submit(self._send, text, chat_id): chat_id for chat_id in recipients}
+            for future in as_completed(futures):
+                chat_id = futures[future]
+                try:
+                    status = future.result()
+                except Exception:
+                    logger.exception("Broadcast %s to %s failed", self.broadcast_id, chat_id)
+                    with self._lock:
+                        self.stats["errors"] += 1
+                    continue
+                # The checkpoint only moves past recipients whose send finished
+                self.db.execute(
+                    "UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND chat_id = ?",
+                    (status, self.broadcast_id, chat_id),
+                )
+                with self._lock:
+                    self.stats[status] += 1
+        elapsed = time.monotonic() - start
+        report = dict(self.stats)
+        report["elapsed"] = round(elapsed, 2)
+        report["per_second"] = round(len(recipients) / elapsed, 2) if elapsed > 0 else 0.0
+        logger.info("Broadcast %s finished: %s", self.broadcast_id, report)
+        return report
+
+
+def run_broadcast(text, concurrency=None):
+    """Collects recipients and runs a new broadcast, returns its report."""
+    recipients = collect_recipients()
+    broadcast = Broadcast.create(storage.get_database(), text, recipients)
+    report = broadcast.run(concurrency or cfg.BROADCAST_CONCURRENCY)
+    report["id"] = broadcast.broadcast_id
+    return report
+
+
+def start_broadcast(text, admin_chat_id):
+    """Runs a broadcast in the background and reports the result to the admin."""
+    def worker():
+        try:
+            report = run_broadcast(text)
+        except Exception as e:
+            logger.error("Error when running broadcast: %s", e)
+            core.send_message(admin_chat_id, f"Ошибка рассылки: {e}")
+            return
+        core.send_message(
+            admin_chat_id,
+            f"Рассылка {report['id']} завершена: доставлено {report['delivered']}, "
+            f"заблокировано {report['blocked']}, ошибок {report['failed']}, "
+            f"не отправлено {report['errors']} ({report['per_second']} сообщений/с).",
+        )
+
+    threading.Thread(target=worker, name="broadcast", daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Broadcast a message to all bot users")
+    parser.add_argument("--token", required=True, help="Telegram Bot Token")
+    parser.add_argument("--servers", required=True, help="JSON string with server configuration")
+    parser.add_argument("--username", required=True, help="API Username")
+    parser.add_argument("--password", required=True, help="API Password")
+    parser.add_argument("--telegram-api-url", help="Bot API base URL including the token, e.g. of a local fake Bot API")
+    parser.add_argument("--text", help="Message text (Markdown)")
+    parser.add_argument("--resume", type=int, help="ID of an interrupted broadcast to continue")
+    parser.add_argument("--concurrency", type=int, default=cfg.BROADCAST_CONCURRENCY, help="Number of concurrent senders")
+    args = parser.parse_args()
+    if not args.text and args.resume is None:
+        parser.error("Either --text or --resume is required")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    config = json.loads(args.servers)
+    cfg.TOKEN = args.token
+    cfg.SERVERS = config["servers"]
+    cfg.DEFAULT_COUNTRY = config["default"]
+    cfg.API_USERNAME = args.username
+    cfg.API_PASSWORD = args.password
+    cfg.TELEGRAM_API_URL = args.telegram_api_url or f"https://api.telegram.org/bot{cfg.TOKEN}"
+    if args.resume is not None:
+        broadcast = Broadcast.load(storage.get_database(), args.resume)
+        report = broadcast.run(args.concurrency)
+        report["id"] = args.resume
+        report["totals"] = broadcast.counts()
+    else:
+        report = run_broadcast(args.text, args.concurrency)
+    print(json.dumps(report))
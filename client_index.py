@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+import config as cfg
+
+logger = logging.getLogger(__name__)
+
+
+class InboundClients:
+    """Clients of one inbound indexed by email, tgId and uuid."""
+
+    def __init__(self, clients):
+        self.loaded_at = time.monotonic()
+        self.by_email = {}
+        self.by_uuid = {}
+        self.by_tg_id = {}
+        for client in clients:
+            self.add(client)
+
+    def add(self, client):
+        """Adds a client or replaces the one with the same uuid."""
+        client_uuid = client.get("id")
+        previous = self.by_uuid.get(client_uuid)
+        if previous is not None:
+            self._remove(previous)
+        self.by_uuid[client_uuid] = client
+        if client.get("email"):
+            self.by_email[client["email"]] = client
+        tg_id = client.get("tgId")
+        if tg_id not in (None, "", 0):
+            # The panel may return tgId as a number or as a string
+            self.by_tg_id.setdefault(str(tg_id), []).append(client)
+
+    def _remove(self, client):
+        self.by_email.pop(client.get("email"), None)
+        tg_clients = self.by_tg_id.get(str(client.get("tgId")))
+        if tg_clients and client in tg_clients:
+            tg_clients.remove(client)
+
+    def __len__(self):
+        return len(self.by_uuid)
+
+
+class ClientIndex:
+    """Local index of inbound clients per (server, inbound id).
+
+    An inbound is downloaded from the panel once, kept up to date on addClient
+    and reconciled with the panel in the background every
+    cfg.CLIENT_INDEX_RECONCILE_INTERVAL seconds.
+    """
+
+    def __init__(self, reload):
+        """
+        Args:
+            reload: Callable taking a ServerTarget and an inbound id that
+                downloads the clients of the inbound and stores them with ``put``
+        """
+        self._reload = reload
+        self._lock = threading.Lock()
+        self._inbounds = {}
+        self._reconciling = set()
+
+    def get(self, server, inbound_id):
+        """Returns InboundClients of the inbound or None if it has not been loaded yet."""
+        key = (server, inbound_id)
+        with self._lock:
+            clients = self._inbounds.get(key)
+            if clients is None:
+                return None
+            start_reconcile = (
+                time.monotonic() - clients.loaded_at >= cfg.CLIENT_INDEX_RECONCILE_INTERVAL
+                and key not in self._reconciling
+            )
+            if start_reconcile:
+                self._reconciling.add(key)
+        if start_reconcile:
+            threading.Thread(
+                target=self._background_reconcile, args=key, daemon=True,
+                name=f"client-reconcile-{server.country}-{inbound_id}",
+            ).start()
+        return clients
+
+    def put(self, server, inbound_id, clients):
+        """Replaces the index of the inbound with the list of clients from the panel."""
+        index = InboundClients(clients)
+        with self._lock:
+            self._inbounds[(server, inbound_id)] = index
+        return index
+
+    def add_client(self, server, inbound_id, client):
+        """Adds a client created via addClient to an already loaded inbound."""
+        with self._lock:
+            clients = self._inbounds.get((server, inbound_id))
+            if clients is not None:
+                clients.add(client)
+
+    def invalidate(self, server, inbound_id=None):
+        """Drops one inbound or every inbound of the server from the index."""
+        with self._lock:
+            for key in list(self._inbounds):
+                if key[0] == server and inbound_id in (None, key[1]):
+                    del self._inbounds[key]
+
+    def _background_reconcile(self, server, inbound_id):
+        try:
+            self._reload(server, inbound_id)
+        except Exception as e:
+            logger.error("Error when reconciling clients of inbound %s on server %s: %s", inbound_id, server.country, e)
+        finally:
+            with self._lock:
+                self._reconciling.discard((server, inbound_id))
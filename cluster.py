@@ -0,0 +1,130 @@
+import json
+import logging
+import os
+import secrets
+import socket
+import time
+import config as cfg
+from dispatcher import update_chat_id
+
+logger = logging.getLogger(__name__)
+
+
+def replica_id():
+    """Returns a name of this process that is unique among the replicas."""
+    return f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}"
+
+
+class Lease:
+    """Named lease in the shared database, held by at most one replica at a time.
+
+    The holder has to renew it within cfg.CLUSTER_LEASE_TTL seconds, after
+    that any replica may take it over, e.g. when the holder crashed.
+    """
+
+    def __init__(self, db, name, owner):
+        self._db = db
+        self.name = name
+        self.owner = owner
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def acquire(self):
+        """Takes or renews the lease, returns True if this replica holds it."""
+        now = time.time()
+        with self._db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at <= ?",
+                (self.name, self.owner, now + cfg.CLUSTER_LEASE_TTL, now),
+            )
+            owner = conn.execute("SELECT owner FROM leases WHERE name = ?", (self.name,)).fetchone()[0]
+        return owner == self.owner
+
+    def release(self):
+        """Gives the lease up, so another replica does not wait for it to expire."""
+        self._db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+
+
+class WorkQueue:
+    """Updates waiting for any replica, in the shared database.
+
+    The leader pushes accepted updates, every replica claims a batch that
+    fits its dispatcher. A chat is worked on by one replica at a time: an
+    update is only claimed while no other replica holds a claim on an update
+    of the same chat, and the oldest update of a chat is always claimed
+    first, so per-chat order holds across replicas. Claims expire after
+    cfg.CLUSTER_CLAIM_TTL seconds unless they are renewed, so the updates of
+    a crashed replica are picked up by the others.
+    """
+
+    def __init__(self, db, owner):
+        self._db = db
+        self.owner = owner
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS work_queue ("
+            "update_id INTEGER PRIMARY KEY, chat_key TEXT NOT NULL, payload TEXT NOT NULL, "
+            "claimed_by TEXT, claimed_until REAL NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS work_queue_chat_key ON work_queue (chat_key, update_id)")
+
+    @staticmethod
+    def _chat_key(update):
+        chat_id = update_chat_id(update)
+        return f"update:{update['update_id']}" if chat_id is None else str(chat_id)
+
+    def push(self, updates):
+        """Adds updates to the queue, updates that are already queued are ignored."""
+        self._db.executemany(
+            "INSERT OR IGNORE INTO work_queue (update_id, chat_key, payload) VALUES (?, ?, ?)",
+            [(update["update_id"], self._chat_key(update), json.dumps(update)) for update in updates],
+        )
+
+    def claim(self, limit):
+        """Claims up to limit updates for this replica and returns them, oldest first."""
+        if limit <= 0:
+            return []
+        now = time.time()
+        with self._db.transaction() as conn:
+            # Chats another replica is still working on
+            busy = {
+                row[0] for row in conn.execute(
+                    "SELECT DISTINCT chat_key FROM work_queue WHERE claimed_by IS NOT NULL "
+                    "AND claimed_by != ? AND claimed_until > ?",
+                    (self.owner, now),
+                )
+            }
+            rows = conn.execute(
+                "SELECT update_id, chat_key, payload FROM work_queue "
+                "WHERE claimed_by IS NULL OR claimed_until <= ? ORDER BY update_id LIMIT ?",
+                (now, limit + len(busy) * 4),
+            ).fetchall()
+            claimed = [row for row in rows if row[1] not in busy][:limit]
+            conn.executemany(
+                "UPDATE work_queue SET claimed_by = ?, claimed_until = ? WHERE update_id = ?",
+                [(self.owner, now + cfg.CLUSTER_CLAIM_TTL, row[0]) for row in claimed],
+            )
+        return [json.loads(row[2]) for row in claimed]
+
+    def renew(self):
+        """Extends the claims of this replica."""
+        self._db.execute(
+            "UPDATE work_queue SET claimed_until = ? WHERE claimed_by = ?",
+            (time.time() + cfg.CLUSTER_CLAIM_TTL, self.owner),
+        )
+
+    def release(self, update_ids):
+        """Returns claimed updates to the queue, e.g. when the dispatcher did not accept them."""
+        self._db.executemany(
+            "UPDATE work_queue SET claimed_by = NULL, claimed_until = 0 WHERE update_id = ? AND claimed_by = ?",
+            [(update_id, self.owner) for update_id in update_ids],
+        )
+
+    def complete(self, update_id):
+        """Removes a handled update."""
+        self._db.execute("DELETE FROM work_queue WHERE update_id = ?", (update_id,))
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM work_queue")[0][0]
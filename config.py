@@ -3,27 +3,210 @@ TELEGRAM_API_URL = ""
 # BOT TOKEN
 TOKEN = ""
 
-# URL API 3xui
-API_URL = ""
-
 # 3xui API credes
 API_USERNAME = ""
 API_PASSWORD = ""
 
-# Link to VLESS server
-SERVER_DOMAIN = ""
-
 # Keep track of the last update_id
 LAST_UPDATE_ID = None
 
-# Keep temp user data: {chat_id: {'last_request_time': datetime, 'vless_link': str}}
-user_data = {}
+# Seconds a conversation state record (e.g. a pending client selection, see state.py) is kept
+STATE_TTL = 120
 
-# Keep track of user requests for rate limiting: {chat_id: [timestamp1, timestamp2, ...]}
-user_requests = {}
+# Conversation state backend: "memory" or "sqlite" to keep it across restarts
+STATE_BACKEND = "memory"
 
-# Server mapping by country
+# Server mapping by country: {country: 3xui panel URL or list of panel URLs}, see servers.py
 SERVERS = {}
 
 # Default country
 DEFAULT_COUNTRY = "ru"
+
+# Number of worker threads processing updates concurrently
+WORKER_COUNT = 8
+
+# Maximum number of updates queued or in progress before polling blocks
+MAX_PENDING_UPDATES = 100
+
+# Worker threads and queue bound for slow updates (account creation, client selection),
+# so menu navigation keeps its own WORKER_COUNT workers while provisioning is backed up, see router.py
+SLOW_WORKER_COUNT = 8
+MAX_PENDING_SLOW_UPDATES = 100
+
+# Threads answering callback queries in the background and their Bot API timeout in seconds
+CALLBACK_ANSWER_WORKERS = 4
+CALLBACK_ANSWER_TIMEOUT = 5
+
+# Run updates on an asyncio event loop instead of worker threads, see async_main.py
+ASYNC_ENABLED = False
+
+# Maximum number of updates handled at once in asyncio mode
+ASYNC_CONCURRENCY = 1000
+
+# Maximum number of accepted updates queued or running in asyncio mode before polling waits
+ASYNC_MAX_PENDING = 5000
+
+# Maximum number of pooled connections to Telegram and the panels in asyncio mode
+ASYNC_POOL_SIZE = 100
+
+# Timeout in seconds for 3xui panel API calls
+PANEL_TIMEOUT = 30
+
+# Maximum number of pooled connections per 3xui panel
+PANEL_POOL_SIZE = 10
+
+# Seconds after which a cached 3xui auth cookie is refreshed
+PANEL_SESSION_MAX_AGE = 3600
+
+# How new clients are spread over the inbounds of a country, see placement.py:
+# "least_clients", "weighted" or "consistent_hash"
+PLACEMENT_POLICY = "least_clients"
+
+# Relative capacity per panel URL for the "weighted" policy, panels not listed weigh 1
+PLACEMENT_WEIGHTS = {}
+
+# Seconds a user keeps the inbound chosen for them, and the number of users remembered
+PLACEMENT_DECISION_TTL = 600
+PLACEMENT_DECISION_CACHE_SIZE = 100000
+
+# Seconds between background health probes of all panels, see registry.py
+PROBE_INTERVAL = 30
+
+# Seconds a health probe may take before it counts as failed
+PROBE_TIMEOUT = 5
+
+# Consecutive failed probes after which a panel is not offered to users
+PROBE_FAILURE_THRESHOLD = 2
+
+# Number of recent probe latencies p50/p95 are computed from
+PROBE_WINDOW = 50
+
+# Seconds resolved Reality inbounds of a server are cached
+INBOUND_CACHE_TTL = 600
+
+# Fraction of INBOUND_CACHE_TTL after which cached inbounds are refreshed in the background
+INBOUND_REFRESH_AHEAD = 0.8
+
+# Seconds after which the local client index of an inbound is reconciled with the panel
+CLIENT_INDEX_RECONCILE_INTERVAL = 300
+
+# Webhook mode: receive updates via HTTP POSTs from Telegram instead of getUpdates
+WEBHOOK_ENABLED = False
+
+# Public URL registered with setWebhook, None to skip registration
+WEBHOOK_URL = None
+
+# Address, port and path the webhook server listens on
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/webhook"
+
+# Secret token Telegram sends in the X-Telegram-Bot-Api-Secret-Token header
+WEBHOOK_SECRET = ""
+
+# Seconds a webhook request waits for a free dispatcher slot before answering 503
+WEBHOOK_ACCEPT_TIMEOUT = 10
+
+# Prometheus metrics endpoint (GET /metrics), see metrics.py, local only by default
+METRICS_ENABLED = False
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+
+# Subscription endpoint (GET /sub/<subId>) serving the vless links of a user in the base64 format
+SUBSCRIPTION_ENABLED = False
+SUBSCRIPTION_HOST = "0.0.0.0"
+SUBSCRIPTION_PORT = 2096
+SUBSCRIPTION_PATH = "/sub"
+
+# Public base URL of the endpoint, e.g. "https://sub.example.com/sub", added to delivered configs if set
+SUBSCRIPTION_URL = None
+
+# Seconds a rendered subscription is cached, number of cached subscriptions and
+# hours between refreshes suggested to client apps
+SUBSCRIPTION_CACHE_TTL = 300
+SUBSCRIPTION_CACHE_SIZE = 100000
+SUBSCRIPTION_UPDATE_INTERVAL = 12
+
+# QR code rendering: module size in pixels, quiet zone in modules and error correction level (L, M, Q, H)
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+QR_ERROR_CORRECTION = "M"
+
+# Fixed QR mask pattern (0-7) skips trying all eight masks, None picks the best one
+QR_MASK_PATTERN = None
+
+# Number of rendered QR codes kept in memory, keyed by link
+QR_CACHE_SIZE = 512
+
+# Number of processes rendering QR codes, 0 renders in the worker thread
+QR_PROCESSES = 0
+
+# SQLite database for persistent state (photo file_ids, ...)
+DB_PATH = "data/bot.db"
+
+# Bot API pacing: global calls per second, per-chat calls per second with burst,
+# and per-group calls per second with burst (20 messages per minute)
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_CHAT_RATE = 1
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_GROUP_BURST = 20
+
+# Retries of Bot API calls answered with 429, 5xx or a connection error
+TELEGRAM_MAX_RETRIES = 5
+
+# Exponential backoff in seconds for 5xx and connection errors: base delay and upper bound
+TELEGRAM_BASE_BACKOFF = 0.5
+TELEGRAM_MAX_BACKOFF = 30
+
+# Maximum number of pooled connections to the Bot API
+TELEGRAM_POOL_SIZE = 20
+
+# Telegram chat IDs allowed to run admin commands such as /broadcast
+ADMIN_IDS = set()
+
+# Number of concurrent senders of a broadcast, pacing is done by bot_api
+BROADCAST_CONCURRENCY = 16
+
+# Clients per multi-client addClient call and number of servers provisioned at once by provision.py
+PROVISION_CHUNK_SIZE = 100
+PROVISION_CONCURRENCY = 8
+
+# Rate limits as (number of requests, period in seconds) per action,
+# "action:country" entries override the limit for one server
+RATE_LIMITS = {
+    "create_account": (3, 3600),
+}
+
+# Seconds between sweeps that drop rate limit state of idle users
+RATE_LIMIT_EVICT_INTERVAL = 300
+
+# Provisioning jobs of bot users, see jobs.py: worker threads, attempts per stage,
+# retry backoff in seconds, seconds a claimed job is held without progress and
+# seconds between checks for jobs due for a retry
+JOB_WORKERS = 8
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BASE_DELAY = 2
+JOB_RETRY_MAX_DELAY = 60
+JOB_CLAIM_TTL = 120
+JOB_POLL_INTERVAL = 1
+
+# Rate limit backend: "memory" or "sqlite" to share the limits between replicas
+RATE_LIMIT_BACKEND = "memory"
+
+# Run as one of several replicas sharing cfg.DB_PATH, see cluster.py
+CLUSTER_ENABLED = False
+
+# Seconds the polling lease is held without renewal, the getUpdates timeout
+# used by the leader has to stay well below it
+CLUSTER_LEASE_TTL = 30
+CLUSTER_POLL_TIMEOUT = 10
+
+# Seconds a replica's claim on queued updates is held without renewal, and
+# seconds between checks of the shared queue for new work
+CLUSTER_CLAIM_TTL = 60
+CLUSTER_CLAIM_INTERVAL = 0.2
+
+# Seconds processed update IDs and client idempotency keys are remembered,
+# Telegram does not redeliver updates older than a day
+UPDATE_LOG_RETENTION = 2 * 24 * 3600
@@ -1,7 +1,10 @@
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import bot_api
 import config as cfg
+from metrics import inc, span
 
 logger = logging.getLogger(__name__)
 
@@ -12,7 +15,7 @@ def send_message(chat_id, text, reply_markup=None):
     Args:
         chat_id: Chat ID to send the message to
         text: Message text
-        reply_markup: Optional keyboard markup
+        reply_markup: Optional keyboard markup, a dict or already serialized JSON
 
     Returns:
         dict: Response from Telegram API or None in case of error
@@ -23,19 +26,40 @@ def send_message(chat_id, text, reply_markup=None):
         "parse_mode": "Markdown",
     }
     if reply_markup:
-        payload["reply_markup"] = json.dumps(reply_markup)
+        payload["reply_markup"] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
     method = "sendMessage"
 
     try:
         logger.debug("Sending message using method %s: %s", method, payload)
-        response = requests.post(
-            f"{cfg.TELEGRAM_API_URL}/{method}", data=payload, timeout=30
-        )
-        response.raise_for_status()
-        logger.debug("Response from Telegram: %s", response.json())
-        return response.json()
+        with span("telegram_send_message"):
+            result = bot_api.get_client().call(method, data=payload, chat_id=chat_id)
+        logger.debug("Response from Telegram: %s", result)
+        return result
     except requests.exceptions.RequestException as e:
         logger.error("Error when sending message: %s", e)
+        inc("errors", kind="telegram")
+        return None
+
+
+def send_reply(chat_id, reply, text=None):
+    """Sends a prepared ui.Reply, its form fields are not encoded again.
+
+    Args:
+        chat_id: Chat ID to send the message to
+        reply: ui.Reply with the fixed fields
+        text: Message text if the reply has none of its own
+
+    Returns:
+        dict: Response from Telegram API or None in case of error
+    """
+    try:
+        with span("telegram_send_message"):
+            result = bot_api.get_client().call("sendMessage", data=reply.body(chat_id, text), chat_id=chat_id)
+        logger.debug("Response from Telegram: %s", result)
+        return result
+    except requests.exceptions.RequestException as e:
+        logger.error("Error when sending message: %s", e)
+        inc("errors", kind="telegram")
         return None
 
 
@@ -44,13 +68,12 @@ def send_photo(chat_id, photo, caption=None):
 
     Args:
         chat_id: Chat ID to send the photo to
-        photo: Photo file
+        photo: Photo file to upload or file_id of an already uploaded photo
         caption: Optional caption text for the photo
 
     Returns:
         dict: Response from Telegram API or None in case of error
     """
-    files = {"photo": photo}
     payload = {
         "chat_id": chat_id,
         "caption": caption,
@@ -59,19 +82,57 @@ def send_photo(chat_id, photo, caption=None):
     }
     if caption:
         payload["caption"] = caption
+    if isinstance(photo, str):
+        # Reusing a file_id sends no bytes
+        payload["photo"] = photo
+        files = None
+    else:
+        files = {"photo": photo}
     try:
         logger.debug("Sending photo")
-        response = requests.post(
-            f"{cfg.TELEGRAM_API_URL}/sendPhoto", data=payload, files=files, timeout=30
-        )
-        response.raise_for_status()
-        logger.debug("Response from Telegram: %s", response.json())
-        return response.json()
+        with span("telegram_send_photo"):
+            result = bot_api.get_client().call("sendPhoto", data=payload, files=files, chat_id=chat_id)
+        logger.debug("Response from Telegram: %s", result)
+        return result
     except requests.exceptions.RequestException as e:
         logger.error("Error when sending photo: %s", e)
+        inc("errors", kind="telegram")
+        return None
+
+
+def answer_callback_query(callback_query_id):
+    """Answers a callback query to remove the loading indicator of the button.
+
+    Args:
+        callback_query_id: ID of the callback query
+
+    Returns:
+        dict: Response from Telegram API or None in case of error
+    """
+    try:
+        with span("telegram_answer_callback"):
+            return bot_api.get_client().call(
+                "answerCallbackQuery",
+                data={"callback_query_id": callback_query_id},
+                timeout=cfg.CALLBACK_ANSWER_TIMEOUT,
+            )
+    except requests.exceptions.RequestException as e:
+        logger.error("Error when sending answerCallbackQuery: %s", e)
+        inc("errors", kind="telegram")
         return None
 
 
+# Threads are only started once the first query is answered
+_answer_executor = ThreadPoolExecutor(
+    max_workers=cfg.CALLBACK_ANSWER_WORKERS, thread_name_prefix="callback-answer"
+)
+
+
+def answer_callback_query_async(callback_query_id):
+    """Answers a callback query from a background thread without waiting for Telegram."""
+    _answer_executor.submit(answer_callback_query, callback_query_id)
+
+
 def get_android_vpn_link():
     """Returns static link to v2rayNG releases page.
 
@@ -0,0 +1,133 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from router import CHEAP, SLOW
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update):
+    """Returns the chat ID an update belongs to, or None if it has no chat."""
+    if "message" in update:
+        return update["message"].get("chat", {}).get("id")
+    if "callback_query" in update:
+        message = update["callback_query"].get("message") or {}
+        return message.get("chat", {}).get("id")
+    return None
+
+
+class Dispatcher:
+    """Fans updates out to bounded worker pools.
+
+    Updates from the same chat are handled strictly in the order they were
+    submitted, updates from different chats run concurrently. At most
+    ``max_pending`` updates may be queued or running at once; ``submit``
+    blocks when that limit is reached.
+
+    With a ``classify(update)`` callback, updates of the router.SLOW cost
+    class run on a second pool with its own ``slow_workers`` and
+    ``max_pending_slow`` limits, so a backlog of slow updates neither takes
+    the workers nor blocks the submission of cheap ones. A chat whose next
+    update has the other cost class is handed over to the other pool.
+    """
+
+    def __init__(self, handler, max_workers, max_pending, classify=None, slow_workers=None, max_pending_slow=None):
+        self._handler = handler
+        self._classify = classify
+        self._executors = {
+            CHEAP: ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="update-worker"),
+        }
+        self._slots = {CHEAP: threading.BoundedSemaphore(max_pending)}
+        if classify is not None:
+            self._executors[SLOW] = ThreadPoolExecutor(
+                max_workers=slow_workers or max_workers, thread_name_prefix="slow-update-worker"
+            )
+            self._slots[SLOW] = threading.BoundedSemaphore(max_pending_slow or max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._chains = {}
+        self._pending = dict.fromkeys(self._executors, 0)
+        self._closed = False
+
+    @property
+    def pending(self):
+        """Number of accepted updates that have not been handled yet."""
+        return sum(self._pending.values())
+
+    def pending_of(self, cost):
+        """Number of accepted updates of the cost class that have not been handled yet."""
+        return self._pending.get(cost, 0)
+
+    def submit(self, update, timeout=None):
+        """Accepts an update for processing.
+
+        Args:
+            update: Update object from Telegram API
+            timeout: Maximum number of seconds to wait for a free slot,
+                None waits indefinitely
+
+        Returns:
+            bool: True if the update was accepted, False on timeout
+        """
+        cost = self._classify(update) if self._classify is not None else CHEAP
+        slots = self._slots[cost]
+        if not slots.acquire(timeout=timeout):
+            logger.warning("Dispatcher is full, %s update %s was not accepted", cost, update.get("update_id"))
+            return False
+        key = update_chat_id(update)
+        if key is None:
+            key = ("update", update.get("update_id"))
+        with self._lock:
+            if self._closed:
+                slots.release()
+                raise RuntimeError("Dispatcher is shut down")
+            self._pending[cost] += 1
+            chain = self._chains.get(key)
+            if chain is not None:
+                chain.append((update, cost))
+                return True
+            self._chains[key] = deque()
+        self._executors[cost].submit(self._run_chain, key, update, cost)
+        return True
+
+    def _run_chain(self, key, update, cost):
+        """Handles an update and then every update queued behind it for the same chat."""
+        while True:
+            try:
+                self._handler(update)
+            except Exception:
+                logger.exception("Error when processing update %s", update.get("update_id"))
+            finally:
+                self._slots[cost].release()
+            with self._lock:
+                self._pending[cost] -= 1
+                if not any(self._pending.values()):
+                    self._idle.notify_all()
+                chain = self._chains[key]
+                if not chain:
+                    del self._chains[key]
+                    return
+                update, next_cost = chain.popleft()
+                if next_cost != cost:
+                    # The chain stays registered, so later updates of the chat queue behind this one
+                    self._executors[next_cost].submit(self._run_chain, key, update, next_cost)
+                    return
+
+    def drain(self, timeout=None):
+        """Waits until every accepted update has been handled.
+
+        Returns:
+            bool: True if the dispatcher is idle, False on timeout
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: not any(self._pending.values()), timeout=timeout)
+
+    def shutdown(self, timeout=None):
+        """Stops accepting updates, drains the pending ones and stops the workers."""
+        with self._lock:
+            self._closed = True
+        if not self.drain(timeout):
+            logger.warning("Dispatcher shut down with %d pending updates", self.pending)
+        for executor in self._executors.values():
+            executor.shutdown(wait=False)
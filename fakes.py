@@ -0,0 +1,430 @@
+"""In-process stand-ins for a 3x-ui panel and the Telegram Bot API.
+
+Both run a ThreadingHTTPServer on a free local port and speak just enough of
+the real protocol for panel.py, vpn.py, bot_api.py and core.py, so the bot
+can be exercised offline by tests and load drivers:
+
+    with FakePanel(latency=0.02) as panel, FakeBotApi() as telegram:
+        cfg.SERVERS = {"nl": panel.url}
+        cfg.TELEGRAM_API_URL = telegram.url
+        telegram.push_update(callback_update(1, "country_nl"))
+
+Latency, random 5xx errors and 429 answers can be configured per instance
+and changed while the server runs.
+"""
+import email.parser
+import email.policy
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+REALITY_STREAM_SETTINGS = json.dumps({
+    "network": "tcp",
+    "security": "reality",
+    "realitySettings": {
+        "serverNames": ["www.google.com"],
+        "shortIds": ["6ba85179e30d4fc2"],
+        "settings": {"publicKey": "Z84J2IelR9ch3k8VtlVhhs5ycBUlXA7wHBWcBrjqnAw"},
+    },
+})
+
+# update_ids of message_update and callback_update, unique within the process like Telegram's
+_update_ids = itertools.count(1)
+
+
+class _FakeServer:
+    """Shared lifecycle, latency and error injection of the fakes."""
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        """
+        Args:
+            latency: Seconds every request is delayed, or a (min, max) range
+            error_rate: Probability of answering a request with HTTP 500
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._fail_next = []
+        self._server = None
+
+    def fail_next(self, count=1, status=500):
+        """Answers the next count requests with the HTTP status."""
+        with self._lock:
+            self._fail_next.extend([status] * count)
+
+    def _delay(self):
+        latency = self.latency
+        if isinstance(latency, tuple):
+            latency = random.uniform(*latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def _injected_error(self):
+        """Returns the HTTP status of an injected failure or None."""
+        with self._lock:
+            if self._fail_next:
+                return self._fail_next.pop(0)
+        if self.error_rate and random.random() < self.error_rate:
+            return 500
+        return None
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body leave in one segment, so keep-alive clients do not wait on delayed ACKs
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, data, headers=None):
+                body = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_empty(self, status, content_type="text/html"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                path = urlparse(self.path).path
+                fake._delay()
+                status = fake._injected_error()
+                if status is not None:
+                    with fake._lock:
+                        fake.calls["injected_errors"] += 1
+                    self.send_json(status, {"ok": False, "error_code": status, "description": "Injected error"})
+                    return
+                fake.handle(self, self.command, path, body)
+
+            do_GET = _handle
+            do_POST = _handle
+
+        return Handler
+
+    def handle(self, request, method, path, body):
+        raise NotImplementedError
+
+    def start(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakePanel(_FakeServer):
+    """A 3x-ui panel with VLESS+Reality inbounds.
+
+    Implements /login, /panel/api/inbounds/list, /panel/api/inbounds/get/{id}
+    and /panel/api/inbounds/addClient. Like 3x-ui, API calls without a valid
+    session cookie get a 404 and duplicate client emails are rejected.
+    """
+
+    def __init__(self, inbounds=1, clients=None, username="", password="", latency=0.0, error_rate=0.0):
+        """
+        Args:
+            inbounds: Number of VLESS+Reality inbounds, with IDs from 1
+            clients: Initial clients of inbound 1, a vision flow client by default
+            username: Login the panel accepts, any login if empty
+            password: Password the panel accepts
+        """
+        super().__init__(latency, error_rate)
+        self.username = username
+        self.password = password
+        # 3x-ui only lists an inbound with xtls-rprx-vision to the bot if its first client has that flow
+        self.inbounds = {
+            inbound_id: {"port": 443 + inbound_id, "up": 0, "down": 0, "clients": [{
+                "id": str(uuid.uuid4()), "flow": "xtls-rprx-vision", "email": f"seed{inbound_id}", "tgId": "",
+            }]}
+            for inbound_id in range(1, inbounds + 1)
+        }
+        if clients is not None:
+            self.inbounds[1]["clients"] = list(clients)
+        self.sessions = set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def clients(self, inbound_id):
+        with self._lock:
+            return list(self.inbounds[inbound_id]["clients"])
+
+    def expire_sessions(self):
+        """Logs every client out, like a panel restart."""
+        with self._lock:
+            self.sessions.clear()
+
+    def _inbound_json(self, inbound_id, inbound):
+        return {
+            "id": inbound_id,
+            "port": inbound["port"],
+            "protocol": "vless",
+            "up": inbound["up"],
+            "down": inbound["down"],
+            "streamSettings": REALITY_STREAM_SETTINGS,
+            "settings": json.dumps({"clients": inbound["clients"]}),
+        }
+
+    def handle(self, request, method, path, body):
+        with self._lock:
+            self.calls[path.rsplit("/", 1)[0] if "/inbounds/get/" in path else path] += 1
+        if path == "/login":
+            form = dict(parse_qsl(body.decode()))
+            if self.username and (form.get("username"), form.get("password")) != (self.username, self.password):
+                request.send_json(200, {"success": False, "msg": "Wrong username or password"})
+                return
+            token = uuid.uuid4().hex
+            with self._lock:
+                self.sessions.add(token)
+            request.send_json(200, {"success": True, "msg": "Login Successfully"}, {"Set-Cookie": f"3x-ui={token}; Path=/"})
+            return
+        cookie = request.headers.get("Cookie", "")
+        token = dict(part.strip().split("=", 1) for part in cookie.split(";") if "=" in part).get("3x-ui")
+        with self._lock:
+            authenticated = token in self.sessions
+        if not authenticated:
+            request.send_empty(404)
+            return
+        if path == "/panel/api/inbounds/list":
+            with self._lock:
+                obj = [self._inbound_json(i, inbound) for i, inbound in self.inbounds.items()]
+            request.send_json(200, {"success": True, "msg": "", "obj": obj})
+        elif path.startswith("/panel/api/inbounds/get/"):
+            inbound_id = int(path.rsplit("/", 1)[1])
+            with self._lock:
+                inbound = self.inbounds.get(inbound_id)
+                obj = self._inbound_json(inbound_id, inbound) if inbound else None
+            if obj is None:
+                request.send_json(200, {"success": False, "msg": "Inbound Not Found"})
+            else:
+                request.send_json(200, {"success": True, "msg": "", "obj": obj})
+        elif path == "/panel/api/inbounds/addClient":
+            payload = json.loads(body)
+            new_clients = json.loads(payload["settings"])["clients"]
+            with self._lock:
+                inbound = self.inbounds.get(payload["id"])
+                if inbound is None:
+                    result = {"success": False, "msg": "Inbound Not Found"}
+                else:
+                    emails = {client["email"] for inbound in self.inbounds.values() for client in inbound["clients"]}
+                    duplicate = next((c["email"] for c in new_clients if c["email"] in emails), None)
+                    if duplicate is not None:
+                        result = {"success": False, "msg": f"Duplicate email: {duplicate}"}
+                    else:
+                        inbound["clients"].extend(new_clients)
+                        result = {"success": True, "msg": "Client(s) added Successfully"}
+            request.send_json(200, result)
+        else:
+            request.send_empty(404)
+
+
+class FakeBotApi(_FakeServer):
+    """A Telegram Bot API serving getUpdates from a queue and recording sent messages.
+
+    Implements getUpdates (long polling), sendMessage, sendPhoto,
+    answerCallbackQuery, deleteWebhook and setWebhook. Photo uploads get a
+    file_id that can be sent again. With chat_rate set, a chat getting more
+    than chat_rate messages per second is answered with 429 and retry_after,
+    like Telegram's flood control.
+    """
+
+    def __init__(self, token="TEST", latency=0.0, error_rate=0.0, chat_rate=None, retry_after=1):
+        super().__init__(latency, error_rate)
+        self.token = token
+        self.chat_rate = chat_rate
+        self.retry_after = retry_after
+        self.sent = []
+        self.sent_by_chat = defaultdict(list)
+        self._updates = []
+        self._next_update_id = 1
+        self._updates_ready = threading.Condition(self._lock)
+        self._chat_times = defaultdict(list)
+        self._file_ids = set()
+        self._rate_limit_next = 0
+
+    @property
+    def url(self):
+        """Base URL including the token, for cfg.TELEGRAM_API_URL."""
+        return f"http://127.0.0.1:{self.port}/bot{self.token}"
+
+    def push_update(self, update):
+        """Queues an update for getUpdates, an update_id is assigned if missing."""
+        with self._updates_ready:
+            if "update_id" not in update:
+                update = dict(update, update_id=self._next_update_id)
+            self._next_update_id = max(self._next_update_id, update["update_id"] + 1)
+            self._updates.append(update)
+            self._updates_ready.notify_all()
+        return update
+
+    def rate_limit_next(self, count=1):
+        """Answers the next count chat messages with 429."""
+        with self._lock:
+            self._rate_limit_next += count
+
+    def wait_for_messages(self, count, timeout=10):
+        """Waits until count messages were sent, returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if len(self.sent) >= count:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    @staticmethod
+    def _parse_body(request, body):
+        content_type = request.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode() + body
+            )
+            params = {}
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename() is not None:
+                    params[name] = part.get_payload(decode=True)
+                else:
+                    params[name] = part.get_payload(decode=True).decode()
+            return params
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        return dict(parse_qsl(body.decode()))
+
+    def _flood_wait(self, chat_id):
+        """Returns True if the message to the chat is rate limited."""
+        now = time.monotonic()
+        with self._lock:
+            if self._rate_limit_next > 0:
+                self._rate_limit_next -= 1
+                return True
+            if self.chat_rate is None or chat_id is None:
+                return False
+            times = [t for t in self._chat_times[chat_id] if now - t < 1]
+            if len(times) >= self.chat_rate:
+                self._chat_times[chat_id] = times
+                return True
+            times.append(now)
+            self._chat_times[chat_id] = times
+            return False
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), 1.0)
+        deadline = time.monotonic() + timeout
+        with self._updates_ready:
+            # Confirmed updates are dropped, like Telegram does
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._updates_ready.wait(remaining)
+            return list(self._updates[:100])
+
+    def handle(self, request, method, path, body):
+        prefix = f"/bot{self.token}/"
+        if not path.startswith(prefix):
+            request.send_json(404, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+        api_method = path[len(prefix):]
+        params = self._parse_body(request, body)
+        with self._lock:
+            self.calls[api_method] += 1
+        if api_method == "getUpdates":
+            request.send_json(200, {"ok": True, "result": self._get_updates(params)})
+            return
+        if api_method in ("deleteWebhook", "setWebhook", "answerCallbackQuery"):
+            with self._lock:
+                self.sent.append((api_method, params))
+            request.send_json(200, {"ok": True, "result": True})
+            return
+        if api_method not in ("sendMessage", "sendPhoto"):
+            request.send_json(404, {"ok": False, "error_code": 404, "description": "Method not found"})
+            return
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if self._flood_wait(chat_id):
+            with self._lock:
+                self.calls["rate_limited"] += 1
+            request.send_json(429, {
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+            return
+        result = {"message_id": random.randint(1, 2 ** 31), "chat": {"id": chat_id}, "date": int(time.time())}
+        if api_method == "sendPhoto":
+            photo = params.get("photo")
+            if isinstance(photo, str):
+                with self._lock:
+                    known = photo in self._file_ids
+                if not known:
+                    request.send_json(400, {"ok": False, "error_code": 400, "description": "Bad Request: wrong file identifier"})
+                    return
+                file_id = photo
+            else:
+                file_id = f"fake-{uuid.uuid4().hex}"
+                with self._lock:
+                    self._file_ids.add(file_id)
+            result["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 410, "height": 410, "file_size": len(body)}]
+            result["caption"] = params.get("caption")
+        else:
+            result["text"] = params.get("text")
+        with self._lock:
+            self.sent.append((api_method, params))
+            self.sent_by_chat[chat_id].append((api_method, params))
+        request.send_json(200, {"ok": True, "result": result})
+
+
+def message_update(chat_id, text, username=None):
+    """Returns a text message update from the user."""
+    user = {"id": chat_id, "is_bot": False, "first_name": "Test", "username": username or f"user{chat_id}"}
+    return {"update_id": next(_update_ids), "message": {
+        "message_id": random.randint(1, 2 ** 31), "from": user,
+        "chat": {"id": chat_id, "type": "private"}, "date": int(time.time()), "text": text,
+    }}
+
+
+def callback_update(chat_id, data, username=None):
+    """Returns an inline keyboard button press update of the user."""
+    user = {"id": chat_id, "is_bot": False, "first_name": "Test", "username": username or f"user{chat_id}"}
+    return {"update_id": next(_update_ids), "callback_query": {
+        "id": uuid.uuid4().hex, "from": user, "data": data,
+        "message": {"message_id": 1, "chat": {"id": chat_id, "type": "private"}, "date": int(time.time())},
+    }}
@@ -0,0 +1,63 @@
+import threading
+import time
+import storage
+
+
+class FileIdCache:
+    """Telegram file_id of already uploaded photos, persisted in SQLite.
+
+    Keys are the content the photo was rendered from, e.g. a vless link, so a
+    repeated delivery of the same config can reuse the uploaded photo.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS photo_file_ids ("
+            "key TEXT PRIMARY KEY, file_id TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._memory = dict(self._db.execute("SELECT key, file_id FROM photo_file_ids"))
+
+    def get(self, key):
+        """Returns the cached file_id for key or None."""
+        return self._memory.get(key)
+
+    def put(self, key, file_id):
+        """Stores the file_id Telegram returned for key."""
+        with self._lock:
+            self._memory[key] = file_id
+        self._db.execute(
+            "INSERT OR REPLACE INTO photo_file_ids (key, file_id, updated_at) VALUES (?, ?, ?)",
+            (key, file_id, time.time()),
+        )
+
+    def discard(self, key):
+        """Forgets a file_id Telegram no longer accepts."""
+        with self._lock:
+            self._memory.pop(key, None)
+        self._db.execute("DELETE FROM photo_file_ids WHERE key = ?", (key,))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the shared FileIdCache, loading it from the database on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = FileIdCache(storage.get_database())
+    return _cache
+
+
+def photo_file_id(response):
+    """Extracts the file_id of the largest photo size from a sendPhoto response."""
+    if not response or not response.get("ok"):
+        return None
+    sizes = response.get("result", {}).get("photo") or []
+    if not sizes:
+        return None
+    return sizes[-1].get("file_id")
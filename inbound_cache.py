@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+from collections import namedtuple
+import config as cfg
+
+logger = logging.getLogger(__name__)
+
+# Parameters of a VLESS+Reality+xtls-rprx-vision inbound needed to build a client link,
+# with its number of clients and up/down traffic in bytes for placement
+RealityInbound = namedtuple(
+    "RealityInbound", ["id", "port", "public_key", "short_id", "sni", "clients", "up", "down"]
+)
+
+
+class InboundCache:
+    """Per-server cache of resolved Reality inbounds.
+
+    Entries live for cfg.INBOUND_CACHE_TTL seconds. Once an entry is older than
+    cfg.INBOUND_REFRESH_AHEAD of its TTL, ``get`` still returns it and schedules
+    a background refresh, so the hot path only waits for the panel on a cold
+    or invalidated entry.
+    """
+
+    def __init__(self, refresh):
+        """
+        Args:
+            refresh: Callable taking a ServerTarget that reloads the inbounds of
+                the server and stores them with ``put``
+        """
+        self._refresh = refresh
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._refreshing = set()
+
+    def get(self, server):
+        """Returns the cached list of RealityInbound for the server or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(server)
+            if entry is None:
+                return None
+            inbounds, loaded_at = entry
+            age = time.monotonic() - loaded_at
+            if age >= cfg.INBOUND_CACHE_TTL:
+                del self._entries[server]
+                return None
+            start_refresh = (
+                age >= cfg.INBOUND_CACHE_TTL * cfg.INBOUND_REFRESH_AHEAD
+                and server not in self._refreshing
+            )
+            if start_refresh:
+                self._refreshing.add(server)
+        if start_refresh:
+            threading.Thread(
+                target=self._background_refresh, args=(server,), daemon=True,
+                name=f"inbound-refresh-{server.country}",
+            ).start()
+        return inbounds
+
+    def put(self, server, inbounds):
+        """Stores freshly loaded inbounds of the server."""
+        with self._lock:
+            self._entries[server] = (inbounds, time.monotonic())
+
+    def invalidate(self, server):
+        """Drops the cached inbounds of the server, the next request reloads them."""
+        logger.info("Invalidating cached inbounds of server %s", server.country)
+        with self._lock:
+            self._entries.pop(server, None)
+
+    def _background_refresh(self, server):
+        try:
+            self._refresh(server)
+        except Exception as e:
+            logger.error("Error when refreshing inbounds of server %s: %s", server.country, e)
+        finally:
+            with self._lock:
+                self._refreshing.discard(server)
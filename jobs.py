@@ -0,0 +1,282 @@
+"""Durable provisioning jobs of bot users.
+
+A job runs through named stages, e.g. login, resolve_inbound, add_client,
+render and deliver for a new account (see vpn.PROVISIONING_STAGES). The
+stage and the context a stage handler builds up are saved in the
+provisioning_jobs table of data/bot.db after every completed stage, so a job
+interrupted by a crash resumes at the stage it was in. A stage failing with a
+transient error, a requests exception or RetryableError, is retried with
+exponential backoff up to cfg.JOB_MAX_ATTEMPTS times; JobFailed ends the job
+with a message for the user.
+
+Jobs are claimed for cfg.JOB_CLAIM_TTL seconds, so replicas sharing the
+database (see cluster.py) work on the same queue and the jobs of a stopped
+replica are taken over once its claims expire.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+import requests
+import config as cfg
+import storage
+from cluster import replica_id
+from metrics import inc
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobFailed(Exception):
+    """A stage failed for good, the message is sent to the user."""
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class RetryableError(Exception):
+    """A stage failed in a way that may succeed on a later attempt."""
+
+
+class Job:
+    """A claimed job: its stage, the stage's attempt count and the context of the handlers."""
+
+    __slots__ = ("id", "chat_id", "stage", "context", "attempts", "_queue")
+
+    def __init__(self, queue, job_id, chat_id, stage, context, attempts):
+        self._queue = queue
+        self.id = job_id
+        self.chat_id = chat_id
+        self.stage = stage
+        self.context = context
+        self.attempts = attempts
+
+    def checkpoint(self):
+        """Saves the context before a step that must not be repeated with different data."""
+        self._queue.save(self)
+
+
+class JobQueue:
+    """Provisioning jobs in the shared database."""
+
+    def __init__(self, db, owner):
+        self._db = db
+        self.owner = owner
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS provisioning_jobs ("
+            "id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, stage TEXT, context TEXT NOT NULL, "
+            "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, run_at REAL NOT NULL, "
+            "claimed_by TEXT, claimed_until REAL NOT NULL DEFAULT 0, error TEXT, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS provisioning_jobs_run_at ON provisioning_jobs (status, run_at)"
+        )
+        self._ready = threading.Condition()
+
+    def submit(self, chat_id, stage, context, job_id=None):
+        """Queues a job starting at the stage.
+
+        Returns:
+            bool: False if a job with the ID was queued before
+        """
+        now = time.time()
+        with self._db.transaction() as conn:
+            # Finished jobs are only kept as long as the update log
+            conn.execute(
+                "DELETE FROM provisioning_jobs WHERE status != ? AND updated_at < ?",
+                (PENDING, now - cfg.UPDATE_LOG_RETENTION),
+            )
+            added = conn.execute(
+                "INSERT OR IGNORE INTO provisioning_jobs "
+                "(id, chat_id, stage, context, status, run_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id or uuid.uuid4().hex, chat_id, stage, json.dumps(context), PENDING, now, now, now),
+            ).rowcount
+        if added:
+            with self._ready:
+                self._ready.notify()
+        return bool(added)
+
+    def claim(self):
+        """Claims the next due job for this process, returns the Job or None."""
+        now = time.time()
+        with self._db.transaction() as conn:
+            row = conn.execute(
+                "SELECT id, chat_id, stage, context, attempts FROM provisioning_jobs "
+                "WHERE status = ? AND run_at <= ? AND claimed_until <= ? ORDER BY run_at LIMIT 1",
+                (PENDING, now, now),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE provisioning_jobs SET claimed_by = ?, claimed_until = ? WHERE id = ?",
+                (self.owner, now + cfg.JOB_CLAIM_TTL, row[0]),
+            )
+        return Job(self, row[0], row[1], row[2], json.loads(row[3]), row[4])
+
+    def wait(self, timeout):
+        """Waits until a job is submitted in this process or the timeout passes."""
+        with self._ready:
+            self._ready.wait(timeout)
+
+    def wake_all(self):
+        """Wakes every waiting worker, e.g. to stop them."""
+        with self._ready:
+            self._ready.notify_all()
+
+    def save(self, job):
+        """Saves the context of the job and extends its claim."""
+        now = time.time()
+        self._db.execute(
+            "UPDATE provisioning_jobs SET context = ?, claimed_until = ?, updated_at = ? WHERE id = ? AND claimed_by = ?",
+            (json.dumps(job.context), now + cfg.JOB_CLAIM_TTL, now, job.id, self.owner),
+        )
+
+    def advance(self, job, stage):
+        """Records a completed stage, a stage of None finishes the job."""
+        now = time.time()
+        job.stage = stage
+        job.attempts = 0
+        self._db.execute(
+            "UPDATE provisioning_jobs SET stage = ?, context = ?, status = ?, attempts = 0, claimed_until = ?, "
+            "updated_at = ? WHERE id = ?",
+            (stage, json.dumps(job.context), PENDING if stage is not None else DONE,
+             now + cfg.JOB_CLAIM_TTL if stage is not None else 0, now, job.id),
+        )
+
+    def retry(self, job, delay, error):
+        """Releases the job to run its current stage again after delay seconds."""
+        now = time.time()
+        self._db.execute(
+            "UPDATE provisioning_jobs SET context = ?, attempts = attempts + 1, run_at = ?, claimed_by = NULL, "
+            "claimed_until = 0, error = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(job.context), now + delay, error, now, job.id),
+        )
+
+    def fail(self, job, error):
+        """Ends the job without completing its stages."""
+        self._db.execute(
+            "UPDATE provisioning_jobs SET status = ?, claimed_until = 0, error = ?, updated_at = ? WHERE id = ?",
+            (FAILED, error, time.time(), job.id),
+        )
+
+    def release_all(self):
+        """Releases every claim, for a process that knows no other process works on the queue."""
+        self._db.execute("UPDATE provisioning_jobs SET claimed_by = NULL, claimed_until = 0 WHERE status = ?", (PENDING,))
+
+    def pending(self):
+        """Number of jobs that have not finished yet."""
+        return self._db.execute("SELECT COUNT(*) FROM provisioning_jobs WHERE status = ?", (PENDING,))[0][0]
+
+
+def retry_delay(attempts):
+    """Returns the backoff before the next attempt of a stage, with jitter."""
+    delay = min(cfg.JOB_RETRY_MAX_DELAY, cfg.JOB_RETRY_BASE_DELAY * 2 ** attempts)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class JobRunner:
+    """Worker threads running the stages of queued jobs.
+
+    ``stages`` maps a stage name to ``handler(job)``, which returns the next
+    stage or None when the job is complete. ``failed(job, message)`` is called
+    when a job ends without completing, message is the JobFailed message or
+    None after the attempts ran out or an unexpected error.
+    """
+
+    def __init__(self, queue, stages, failed, workers=None):
+        self._queue = queue
+        self._stages = stages
+        self._failed = failed
+        self._workers = workers or cfg.JOB_WORKERS
+        self._threads = []
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts the worker threads."""
+        if self._threads:
+            return
+        for number in range(self._workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stops the workers after their current stage, unfinished jobs resume on the next start."""
+        self._stop.set()
+        self._queue.wake_all()
+
+    def drain(self, timeout=None):
+        """Waits until no job is pending, returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.pending():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                job = self._queue.claim()
+            except Exception:
+                logger.exception("Error when claiming a job")
+                job = None
+            if job is None:
+                self._queue.wait(cfg.JOB_POLL_INTERVAL)
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        """Runs the stages of a claimed job until it completes, fails or waits for a retry."""
+        while job.stage is not None and not self._stop.is_set():
+            handler = self._stages[job.stage]
+            try:
+                next_stage = handler(job)
+            except JobFailed as e:
+                logger.warning("Job %s failed in stage %s: %s", job.id, job.stage, e.message)
+                self._fail(job, e.message, e.message)
+                return
+            except (requests.exceptions.RequestException, RetryableError) as e:
+                inc("job_retries", stage=job.stage)
+                if job.attempts + 1 >= cfg.JOB_MAX_ATTEMPTS:
+                    logger.error("Job %s gave up in stage %s after %d attempts: %s", job.id, job.stage, job.attempts + 1, e)
+                    self._fail(job, None, str(e))
+                    return
+                delay = retry_delay(job.attempts)
+                logger.warning("Job %s stage %s failed, retrying in %.1fs: %s", job.id, job.stage, delay, e)
+                self._queue.retry(job, delay, str(e))
+                return
+            except Exception as e:
+                logger.exception("Unexpected error in job %s stage %s", job.id, job.stage)
+                self._fail(job, None, str(e))
+                return
+            self._queue.advance(job, next_stage)
+
+    def _fail(self, job, message, error):
+        inc("job_failures", stage=job.stage)
+        self._queue.fail(job, error)
+        try:
+            self._failed(job, message)
+        except Exception:
+            logger.exception("Error when reporting failed job %s", job.id)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Returns the shared JobQueue, creating its table on first use."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue(storage.get_database(), replica_id())
+    return _queue
@@ -1,4 +1,10 @@
+import functools
 import logging
+import os
+import secrets
+import signal
+import sys
+import threading
 import time
 import json
 from urllib.parse import urlparse
@@ -6,6 +12,24 @@ import argparse
 import config as cfg
 import message_handler as handler
 import requests
+import bot_api
+import cluster
+import core
+import jobs
+import panel
+import vpn
+from dispatcher import Dispatcher
+import webhook
+import qr
+import state
+import storage
+import subscriptions
+import updates_log
+import ratelimit
+from metrics import inc, metrics, span
+from registry import registry
+from router import CHEAP, SLOW
+from servers import all_servers
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)s: %(message)s",
@@ -24,11 +48,19 @@ def load_config_from_secrets():
         config = json.loads(f.read().strip())
         cfg.SERVERS = config["servers"]
         cfg.DEFAULT_COUNTRY = config["default"]
-        cfg.API_URL = cfg.SERVERS[cfg.DEFAULT_COUNTRY]
     with open("/run/secrets/API_USERNAME", encoding="utf-8") as f:
         cfg.API_USERNAME = f.read().strip()
     with open("/run/secrets/API_PASSWORD", encoding="utf-8") as f:
         cfg.API_PASSWORD = f.read().strip()
+    # Admins are optional
+    if os.path.exists("/run/secrets/ADMIN_IDS"):
+        with open("/run/secrets/ADMIN_IDS", encoding="utf-8") as f:
+            cfg.ADMIN_IDS = parse_admin_ids(f.read())
+
+
+def parse_admin_ids(value):
+    """Parses a comma separated list of Telegram chat IDs"""
+    return {int(part) for part in value.split(",") if part.strip()}
 
 
 def load_config_from_args(args):
@@ -37,26 +69,29 @@ def load_config_from_args(args):
     config = json.loads(args.servers)
     cfg.SERVERS = config["servers"]
     cfg.DEFAULT_COUNTRY = config["default"]
-    cfg.API_URL = cfg.SERVERS[cfg.DEFAULT_COUNTRY]
     cfg.API_USERNAME = args.username
     cfg.API_PASSWORD = args.password
+    if getattr(args, "admins", None):
+        cfg.ADMIN_IDS = parse_admin_ids(args.admins)
 
 
-def get_updates() -> dict:
-    """Gets updates from Telegram API.
+def get_updates(timeout=100) -> dict:
+    """Gets updates from Telegram API, long-polling for up to timeout seconds.
     Returns a dictionary with updates or empty result on error.
     """
     logger.debug("Getting updates with offset=%s", cfg.LAST_UPDATE_ID)
-    params = {"timeout": 100, "offset": cfg.LAST_UPDATE_ID}
+    params = {"timeout": timeout, "offset": cfg.LAST_UPDATE_ID}
     try:
-        response = requests.get(f"{cfg.TELEGRAM_API_URL}/getUpdates", params=params)
-        if response.status_code == 409:
-            logger.warning("Conflict with previous bot instance detected. Resetting LAST_UPDATE_ID")
-            cfg.LAST_UPDATE_ID = None
-            return {"result": []}
-        response.raise_for_status()
-        logger.debug("Received updates: %s", response.json())
-        return response.json()
+        result = bot_api.get_client().call("getUpdates", data=params, limited=False, timeout=timeout + 10)
+        logger.debug("Received updates: %s", result)
+        return result
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 409:
+            # Keep the persisted offset, redelivered updates are skipped by the update log
+            logger.warning("Conflict with previous bot instance detected")
+        else:
+            logger.error("Error when getting updates: %s", e)
+        return {"result": []}
     except requests.exceptions.RequestException as e:
         logger.error("Error when getting updates: %s", e)
         return {"result": []}
@@ -65,30 +100,315 @@ def get_updates() -> dict:
 def delete_webhook():
     """Deletes webhook before starting the bot"""
     try:
-        response = requests.post(f"{cfg.TELEGRAM_API_URL}/deleteWebhook")
-        response.raise_for_status()
+        bot_api.get_client().call("deleteWebhook", limited=False)
         logger.info("Webhook successfully deleted")
     except requests.exceptions.RequestException as e:
         logger.error("Error when deleting webhook: %s", e)
 
 
-def main():
-    logger.debug("-" * 50)
-    logger.info("Bot started and ready to work")
+def handle_update(update):
+    """Routes a single update to the matching handler."""
+    logger.debug("Processing update: %s", update)
+    if "message" in update:
+        message = update["message"]
+        if "contact" in message or "text" in message:
+            handler.process_message(message)
+    elif "callback_query" in update:
+        handler.handle_callback_query(update["callback_query"])
+
+
+def process_update(update):
+    """Handles an accepted update and marks it done in the update log."""
+    inc("updates")
+    try:
+        with span("update"):
+            handle_update(update)
+    except Exception:
+        inc("errors", kind="handler")
+        raise
+    finally:
+        # A failing update is not retried on every restart
+        updates_log.get_update_log().mark_done(update["update_id"])
+
+
+def process_queued_update(queue, update):
+    """Handles an update claimed from the shared work queue and removes it from the queue."""
+    try:
+        process_update(update)
+    finally:
+        queue.complete(update["update_id"])
+
+
+def accept_update(dispatcher, update, timeout=None):
+    """Records an update and hands it to the dispatcher, skipping updates that were seen before.
+
+    Returns:
+        bool: False if the dispatcher did not accept the update in time
+    """
+    update_log = updates_log.get_update_log()
+    if not update_log.record(update):
+        logger.info("Skipping already processed update %s", update["update_id"])
+        return True
+    # Stop the button spinner right away, even if the update waits behind slow work
+    if "callback_query" in update:
+        core.answer_callback_query_async(update["callback_query"]["id"])
+    if not dispatcher.submit(update, timeout=timeout):
+        update_log.forget(update["update_id"])
+        return False
+    return True
+
+
+def resume_unfinished_updates(dispatcher):
+    """Dispatches updates that were accepted but not finished before the last shutdown."""
+    unfinished = updates_log.get_update_log().unfinished()
+    if unfinished:
+        logger.info("Resuming %d unfinished updates", len(unfinished))
+    for update in unfinished:
+        dispatcher.submit(update)
+
+
+def set_webhook(url, secret):
+    """Registers the webhook URL and its secret token with Telegram"""
+    try:
+        bot_api.get_client().call("setWebhook", data={"url": url, "secret_token": secret}, limited=False)
+        logger.info("Webhook successfully set")
+    except requests.exceptions.RequestException as e:
+        logger.error("Error when setting webhook: %s", e)
+
+
+def poll_updates(dispatcher):
+    """Long-polls getUpdates and feeds the updates to the dispatcher."""
     delete_webhook()  # Delete webhook before starting
+    update_log = updates_log.get_update_log()
+    cfg.LAST_UPDATE_ID = update_log.load_offset()
     while True:
         updates = get_updates()
         if "result" in updates and updates["result"]:
             for update in updates["result"]:
-                logger.debug("Processing update: %s", update)
+                # Blocks while the pool is full, the offset only moves past accepted updates
+                accept_update(dispatcher, update)
                 cfg.LAST_UPDATE_ID = update["update_id"] + 1
-                if "message" in update:
-                    message = update["message"]
-                    if "contact" in message or "text" in message:
-                        handler.process_message(message)
-                elif "callback_query" in update:
-                    handler.handle_callback_query(update["callback_query"])
-        time.sleep(1)
+                update_log.save_offset(cfg.LAST_UPDATE_ID)
+        else:
+            # Only back off after an empty or failed poll, new updates are fetched right away
+            time.sleep(1)
+
+
+def lead_polling(lease, queue, stop):
+    """Long-polls getUpdates while this replica holds the polling lease.
+
+    Accepted updates go to the shared work queue instead of the local
+    dispatcher, so every replica works on them. The poll timeout stays below
+    the lease TTL, so the lease is renewed between polls; a replica that does
+    not hold it retries after a third of the TTL and takes over once the
+    leader stops renewing it.
+    """
+    update_log = updates_log.get_update_log()
+    leading = False
+    while not stop.is_set():
+        try:
+            if not lease.acquire():
+                if leading:
+                    logger.warning("Replica %s lost the polling lease", lease.owner)
+                    leading = False
+                stop.wait(cfg.CLUSTER_LEASE_TTL / 3)
+                continue
+            if not leading:
+                leading = True
+                logger.info("Replica %s is polling updates", lease.owner)
+                delete_webhook()
+                cfg.LAST_UPDATE_ID = update_log.load_offset()
+                # Updates the previous leader recorded but may not have queued
+                queue.push(update_log.unfinished())
+            updates = get_updates(cfg.CLUSTER_POLL_TIMEOUT)
+            if not updates.get("result"):
+                stop.wait(1)
+                continue
+            accepted = []
+            for update in updates["result"]:
+                if not update_log.record(update):
+                    logger.info("Skipping already processed update %s", update["update_id"])
+                    continue
+                if "callback_query" in update:
+                    core.answer_callback_query_async(update["callback_query"]["id"])
+                accepted.append(update)
+            queue.push(accepted)
+            cfg.LAST_UPDATE_ID = updates["result"][-1]["update_id"] + 1
+            update_log.save_offset(cfg.LAST_UPDATE_ID)
+        except Exception as e:
+            logger.exception("Error when polling updates: %s", e)
+            if leading:
+                leading = False
+                # Another replica takes over right away instead of after the lease expires,
+                # and a new term reloads the offset and requeues the recorded updates
+                try:
+                    lease.release()
+                except Exception as release_error:
+                    logger.error("Error when releasing the polling lease: %s", release_error)
+            stop.wait(cfg.CLUSTER_LEASE_TTL / 3)
+    if leading:
+        lease.release()
+
+
+def keep_claims(queue, stop):
+    """Renews the claims of this replica on queued updates until stopped."""
+    while not stop.wait(cfg.CLUSTER_CLAIM_TTL / 3):
+        try:
+            queue.renew()
+        except Exception as e:
+            logger.error("Error when renewing claimed updates: %s", e)
+
+
+def work_cluster_queue(dispatcher, queue):
+    """Claims updates from the shared work queue as the dispatcher has room for them."""
+    capacity = cfg.MAX_PENDING_UPDATES + cfg.MAX_PENDING_SLOW_UPDATES
+    while True:
+        claimed = queue.claim(capacity - dispatcher.pending)
+        submitted = 0
+        try:
+            for update in claimed:
+                # One cost class may be full while the other has room
+                if not dispatcher.submit(update, timeout=cfg.CLUSTER_CLAIM_INTERVAL):
+                    break
+                submitted += 1
+        finally:
+            queue.release([update["update_id"] for update in claimed[submitted:]])
+        if submitted < len(claimed) or not claimed:
+            time.sleep(cfg.CLUSTER_CLAIM_INTERVAL)
+
+
+def run_cluster(dispatcher, lease, queue):
+    """Works as one replica: polls while holding the lease and handles updates of the shared queue."""
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=lead_polling, args=(lease, queue, stop), name="cluster-leader", daemon=True),
+        threading.Thread(target=keep_claims, args=(queue, stop), name="cluster-claims", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info("Running as replica %s", lease.owner)
+    try:
+        work_cluster_queue(dispatcher, queue)
+    finally:
+        stop.set()
+
+
+def serve_webhook(dispatcher):
+    """Serves Telegram webhook POSTs and feeds the updates to the dispatcher."""
+    if cfg.WEBHOOK_URL:
+        set_webhook(cfg.WEBHOOK_URL, cfg.WEBHOOK_SECRET)
+    server = webhook.create_server(
+        lambda update, timeout: accept_update(dispatcher, update, timeout),
+        cfg.WEBHOOK_HOST,
+        cfg.WEBHOOK_PORT,
+    )
+    logger.info("Listening for webhook updates on %s:%s%s", cfg.WEBHOOK_HOST, cfg.WEBHOOK_PORT, cfg.WEBHOOK_PATH)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def start_metrics():
+    """Registers the state size and panel session gauges and serves /metrics if it is enabled."""
+    metrics.gauge("state_entries", lambda: len(state.store))
+    metrics.gauge("rate_limit_keys", lambda: len(ratelimit.limiter))
+    metrics.gauge("telegram_waiting_calls", lambda: bot_api.get_client().metrics()["waiting"])
+    metrics.gauge("pending_jobs", lambda: jobs.get_queue().pending())
+    for server in all_servers():
+        for event in ("logins", "reuses", "relogins", "failures"):
+            metrics.gauge(
+                "panel_session_events",
+                lambda server=server, event=event: panel.session_stats().get(server, {}).get(event, 0),
+                country=server.country, panel=server.domain, event=event,
+            )
+    if cfg.METRICS_ENABLED:
+        return metrics.serve(cfg.METRICS_HOST, cfg.METRICS_PORT)
+    return None
+
+
+def start_subscriptions():
+    """Serves subscription requests from a daemon thread if the endpoint is enabled."""
+    if not cfg.SUBSCRIPTION_ENABLED:
+        return None
+    server = subscriptions.create_server(cfg.SUBSCRIPTION_HOST, cfg.SUBSCRIPTION_PORT)
+    threading.Thread(target=server.serve_forever, name="subscriptions", daemon=True).start()
+    logger.info(
+        "Serving subscriptions on %s:%s%s/<subId>", cfg.SUBSCRIPTION_HOST, cfg.SUBSCRIPTION_PORT, cfg.SUBSCRIPTION_PATH
+    )
+    return server
+
+
+def start_jobs():
+    """Starts the workers of provisioning jobs, resuming jobs left unfinished by the last run."""
+    queue = jobs.get_queue()
+    if not cfg.CLUSTER_ENABLED:
+        # No other process works on the queue, claims are left over from a crash
+        queue.release_all()
+    runner = jobs.JobRunner(queue, vpn.PROVISIONING_STAGES, vpn.provisioning_failed, cfg.JOB_WORKERS)
+    runner.start()
+    return runner
+
+
+def main():
+    logger.debug("-" * 50)
+    logger.info("Bot started and ready to work")
+    metrics_server = start_metrics()
+    subscription_server = start_subscriptions()
+    registry.start()
+    job_runner = start_jobs()
+    if cfg.ASYNC_ENABLED:
+        # Imported lazily, aiohttp is only needed in asyncio mode
+        import asyncio
+        import async_main
+        try:
+            asyncio.run(async_main.run(handle_update))
+        except (KeyboardInterrupt, SystemExit):
+            logger.info("Bot stopped")
+        finally:
+            job_runner.stop()
+            registry.stop()
+            qr.get_renderer().shutdown()
+            for server in (metrics_server, subscription_server):
+                if server is not None:
+                    server.shutdown()
+        return
+    queue = lease = None
+    update_handler = process_update
+    if cfg.CLUSTER_ENABLED:
+        owner = cluster.replica_id()
+        lease = cluster.Lease(storage.get_database(), "getUpdates", owner)
+        queue = cluster.WorkQueue(storage.get_database(), owner)
+        update_handler = functools.partial(process_queued_update, queue)
+        metrics.gauge("cluster_queue_length", lambda: len(queue))
+    dispatcher = Dispatcher(
+        update_handler, cfg.WORKER_COUNT, cfg.MAX_PENDING_UPDATES,
+        classify=handler.update_cost,
+        slow_workers=cfg.SLOW_WORKER_COUNT,
+        max_pending_slow=cfg.MAX_PENDING_SLOW_UPDATES,
+    )
+    for cost in (CHEAP, SLOW):
+        metrics.gauge("pending_updates", lambda cost=cost: dispatcher.pending_of(cost), cost=cost)
+    try:
+        if cfg.CLUSTER_ENABLED:
+            # The leader queues unfinished updates for all replicas
+            run_cluster(dispatcher, lease, queue)
+        elif cfg.WEBHOOK_ENABLED:
+            resume_unfinished_updates(dispatcher)
+            serve_webhook(dispatcher)
+        else:
+            resume_unfinished_updates(dispatcher)
+            poll_updates(dispatcher)
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Stopping bot, waiting for %d pending updates", dispatcher.pending)
+    finally:
+        dispatcher.shutdown()
+        job_runner.stop()
+        registry.stop()
+        qr.get_renderer().shutdown()
+        for server in (metrics_server, subscription_server):
+            if server is not None:
+                server.shutdown()
 
 
 if __name__ == "__main__":
@@ -98,8 +418,71 @@ if __name__ == "__main__":
     parser.add_argument('--servers', help='JSON string with server configuration. Example: {"servers":{"nl":"https://server1.com","fr":"https://server2.com"},"default":"nl"}')
     parser.add_argument('--username', help='API Username')
     parser.add_argument('--password', help='API Password')
+    parser.add_argument('--admins', help='Comma separated Telegram chat IDs allowed to use admin commands')
+    parser.add_argument('--workers', type=int, default=cfg.WORKER_COUNT, help='Number of concurrent update workers')
+    parser.add_argument('--max-pending', type=int, default=cfg.MAX_PENDING_UPDATES, help='Maximum number of queued updates before polling pauses')
+    parser.add_argument('--slow-workers', type=int, default=cfg.SLOW_WORKER_COUNT, help='Number of workers for account creation and client selection')
+    parser.add_argument('--max-pending-slow', type=int, default=cfg.MAX_PENDING_SLOW_UPDATES, help='Maximum number of queued slow updates before polling pauses')
+    parser.add_argument('--job-workers', type=int, default=cfg.JOB_WORKERS, help='Number of threads running provisioning jobs')
+    parser.add_argument('--qr-processes', type=int, default=cfg.QR_PROCESSES, help='Number of processes rendering QR codes, 0 renders in the worker threads')
+    parser.add_argument('--placement-policy', choices=['least_clients', 'weighted', 'consistent_hash'], default=cfg.PLACEMENT_POLICY, help='How new clients are spread over the inbounds and panels of a country')
+    parser.add_argument('--state-backend', choices=['memory', 'sqlite'], default=cfg.STATE_BACKEND, help='Where pending client selections are kept')
+    parser.add_argument('--rate-limit-backend', choices=['memory', 'sqlite'], default=cfg.RATE_LIMIT_BACKEND, help='Where rate limit state is kept')
+    parser.add_argument('--cluster', action='store_true', help='Run as one of several replicas sharing the database, implies the sqlite state and rate limit backends')
+    parser.add_argument('--async', dest='async_mode', action='store_true', help='Handle updates on an asyncio event loop, only long polling is supported')
+    parser.add_argument('--async-concurrency', type=int, default=cfg.ASYNC_CONCURRENCY, help='Maximum number of updates handled at once in asyncio mode')
+    parser.add_argument('--webhook', action='store_true', help='Receive updates through a webhook instead of getUpdates long polling')
+    parser.add_argument('--webhook-url', help='Public HTTPS URL registered with Telegram, omit to only listen locally')
+    parser.add_argument('--webhook-host', default=cfg.WEBHOOK_HOST, help='Address the webhook server listens on')
+    parser.add_argument('--webhook-port', type=int, default=cfg.WEBHOOK_PORT, help='Port the webhook server listens on')
+    parser.add_argument('--metrics', action='store_true', help='Serve Prometheus metrics on /metrics')
+    parser.add_argument('--metrics-host', default=cfg.METRICS_HOST, help='Address the metrics server listens on')
+    parser.add_argument('--metrics-port', type=int, default=cfg.METRICS_PORT, help='Port the metrics server listens on')
+    parser.add_argument('--subscriptions', action='store_true', help='Serve subscription links of users on GET /sub/<subId>')
+    parser.add_argument('--subscription-port', type=int, default=cfg.SUBSCRIPTION_PORT, help='Port the subscription server listens on')
+    parser.add_argument('--subscription-url', help='Public base URL of the subscription endpoint sent to users, e.g. https://sub.example.com/sub')
+    parser.add_argument('--webhook-secret', help='Secret token expected in the X-Telegram-Bot-Api-Secret-Token header, generated if omitted with --webhook-url')
 
     args = parser.parse_args()
+    if args.async_mode and args.webhook:
+        parser.error("--async only supports long polling, drop --webhook")
+    if args.cluster and (args.async_mode or args.webhook):
+        parser.error("--cluster only supports long polling with worker threads, drop --async and --webhook")
+    if args.webhook and not args.webhook_url and not args.webhook_secret:
+        # A generated secret would only be known to this process, so every POST would be rejected
+        parser.error("--webhook without --webhook-url needs --webhook-secret")
+    cfg.WORKER_COUNT = args.workers
+    cfg.MAX_PENDING_UPDATES = args.max_pending
+    cfg.SLOW_WORKER_COUNT = args.slow_workers
+    cfg.MAX_PENDING_SLOW_UPDATES = args.max_pending_slow
+    cfg.JOB_WORKERS = args.job_workers
+    cfg.QR_PROCESSES = args.qr_processes
+    cfg.STATE_BACKEND = args.state_backend
+    cfg.RATE_LIMIT_BACKEND = args.rate_limit_backend
+    cfg.CLUSTER_ENABLED = args.cluster
+    if cfg.CLUSTER_ENABLED:
+        # Replicas share conversation state and rate limits through cfg.DB_PATH
+        cfg.STATE_BACKEND = cfg.RATE_LIMIT_BACKEND = "sqlite"
+    cfg.PLACEMENT_POLICY = args.placement_policy
+    cfg.ASYNC_ENABLED = args.async_mode
+    cfg.ASYNC_CONCURRENCY = args.async_concurrency
+    cfg.WEBHOOK_ENABLED = args.webhook
+    cfg.WEBHOOK_URL = args.webhook_url
+    cfg.WEBHOOK_HOST = args.webhook_host
+    cfg.WEBHOOK_PORT = args.webhook_port
+    cfg.WEBHOOK_SECRET = args.webhook_secret
+    if args.webhook and not cfg.WEBHOOK_SECRET:
+        # Registered with Telegram by setWebhook, which then sends it with every update
+        cfg.WEBHOOK_SECRET = secrets.token_urlsafe(32)
+        logger.info("Using a generated webhook secret, pass --webhook-secret to set it")
+    cfg.METRICS_ENABLED = args.metrics
+    cfg.SUBSCRIPTION_ENABLED = args.subscriptions
+    cfg.SUBSCRIPTION_PORT = args.subscription_port
+    cfg.SUBSCRIPTION_URL = args.subscription_url
+    cfg.METRICS_HOST = args.metrics_host
+    cfg.METRICS_PORT = args.metrics_port
+    # Docker sends SIGTERM on stop, turn it into a graceful drain
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     try:
         if args.debug:
@@ -110,6 +493,8 @@ if __name__ == "__main__":
             load_config_from_secrets()
         
         cfg.TELEGRAM_API_URL = f"https://api.telegram.org/bot{cfg.TOKEN}"
+        state.configure(cfg.STATE_BACKEND)
+        ratelimit.configure(cfg.RATE_LIMIT_BACKEND)
         main()
     except FileNotFoundError as e:
         logger.error("Error when reading configuration: %s", e)
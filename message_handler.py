@@ -1,81 +1,93 @@
-import requests
-import time
 import logging
 import config as cfg
+import broadcast
 import core
 import ui
 import vpn
+import state
+from state import PendingSelection
+from servers import find_server, default_server
+from router import CHEAP, SLOW, Router
 
 logger = logging.getLogger(__name__)
 
-def get_updates() -> dict:
-    """Gets updates from Telegram API.
-    Returns a dictionary with updates or empty result on error.
-    """
-    logger.debug("Getting updates with offset=%s", cfg.LAST_UPDATE_ID)
-    params = {"timeout": 100, "offset": cfg.LAST_UPDATE_ID}
-    try:
-        response = requests.get(f"{cfg.TELEGRAM_API_URL}/getUpdates", params=params)
-        response.raise_for_status()
-        logger.debug("Received updates: %s", response.json())
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error("Error when getting updates: %s", e)
-        return {"result": []}
+# Handlers of commands, called as handler(message, chat_id, args)
+commands = Router()
+# Handlers of inline button callback data, called as handler(callback_query, chat_id, argument)
+callbacks = Router()
+
+
+def is_client_selection(text: str) -> bool:
+    """Checks if a message looks like an answer to the client selection prompt."""
+    text = text.strip()
+    return text.isdigit() or text.lower() == "новый"
+
 
 def handle_client_selection(chat_id: int, selection: str) -> bool:
     """Handles client selection if matching_clients list was previously saved.
     Returns True if the message was processed as client selection, False otherwise.
     """
-    data = cfg.user_data.get(chat_id)
-    if not data or not data.get("matching_clients"):
+    pending = state.store.get(chat_id)
+    if not isinstance(pending, PendingSelection) or not pending.matching_clients:
         return False
-    try:
-        matching_clients = data["matching_clients"]
-        inbound_id = data["inbound_id"]
-        server_port = data["server_port"]
-        public_key = data["public_key"]
-        short_id = data["short_id"]
-        sni = data["sni"]
-        username = data["username"]
-        last_request_time = data["last_request_time"]
-        country = data.get("country", "nl")
-        original_api_url = data.get("original_api_url")
-        original_server_domain = data.get("original_server_domain")
-
-        # Set server configuration for selected country
-        if original_api_url and original_server_domain:
-            cfg.API_URL = cfg.SERVERS[country]
-            from urllib.parse import urlparse
-            parsed_url = urlparse(cfg.API_URL)
-            cfg.SERVER_DOMAIN = parsed_url.hostname
-
-        if selection.lower() == "новый":
-            session = requests.Session()
-            client_uuid = vpn.add_new_client(session, inbound_id, chat_id, username)
-            if client_uuid is None:
-                return True
-            vpn.send_vpn_configuration(chat_id, client_uuid, server_port, public_key, sni, short_id, username, last_request_time)
-        else:
-            index = int(selection) - 1
-            if index < 0 or index >= len(matching_clients):
-                raise ValueError
-            selected_client = matching_clients[index]
-            client_uuid = selected_client.get("id")
-            vpn.send_vpn_configuration(chat_id, client_uuid, server_port, public_key, sni, short_id, username, last_request_time)
-    except ValueError:
+    # The prompt is answered once, a wrong answer starts over from the menu
+    state.store.pop(chat_id)
+    server = find_server(pending.country, pending.api_url) or default_server()
+    context = {
+        "country": server.country, "api_url": server.api_url, "inbound_id": pending.inbound_id,
+        "server_port": pending.server_port, "public_key": pending.public_key, "short_id": pending.short_id,
+        "sni": pending.sni, "email": pending.username,
+    }
+    if selection.lower() == "новый":
+        vpn.submit_provisioning(chat_id, vpn.ADD_CLIENT, context)
+        return True
+    index = int(selection) - 1 if selection.isdigit() else -1
+    if index < 0 or index >= len(pending.matching_clients):
         core.send_message(chat_id, "Некорректный выбор. Введите номер клиента из списка или 'новый' для создания нового клиента.")
-    except Exception as e:
-        logger.error("Error when processing client selection: %s", e)
-        core.send_message(chat_id, f"Ошибка при обработке выбора клиента: {e}")
-    finally:
-        # Restore original configuration
-        if original_api_url and original_server_domain:
-            cfg.API_URL = original_api_url
-            cfg.SERVER_DOMAIN = original_server_domain
-        del cfg.user_data[chat_id]
+        return True
+    client = pending.matching_clients[index]
+    # The link is named after the client's own email, so it stays the same link every time it is sent
+    context.update(client_uuid=client.get("id"), email=client.get("email") or pending.username)
+    vpn.submit_provisioning(chat_id, vpn.RENDER, context)
     return True
 
+def send_menu_hint(chat_id: int) -> None:
+    core.send_reply(chat_id, ui.MAIN_MENU_HINT)
+
+
+@commands.route("/start")
+def start_command(message: dict, chat_id: int, args: str) -> None:
+    user_data_msg = message["from"]
+    first_name = user_data_msg.get("first_name", "")
+    last_name = user_data_msg.get("last_name", "")
+    full_name = f"{first_name} {last_name}".strip()
+    logger.info(
+        "Command /start from user %s", chat_id, extra={"username": user_data_msg.get("username", "")}
+    )
+    core.send_reply(chat_id, ui.WELCOME, ui.WELCOME_TEXT.format(full_name=full_name))
+
+
+@commands.route("/help")
+def help_command(message: dict, chat_id: int, args: str) -> None:
+    logger.info(
+        "Command /help from user %s", chat_id, extra={"username": message["from"].get("username", "")}
+    )
+    core.send_reply(chat_id, ui.HELP_COMMAND)
+
+
+@commands.route("/broadcast")
+def broadcast_command(message: dict, chat_id: int, args: str) -> None:
+    if chat_id not in cfg.ADMIN_IDS:
+        send_menu_hint(chat_id)
+        return
+    if not args:
+        core.send_message(chat_id, "Использование: /broadcast <текст сообщения>")
+        return
+    logger.info("Admin %s started a broadcast", chat_id)
+    broadcast.start_broadcast(args, chat_id)
+    core.send_message(chat_id, "Рассылка запущена, отчёт придёт по завершении.")
+
+
 def process_message(message: dict) -> None:
     """Processes incoming message from user and sends appropriate response."""
     logger.debug("Processing message: %s", message)
@@ -85,40 +97,19 @@ def process_message(message: dict) -> None:
     if handle_client_selection(chat_id, text.strip()):
         return
 
-    contact = message.get("contact", None)
-    user_data_msg = message["from"]
-    first_name = user_data_msg.get("first_name", "")
-    last_name = user_data_msg.get("last_name", "")
-    username = user_data_msg.get("username", "")
-    full_name = f"{first_name} {last_name}".strip()
+    command, _, args = text.partition(" ")
+    route = commands.resolve(command) if command.startswith("/") else None
+    if route is not None:
+        route.handler(message, chat_id, args.strip())
+        return
 
-    if text == "/start":
-        logger.info(
-            "Command /start from user %s", chat_id, extra={"username": username}
-        )
-        welcome_message = (
-            f"Здравствуйте, {full_name}!\n\nЯ помогу вам настроить доступ к VLESS VPN."
-        )
-        core.send_message(chat_id, welcome_message, reply_markup=ui.main_menu())
-    elif text == "/help":
-        logger.info(
-            "Command /help from user %s", chat_id, extra={"username": username}
-        )
-        core.send_message(
-            chat_id,
-            "Используйте меню для навигации по боту.",
-            reply_markup=ui.main_menu(),
-        )
-    elif contact:
+    username = message["from"].get("username", "")
+    if message.get("contact"):
         logger.info(
             "Received contact from user %s", chat_id, extra={"username": username}
         )
         # Contact handling is no longer needed, redirect to main menu
-        core.send_message(
-            chat_id,
-            "Запрос контакта больше не требуется. Используйте кнопку 'Получить VPN' в главном меню.",
-            reply_markup=ui.main_menu(),
-        )
+        core.send_reply(chat_id, ui.CONTACT_NOT_NEEDED)
     else:
         logger.info(
             "Received text message from user %s: %s",
@@ -126,57 +117,76 @@ def process_message(message: dict) -> None:
             text,
             extra={"username": username},
         )
-        core.send_message(
-            chat_id,
-            "Пожалуйста, используйте меню для навигации.",
-            reply_markup=ui.main_menu(),
-        )
+        send_menu_hint(chat_id)
+
+
+@callbacks.route("get")
+def get_vpn_callback(callback_query: dict, chat_id: int, argument: str) -> None:
+    logger.info('User %s selected "Get VPN"', chat_id)
+    core.send_message(
+        chat_id, "Выберите страну для VPN сервера:", reply_markup=ui.country_menu()
+    )
+
+
+@callbacks.route("help")
+def help_callback(callback_query: dict, chat_id: int, argument: str) -> None:
+    logger.info('User %s selected "VPN Setup Help"', chat_id)
+    core.send_reply(chat_id, ui.PLATFORM_MENU)
+
+
+@callbacks.route("help_", prefix=True)
+def platform_help_callback(callback_query: dict, chat_id: int, platform: str) -> None:
+    logger.info(
+        "User %s requested help for platform %s", chat_id, platform
+    )
+    ui.send_platform_help(chat_id, platform)
+
+
+@callbacks.route("country_", cost=SLOW, prefix=True)
+def country_callback(callback_query: dict, chat_id: int, country: str) -> None:
+    logger.info("User %s selected country %s", chat_id, country)
+    username = callback_query["from"].get("username", "")
+    # The callback query ID stays the same when Telegram redelivers the update
+    vpn.create_vpn_account(chat_id, username, country, idempotency_key=callback_query["id"])
+
+
+@callbacks.route("back")
+def back_callback(callback_query: dict, chat_id: int, argument: str) -> None:
+    logger.info("User %s returned to main menu", chat_id)
+    core.send_reply(chat_id, ui.BACK)
 
 
 def handle_callback_query(callback_query: dict) -> None:
-    """Handles callback_query from user and performs appropriate actions."""
+    """Handles callback_query from user and performs appropriate actions.
+
+    The query itself is answered when the update is accepted, see
+    main.accept_update, so the button stops loading before queued work runs.
+    """
     logger.debug("Processing callback_query: %s", callback_query)
     chat_id = callback_query["message"]["chat"]["id"]
     data = callback_query["data"]
 
-    # Send answerCallbackQuery to remove loading indicator
-    callback_query_id = callback_query["id"]
-    try:
-        requests.post(
-            f"{cfg.TELEGRAM_API_URL}/answerCallbackQuery",
-            data={"callback_query_id": callback_query_id},
-        )
-    except requests.exceptions.RequestException as e:
-        logger.error("Error when sending answerCallbackQuery: %s", e)
-
-    if data == "get":
-        logger.info('User %s selected "Get VPN"', chat_id)
-        core.send_message(
-            chat_id, "Выберите страну для VPN сервера:", reply_markup=ui.country_menu()
-        )
-    elif data == "help":
-        logger.info('User %s selected "VPN Setup Help"', chat_id)
-        core.send_message(
-            chat_id, "Выберите вашу платформу:", reply_markup=ui.help_menu()
-        )
-    elif data.startswith("help_"):
-        platform = data.split("_")[1]
-        logger.info(
-            "User %s requested help for platform %s", chat_id, platform
-        )
-        ui.send_platform_help(chat_id, platform)
-    elif data.startswith("country_"):
-        country = data.split("_")[1]
-        logger.info("User %s selected country %s", chat_id, country)
-        # Get user data from callback_query
-        user_data_cb = callback_query["from"]
-        username = user_data_cb.get("username", "")
-        vpn.create_vpn_account(chat_id, username, country)
-    elif data == "back":
-        logger.info("User %s returned to main menu", chat_id)
-        core.send_message(
-            chat_id, "Возврат в главное меню.", reply_markup=ui.main_menu()
-        )
-    else:
+    route = callbacks.resolve(data)
+    if route is None:
         logger.warning("Unknown command from user %s: %s", chat_id, data)
-        core.send_message(chat_id, "Неизвестная команда.", reply_markup=ui.main_menu())
+        core.send_reply(chat_id, ui.UNKNOWN_COMMAND)
+        return
+    route.handler(callback_query, chat_id, route.argument(data))
+
+
+def update_cost(update: dict) -> str:
+    """Returns the cost class of the handler the update is routed to, see router.py."""
+    callback_query = update.get("callback_query")
+    if callback_query is not None:
+        route = callbacks.resolve(callback_query.get("data", ""))
+        return route.cost if route is not None else CHEAP
+    message = update.get("message")
+    if message is not None:
+        text = message.get("text", "")
+        # Answering the selection prompt queues a provisioning job like a country_ callback
+        if is_client_selection(text):
+            return SLOW
+        route = commands.resolve(text.partition(" ")[0])
+        if route is not None:
+            return route.cost
+    return CHEAP
@@ -0,0 +1,210 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+# Prefix of every exported Prometheus metric name
+PREFIX = "vpn_bot"
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, constant memory however many samples it gets."""
+
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q-quantile, or None without samples."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": dict(zip([str(b) for b in self.bounds] + ["+Inf"], self.counts)),
+        }
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics in the Prometheus text format."""
+
+    # Set by Metrics.serve
+    metrics = None
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics %s - %s", self.address_string(), format % args)
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Metrics:
+    """Process-wide latency histograms of named stages, labelled counters and gauges.
+
+    Recording a sample or a count is a dict lookup and an addition under a
+    lock. Gauges are callables that are only evaluated when the metrics are
+    rendered, so nothing is computed unless /metrics is scraped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name):
+        """Times the block and records its duration under name, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def inc(self, name, amount=1, **labels):
+        """Adds amount to the counter name with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def gauge(self, name, func, **labels):
+        """Registers func() as the current value of the gauge, replacing an earlier one."""
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def snapshot(self):
+        """Returns the histogram summary of every stage."""
+        with self._lock:
+            return {name: histogram.snapshot() for name, histogram in self._histograms.items()}
+
+    def counters(self):
+        """Returns {name: {labels: value}} of every counter."""
+        result = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                result.setdefault(name, {})[labels] = value
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = {
+                name: (list(h.counts), h.count, h.total, h.bounds) for name, h in self._histograms.items()
+            }
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items(), key=lambda item: item[0])
+        lines = []
+        if histograms:
+            metric = f"{PREFIX}_stage_duration_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, (counts, count, total, bounds) in sorted(histograms.items()):
+                cumulative = 0
+                for bound, bucket in zip(list(bounds) + ["+Inf"], counts):
+                    cumulative += bucket
+                    le = bound if bound == "+Inf" else _number(float(bound))
+                    lines.append(f"{metric}_bucket{_labels((('stage', name), ('le', le)))} {cumulative}")
+                lines.append(f"{metric}_sum{_labels((('stage', name),))} {_number(total)}")
+                lines.append(f"{metric}_count{_labels((('stage', name),))} {count}")
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f"{PREFIX}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {_number(value)}")
+        for (name, labels), func in gauges:
+            metric = f"{PREFIX}_{name}"
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning("Error when reading gauge %s: %s", name, e)
+                continue
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host, port):
+        """Serves /metrics from a daemon thread and returns the server."""
+        handler = type("BoundMetricsHandler", (MetricsHandler,), {"metrics": self})
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Serving metrics on %s:%s/metrics", host, server.server_address[1])
+        return server
+
+
+metrics = Metrics()
+span = metrics.span
+inc = metrics.inc
@@ -0,0 +1,153 @@
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import config as cfg
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+def _is_auth_failure(response):
+    """Checks if the panel rejected a request because the session is not authenticated.
+
+    3x-ui answers unauthenticated API calls with 401/404 or redirects them to the
+    HTML login page instead of returning JSON.
+    """
+    if response.status_code in (401, 403, 404):
+        return True
+    content_type = response.headers.get("Content-Type", "")
+    return "text/html" in content_type
+
+
+class PanelSession:
+    """Long-lived, connection-pooled and authenticated session to one 3x-ui panel.
+
+    The session is shared by all workers. The auth cookie is cached and the
+    session logs in again when the cookie is older than
+    cfg.PANEL_SESSION_MAX_AGE or when the panel reports an auth failure.
+    """
+
+    def __init__(self, server, pool_size=None):
+        self.server = server
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size or cfg.PANEL_POOL_SIZE)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._logged_in_at = None
+        # Incremented on every successful login, lets concurrent workers that saw
+        # the same auth failure log in only once
+        self._generation = 0
+        self.stats = {"logins": 0, "reuses": 0, "relogins": 0, "failures": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _login_locked(self):
+        """Posts the credentials to /login, the caller must hold the lock."""
+        login_url = f"{self.server.api_url}/login"
+        login_data = {"username": cfg.API_USERNAME, "password": cfg.API_PASSWORD}
+        logger.debug("Authenticating with 3xui API of server %s", self.server.country)
+        # The cookie jar is shared with requests in flight on other workers, a successful
+        # login replaces the cookie through Set-Cookie instead of clearing the jar first
+        self._logged_in_at = None
+        try:
+            with span("panel_login"):
+                response = self._session.post(login_url, data=login_data, timeout=cfg.PANEL_TIMEOUT)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.exceptions.RequestException, ValueError):
+            self.stats["failures"] += 1
+            raise
+        logger.debug("3xui API login result: success=%s", result.get('success'))
+        if not result.get('success'):
+            self.stats["failures"] += 1
+            logger.error("Failed to login to 3xui API: %s", result.get('msg'))
+            return False, result.get('msg')
+        self.stats["logins"] += 1
+        self._logged_in_at = time.monotonic()
+        self._generation += 1
+        return True, None
+
+    def ensure_login(self):
+        """Logs in unless a fresh auth cookie is cached.
+
+        Returns:
+            tuple: (success, error message)
+        """
+        with self._lock:
+            if (
+                self._logged_in_at is not None
+                and time.monotonic() - self._logged_in_at < cfg.PANEL_SESSION_MAX_AGE
+            ):
+                return True, None
+            return self._login_locked()
+
+    def _relogin(self, generation):
+        """Logs in again after an auth failure unless another worker already did."""
+        with self._lock:
+            if generation != self._generation:
+                return True, None
+            self.stats["relogins"] += 1
+            return self._login_locked()
+
+    def request(self, method, url, **kwargs):
+        """Sends an authenticated request, logging in again once on auth failure.
+
+        Returns:
+            requests.Response: Response of the panel
+        """
+        kwargs.setdefault("timeout", cfg.PANEL_TIMEOUT)
+        kwargs.setdefault("allow_redirects", False)
+        success, error_msg = self.ensure_login()
+        if not success:
+            raise requests.exceptions.RequestException(f"3xui login failed: {error_msg}")
+        generation = self._generation
+        response = self._send(method, url, **kwargs)
+        if _is_auth_failure(response) or response.is_redirect:
+            logger.info("3xui session of server %s expired, logging in again", self.server.country)
+            success, error_msg = self._relogin(generation)
+            if not success:
+                raise requests.exceptions.RequestException(f"3xui login failed: {error_msg}")
+            response = self._send(method, url, **kwargs)
+        else:
+            self._count("reuses")
+        return response
+
+    def _send(self, method, url, **kwargs):
+        """Sends a request with the cached cookie, failed logins are counted by _login_locked."""
+        try:
+            return self._session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self._count("failures")
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(server):
+    """Returns the shared PanelSession of the server, creating it on first use."""
+    session = _sessions.get(server)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(server)
+            if session is None:
+                session = PanelSession(server)
+                _sessions[server] = session
+    return session
+
+
+def session_stats():
+    """Returns login/reuse/relogin/failure counters per ServerTarget with a session."""
+    return {server: dict(session.stats) for server, session in list(_sessions.items())}
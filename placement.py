@@ -0,0 +1,151 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+import config as cfg
+
+logger = logging.getLogger(__name__)
+
+# An inbound a new client can be added to, with its current load
+Candidate = namedtuple("Candidate", ["server", "inbound", "clients", "traffic"])
+
+
+def least_clients(candidates, chat_id):
+    """Picks the inbound with the fewest clients, the least traffic breaks ties."""
+    return min(candidates, key=lambda c: (c.clients, c.traffic))
+
+
+def weighted(candidates, chat_id):
+    """Picks an inbound at random, weighted by panel weight per client already on it.
+
+    Panel weights come from cfg.PLACEMENT_WEIGHTS by panel URL and default to 1.
+    """
+    weights = [
+        cfg.PLACEMENT_WEIGHTS.get(c.server.api_url, 1) / (1 + c.clients)
+        for c in candidates
+    ]
+    return random.choices(candidates, weights=weights)[0]
+
+
+def _rendezvous_score(chat_id, candidate):
+    key = f"{chat_id}:{candidate.server.api_url}:{candidate.inbound.id}".encode()
+    return hashlib.blake2b(key, digest_size=8).digest()
+
+
+def consistent_hash(candidates, chat_id):
+    """Picks the same inbound for a Telegram user every time.
+
+    Rendezvous hashing on the tgId: adding or removing an inbound only moves
+    the users whose inbound it was or becomes.
+    """
+    return max(candidates, key=lambda c: _rendezvous_score(chat_id, c))
+
+
+POLICIES = {
+    "least_clients": least_clients,
+    "weighted": weighted,
+    "consistent_hash": consistent_hash,
+}
+
+
+class Placement:
+    """Chooses the inbound a new client is added to.
+
+    Candidates are built from the cached inbound lists, so placing a client
+    costs no panel calls. Clients added since an inbound list was loaded are
+    counted locally, so least-clients keeps spreading clients between
+    refreshes. The decision per user and country is cached for
+    cfg.PLACEMENT_DECISION_TTL seconds, so repeated requests of a user land on
+    the same inbound while it stays a candidate.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (server, inbound_id) -> (RealityInbound the count applies to, clients added since)
+        self._added = {}
+        # (chat_id, servers) -> ((server, inbound_id), decided_at)
+        self._decisions = OrderedDict()
+
+    def _added_clients(self, server, inbound):
+        entry = self._added.get((server, inbound.id))
+        # A reloaded inbound list already contains the added clients
+        if entry is None or entry[0] is not inbound:
+            return 0
+        return entry[1]
+
+    def candidates(self, inbounds_by_server):
+        """Returns the Candidates of a dict of ServerTarget to its list of RealityInbound."""
+        with self._lock:
+            return [
+                Candidate(
+                    server, inbound,
+                    inbound.clients + self._added_clients(server, inbound),
+                    inbound.up + inbound.down,
+                )
+                for server, inbounds in inbounds_by_server.items()
+                for inbound in inbounds
+            ]
+
+    def choose(self, inbounds_by_server, chat_id, policy=None):
+        """Returns (ServerTarget, RealityInbound) a new client of the user is added to.
+
+        Args:
+            inbounds_by_server: Dict of ServerTarget to its list of RealityInbound
+            chat_id: Telegram user ID
+            policy: Name in POLICIES, cfg.PLACEMENT_POLICY by default
+        """
+        candidates = self.candidates(inbounds_by_server)
+        if not candidates:
+            return None
+        decision_key = (chat_id, tuple(inbounds_by_server))
+        now = time.monotonic()
+        with self._lock:
+            decision = self._decisions.get(decision_key)
+            if decision is not None and now - decision[1] < cfg.PLACEMENT_DECISION_TTL:
+                for c in candidates:
+                    if (c.server, c.inbound.id) == decision[0]:
+                        return c.server, c.inbound
+        chosen = POLICIES[policy or cfg.PLACEMENT_POLICY](candidates, chat_id)
+        with self._lock:
+            self._decisions[decision_key] = ((chosen.server, chosen.inbound.id), now)
+            self._decisions.move_to_end(decision_key)
+            while len(self._decisions) > cfg.PLACEMENT_DECISION_CACHE_SIZE:
+                self._decisions.popitem(last=False)
+        logger.debug(
+            "Placing client of user %s on inbound %s of server %s (%d clients)",
+            chat_id, chosen.inbound.id, chosen.server.api_url, chosen.clients,
+        )
+        return chosen.server, chosen.inbound
+
+    def assign(self, inbounds_by_server, keys, policy=None):
+        """Places a batch of new clients, counting the clients placed earlier in the batch.
+
+        Args:
+            inbounds_by_server: Dict of ServerTarget to its list of RealityInbound
+            keys: Telegram user ID or another stable key per client
+            policy: Name in POLICIES, cfg.PLACEMENT_POLICY by default
+
+        Returns:
+            list: (ServerTarget, RealityInbound) per key, empty if there are no candidates
+        """
+        candidates = self.candidates(inbounds_by_server)
+        if not candidates:
+            return []
+        choose = POLICIES[policy or cfg.PLACEMENT_POLICY]
+        result = []
+        for key in keys:
+            chosen = choose(candidates, key)
+            candidates[candidates.index(chosen)] = chosen._replace(clients=chosen.clients + 1)
+            result.append((chosen.server, chosen.inbound))
+        return result
+
+    def record(self, server, inbound):
+        """Counts a client added to the inbound until its list is reloaded."""
+        with self._lock:
+            key = (server, inbound.id)
+            self._added[key] = (inbound, self._added_clients(server, inbound) + 1)
+
+
+placement = Placement()
@@ -17,10 +17,10 @@ class AndroidHelp(PlatformHelp):
         super().__init__(
             "android",
             link,
-            """
+            f"""
 **Настройка VPN на Android**
 
-1. Скачайте и установите приложение [v2rayNG]({actual_vpn_link}).
+1. Скачайте и установите приложение [v2rayNG]({link}).
 2. Загрузите QR-код или скопируйте ссылку на конфигурацию.
 3. Откройте приложение и нажмите на иконку ＋.
 4. Выберите импорт:
@@ -88,4 +88,5 @@ class Platform(Enum):
 
     @staticmethod
     def platform_name_to_enum(platform_name):
-        return Platform[platform_name.upper()]
+        """Returns the Platform of the name or None if it is unknown."""
+        return Platform.__members__.get(platform_name.upper())
@@ -0,0 +1,447 @@
+"""Bulk provisioning of VPN clients from a CSV or JSONL list of users.
+
+Every user of the input gets a row in the provision_users table with a
+pre-generated client uuid and email and the panel and inbound chosen for it,
+before anything is sent to a panel. Rows are then added in multi-client
+addClient chunks per inbound, with the panels of all servers worked on
+concurrently. Rows left pending by an interrupted run are reconciled with the
+clients the panel already has, so a resumed job never adds a client twice.
+
+Usage:
+    python provision.py --servers '...' --username ... --password ... --input users.csv --output out/
+    python provision.py --servers '...' --username ... --password ... --resume 1 --output out/
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import requests
+import config as cfg
+import panel
+import qr
+import storage
+import subscriptions
+import vpn
+from placement import placement
+from registry import resolve_servers
+from servers import find_server
+
+logger = logging.getLogger(__name__)
+
+# Links rendered per task of the QR process pool
+QR_BATCH_SIZE = 16
+
+
+def read_users(path):
+    """Reads users from a CSV file with a header or from JSON lines.
+
+    Every user needs a unique username and may have a tg_id and a country.
+
+    Returns:
+        list: Dicts with username, tg_id and country keys
+    """
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".jsonl") or path.endswith(".json"):
+            records = [json.loads(line) for line in f if line.strip()]
+        else:
+            records = list(csv.DictReader(f))
+    users = []
+    seen = {}
+    for number, record in enumerate(records, start=1):
+        username = str(record.get("username") or "").strip()
+        if not username:
+            raise ValueError(f"User {number} of {path} has no username")
+        # Emails are built from the username, the panel rejects a chunk with a duplicate one
+        if username in seen:
+            raise ValueError(f"User {number} of {path} repeats the username {username} of user {seen[username]}")
+        seen[username] = number
+        tg_id = str(record.get("tg_id") or "").strip()
+        users.append({
+            "username": username,
+            "tg_id": int(tg_id) if tg_id.lstrip("-").isdigit() else None,
+            "country": str(record.get("country") or "").strip() or None,
+        })
+    return users
+
+
+class ProvisionJob:
+    """A resumable bulk provisioning of clients."""
+
+    def __init__(self, db, job_id):
+        self.db = db
+        self.job_id = job_id
+        self.stats = {"added": 0, "reused": 0, "failed": 0, "calls": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _create_tables(db):
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS provision_jobs ("
+            "id INTEGER PRIMARY KEY, source TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS provision_users ("
+            "job_id INTEGER NOT NULL, row INTEGER NOT NULL, username TEXT NOT NULL, tg_id INTEGER, "
+            "country TEXT NOT NULL, email TEXT NOT NULL, client_uuid TEXT NOT NULL, api_url TEXT, "
+            "inbound_id INTEGER, status TEXT NOT NULL, vless_link TEXT, error TEXT, "
+            "PRIMARY KEY (job_id, row))"
+        )
+
+    @classmethod
+    def create(cls, db, source, users, country=None):
+        """Stores a new job and places every user on a panel and inbound.
+
+        Users are placed per country with placement.assign over the cached
+        inbound lists. Users of a country without a usable inbound are stored
+        as failed.
+        """
+        cls._create_tables(db)
+        timestamp = int(time.time())
+        by_country = {}
+        for row, user in enumerate(users):
+            by_country.setdefault(user["country"] or country or cfg.DEFAULT_COUNTRY, []).append((row, user))
+        rows = []
+        for user_country, country_users in by_country.items():
+            inbounds_by_server, error = _load_candidates(user_country)
+            keys = [user["tg_id"] or user["username"] for _, user in country_users]
+            assigned = placement.assign(inbounds_by_server, keys) if inbounds_by_server else []
+            for i, (row, user) in enumerate(country_users):
+                client = vpn.new_client(user["tg_id"] or "", f"{user['username']}_{timestamp}")
+                if assigned:
+                    server, inbound = assigned[i]
+                    api_url, inbound_id, status = server.api_url, inbound.id, "pending"
+                else:
+                    api_url, inbound_id, status = None, None, "failed"
+                rows.append((
+                    row, user["username"], user["tg_id"], user_country, client["email"], client["id"],
+                    api_url, inbound_id, status, None if assigned else error,
+                ))
+        with db.transaction() as conn:
+            job_id = conn.execute(
+                "INSERT INTO provision_jobs (source, created_at) VALUES (?, ?)", (source, time.time())
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO provision_users (job_id, row, username, tg_id, country, email, client_uuid, "
+                "api_url, inbound_id, status, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(job_id,) + r for r in rows],
+            )
+        return cls(db, job_id)
+
+    @classmethod
+    def load(cls, db, job_id):
+        """Loads an existing job to resume it."""
+        cls._create_tables(db)
+        if not db.execute("SELECT 1 FROM provision_jobs WHERE id = ?", (job_id,)):
+            raise KeyError(f"Unknown provisioning job {job_id}")
+        return cls(db, job_id)
+
+    def retry_failed(self):
+        """Makes failed rows that have a placement pending again."""
+        self.db.execute(
+            "UPDATE provision_users SET status = 'pending', error = NULL "
+            "WHERE job_id = ? AND status = 'failed' AND api_url IS NOT NULL",
+            (self.job_id,),
+        )
+
+    def counts(self):
+        """Returns the number of users per status over the whole job."""
+        rows = self.db.execute(
+            "SELECT status, COUNT(*) FROM provision_users WHERE job_id = ? GROUP BY status",
+            (self.job_id,),
+        )
+        return dict(rows)
+
+    def _pending_groups(self):
+        """Returns {(country, api_url, inbound_id): [(row, email, client_uuid, tg_id)]} of pending users."""
+        rows = self.db.execute(
+            "SELECT country, api_url, inbound_id, row, email, client_uuid, tg_id FROM provision_users "
+            "WHERE job_id = ? AND status = 'pending' ORDER BY row",
+            (self.job_id,),
+        )
+        groups = {}
+        for country, api_url, inbound_id, row, email, client_uuid, tg_id in rows:
+            groups.setdefault((country, api_url, inbound_id), []).append((row, email, client_uuid, tg_id))
+        return groups
+
+    def _finish(self, rows, status, inbound=None, server=None, error=None):
+        """Stores the outcome of rows of one inbound."""
+        updates = []
+        links = []
+        sub_ids = subscriptions.get_store().sub_ids(r[3] for r in rows if r[3] is not None) if inbound is not None else {}
+        for row, email, client_uuid, tg_id in rows:
+            link = None
+            if inbound is not None:
+                link = vpn.build_vless_link(
+                    server, client_uuid, inbound.port, inbound.public_key, inbound.sni, inbound.short_id, email
+                )
+                if tg_id is not None:
+                    links.append((sub_ids[tg_id], link))
+            updates.append((status, link, error, self.job_id, row))
+        subscriptions.get_store().add_links(links)
+        self.db.executemany(
+            "UPDATE provision_users SET status = ?, vless_link = ?, error = ? WHERE job_id = ? AND row = ?",
+            updates,
+        )
+
+    def _run_inbound(self, server, inbound_id, rows, chunk_size):
+        """Adds the pending clients of one inbound in chunks."""
+        session = panel.get_session(server)
+        inbounds, error_msg = vpn.get_reality_inbounds(server)
+        inbound = next((i for i in inbounds or () if i.id == inbound_id), None)
+        if inbound is None:
+            self._finish(rows, "failed", error=error_msg or f"Inbound {inbound_id} not found")
+            with self._lock:
+                self.stats["failed"] += len(rows)
+            return
+        # Clients that an interrupted run added before it could record them
+        existing = vpn.load_inbound_clients(session, server, inbound_id)
+        if existing is not None:
+            reused = [r for r in rows if r[2] in existing.by_uuid]
+            if reused:
+                self._finish(reused, "added", inbound, server)
+                with self._lock:
+                    self.stats["reused"] += len(reused)
+                rows = [r for r in rows if r[2] not in existing.by_uuid]
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            clients = []
+            sub_ids = subscriptions.get_store().sub_ids(r[3] for r in chunk if r[3] is not None)
+            for _, email, client_uuid, tg_id in chunk:
+                client = vpn.new_client(tg_id if tg_id is not None else "", email, sub_ids.get(tg_id, ""))
+                client["id"] = client_uuid
+                clients.append(client)
+            with self._lock:
+                self.stats["calls"] += 1
+            error = vpn.add_clients(session, server, inbound_id, clients)
+            if error is not None:
+                self._finish(chunk, "failed", error=error)
+                with self._lock:
+                    self.stats["failed"] += len(chunk)
+            else:
+                self._finish(chunk, "added", inbound, server)
+                with self._lock:
+                    self.stats["added"] += len(chunk)
+
+    def _run_server(self, server, groups, chunk_size):
+        """Works through the inbounds of one panel one chunk at a time."""
+        for inbound_id, rows in groups:
+            try:
+                self._run_inbound(server, inbound_id, rows, chunk_size)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                # The rows stay pending, a resumed run reconciles them with the panel
+                logger.error("Provisioning job %s on server %s failed: %s", self.job_id, server.api_url, e)
+                self._record_error(server, inbound_id, e)
+
+    def _record_error(self, server, inbound_id, error):
+        """Notes the error on the rows of the inbound that are still pending, so the manifest shows it."""
+        with self._lock:
+            self.stats["errors"] += 1
+        self.db.execute(
+            "UPDATE provision_users SET error = ? WHERE job_id = ? AND status = 'pending' AND api_url = ? "
+            "AND inbound_id = ?",
+            (f"{type(error).__name__}: {error}", self.job_id, server.api_url, inbound_id),
+        )
+
+    def run(self, chunk_size=None, concurrency=None):
+        """Adds every pending client, the panels of different servers concurrently.
+
+        Returns:
+            dict: added/reused/failed counts and addClient calls of this run, elapsed seconds
+                and clients per second
+        """
+        by_server = {}
+        for (country, api_url, inbound_id), rows in self._pending_groups().items():
+            server = find_server(country, api_url)
+            if server is None:
+                self._finish(rows, "failed", error=f"Server {api_url} is not configured")
+                self.stats["failed"] += len(rows)
+                continue
+            by_server.setdefault(server, []).append((inbound_id, rows))
+        pending = sum(len(rows) for groups in by_server.values() for _, rows in groups)
+        logger.info("Provisioning job %s: adding %d clients on %d servers", self.job_id, pending, len(by_server))
+        start = time.monotonic()
+        workers = max(1, min(concurrency or cfg.PROVISION_CONCURRENCY, len(by_server)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="provision") as pool:
+            futures = {
+                pool.submit(self._run_server, server, groups, chunk_size or cfg.PROVISION_CHUNK_SIZE): (server, groups)
+                for server, groups in by_server.items()
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # Unexpected errors, e.g. a panel reply without an expected field, stop the server's rows
+                    server, groups = futures[future]
+                    logger.exception("Provisioning job %s on server %s failed", self.job_id, server.api_url)
+                    for inbound_id, _ in groups:
+                        self._record_error(server, inbound_id, e)
+        elapsed = time.monotonic() - start
+        report = dict(self.stats)
+        report["elapsed"] = round(elapsed, 2)
+        done = report["added"] + report["reused"]
+        report["per_second"] = round(done / elapsed, 2) if elapsed > 0 else 0.0
+        logger.info("Provisioning job %s finished: %s", self.job_id, report)
+        return report
+
+    def users(self):
+        """Returns every user of the job as a manifest record, in input order."""
+        rows = self.db.execute(
+            "SELECT row, username, tg_id, country, email, client_uuid, api_url, inbound_id, status, "
+            "vless_link, error FROM provision_users WHERE job_id = ? ORDER BY row",
+            (self.job_id,),
+        )
+        keys = (
+            "row", "username", "tg_id", "country", "email", "client_uuid", "api_url", "inbound_id",
+            "status", "vless_link", "error",
+        )
+        return [dict(zip(keys, row)) for row in rows]
+
+    def write_results(self, output_dir, processes=None):
+        """Renders QR codes of the added clients in parallel and writes manifest.jsonl.
+
+        QR codes that exist from an earlier run are not rendered again. A user
+        whose QR code failed to render has no "qr" and a "qr_error" in the
+        manifest, and gets it rendered by the next run.
+
+        Returns:
+            tuple: Number of QR codes rendered and number that failed
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        users = self.users()
+        todo = []
+        for user in users:
+            if user["status"] != "added":
+                continue
+            name = re.sub(r"[^\w.-]", "_", user["email"])
+            user["qr"] = f"{user['row']:06d}_{name}.png"
+            if not os.path.exists(os.path.join(output_dir, user["qr"])):
+                todo.append(user)
+        failed = 0
+        if todo:
+            args = (cfg.QR_BOX_SIZE, cfg.QR_BORDER, cfg.QR_ERROR_CORRECTION, cfg.QR_MASK_PATTERN)
+            with ProcessPoolExecutor(max_workers=processes or os.cpu_count()) as pool:
+                futures = {
+                    pool.submit(_render_batch, [user["vless_link"] for user in batch], args): batch
+                    for batch in (todo[i:i + QR_BATCH_SIZE] for i in range(0, len(todo), QR_BATCH_SIZE))
+                }
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        # The worker process died, e.g. BrokenProcessPool
+                        results = [(None, f"{type(e).__name__}: {e}")] * len(batch)
+                    for user, (png, error) in zip(batch, results):
+                        if error is not None:
+                            logger.error("Rendering the QR code of user %s failed: %s", user["row"], error)
+                            user["qr"] = None
+                            user["qr_error"] = error
+                            failed += 1
+                            continue
+                        with open(os.path.join(output_dir, user["qr"]), "wb") as f:
+                            f.write(png)
+        manifest_path = os.path.join(output_dir, "manifest.jsonl")
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            for user in users:
+                f.write(json.dumps(user, ensure_ascii=False) + "\n")
+        os.replace(manifest_path + ".tmp", manifest_path)
+        return len(todo) - failed, failed
+
+
+def _render_batch(links, args):
+    """Renders the QR codes of links in a worker process, returns (png, None) or (None, error) per link."""
+    results = []
+    for link in links:
+        try:
+            results.append((qr.render_png(link, *args), None))
+        except Exception as e:
+            results.append((None, f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _load_candidates(country):
+    """Returns ({server: Reality inbounds} of the healthy panels of the country, error message)."""
+    servers = resolve_servers(country)
+    if not servers:
+        return {}, f"Country {country} has no available server"
+    inbounds_by_server = {}
+    error = None
+    for server in servers:
+        try:
+            inbounds, error_msg = vpn.get_reality_inbounds(server)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error("Error when loading inbounds of server %s: %s", server.api_url, e)
+            error = str(e)
+            continue
+        if inbounds is None:
+            error = error_msg
+            continue
+        inbounds_by_server[server] = inbounds
+    return inbounds_by_server, error
+
+
+def provision(path, output_dir, country=None, chunk_size=None, concurrency=None, processes=None):
+    """Provisions every user of a CSV or JSONL file, returns the report of the job."""
+    job = ProvisionJob.create(storage.get_database(), path, read_users(path), country)
+    return _run_job(job, output_dir, chunk_size, concurrency, processes)
+
+
+def resume(job_id, output_dir, chunk_size=None, concurrency=None, processes=None, retry_failed=False):
+    """Continues an interrupted provisioning job, returns its report."""
+    job = ProvisionJob.load(storage.get_database(), job_id)
+    if retry_failed:
+        job.retry_failed()
+    return _run_job(job, output_dir, chunk_size, concurrency, processes)
+
+
+def _run_job(job, output_dir, chunk_size, concurrency, processes):
+    report = job.run(chunk_size, concurrency)
+    start = time.monotonic()
+    report["qr_rendered"], report["qr_failed"] = job.write_results(output_dir, processes)
+    report["qr_elapsed"] = round(time.monotonic() - start, 2)
+    report["id"] = job.job_id
+    report["totals"] = job.counts()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Provision VPN clients for a list of users")
+    parser.add_argument("--servers", required=True, help="JSON string with server configuration")
+    parser.add_argument("--username", required=True, help="API Username")
+    parser.add_argument("--password", required=True, help="API Password")
+    parser.add_argument("--input", help="CSV with a header or JSONL file with username, tg_id and country")
+    parser.add_argument("--resume", type=int, help="ID of an interrupted provisioning job to continue")
+    parser.add_argument("--retry-failed", action="store_true", help="With --resume, also retry users that failed")
+    parser.add_argument("--output", required=True, help="Directory for QR codes and manifest.jsonl")
+    parser.add_argument("--country", help="Country of users without one, the default country if omitted")
+    parser.add_argument("--chunk-size", type=int, default=cfg.PROVISION_CHUNK_SIZE, help="Clients per addClient call")
+    parser.add_argument("--concurrency", type=int, default=cfg.PROVISION_CONCURRENCY, help="Number of servers worked on at once")
+    parser.add_argument("--qr-processes", type=int, help="Number of processes rendering QR codes, all CPUs if omitted")
+    args = parser.parse_args()
+    if not args.input and args.resume is None:
+        parser.error("Either --input or --resume is required")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    config = json.loads(args.servers)
+    cfg.SERVERS = config["servers"]
+    cfg.DEFAULT_COUNTRY = config["default"]
+    cfg.API_USERNAME = args.username
+    cfg.API_PASSWORD = args.password
+    if args.resume is not None:
+        result = resume(
+            args.resume, args.output, args.chunk_size, args.concurrency, args.qr_processes, args.retry_failed
+        )
+    else:
+        result = provision(
+            args.input, args.output, args.country, args.chunk_size, args.concurrency, args.qr_processes
+        )
+    print(json.dumps(result))
+    # Users left pending by an error or without a QR code need a --resume
+    if result["errors"] or result["qr_failed"]:
+        sys.exit(1)
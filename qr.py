@@ -0,0 +1,109 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import qrcode
+import config as cfg
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+ERROR_CORRECTION_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+
+
+def render_png(data, box_size, border, error_correction, mask_pattern=None):
+    """Renders data as a 1-bit QR code and returns optimized PNG bytes.
+
+    Module level so it can be pickled into a worker process.
+    """
+    qr = qrcode.QRCode(
+        error_correction=ERROR_CORRECTION_LEVELS[error_correction],
+        box_size=box_size,
+        border=border,
+        mask_pattern=mask_pattern,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    image = qr.make_image()
+    bio = BytesIO()
+    image.save(bio, "PNG", optimize=True)
+    return bio.getvalue()
+
+
+class QrRenderer:
+    """Renders QR code PNGs with a bounded LRU cache keyed by the encoded link.
+
+    With ``processes`` > 0 rendering runs in a process pool so it does not hold
+    the GIL of the I/O workers, otherwise it runs in the calling thread.
+    """
+
+    def __init__(self, cache_size, processes=0):
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._processes = processes
+        self._pool = None
+        self.hits = 0
+        self.misses = 0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self._processes)
+            return self._pool
+
+    def render(self, data):
+        """Returns PNG bytes of the QR code for data."""
+        with self._lock:
+            png = self._cache.get(data)
+            if png is not None:
+                self._cache.move_to_end(data)
+                self.hits += 1
+                return png
+            self.misses += 1
+        args = (data, cfg.QR_BOX_SIZE, cfg.QR_BORDER, cfg.QR_ERROR_CORRECTION, cfg.QR_MASK_PATTERN)
+        with span("qr_render"):
+            if self._processes > 0:
+                png = self._get_pool().submit(render_png, *args).result()
+            else:
+                png = render_png(*args)
+        with self._lock:
+            self._cache[data] = png
+            self._cache.move_to_end(data)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return png
+
+    def shutdown(self):
+        """Stops the worker processes."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    """Returns the shared QrRenderer configured from cfg, creating it on first use."""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = QrRenderer(cfg.QR_CACHE_SIZE, cfg.QR_PROCESSES)
+    return _renderer
+
+
+def qr_photo(data):
+    """Returns the QR code of data as a named PNG file object ready for upload."""
+    bio = BytesIO(get_renderer().render(data))
+    bio.name = "qr.png"
+    return bio
@@ -0,0 +1,161 @@
+import logging
+import threading
+import time
+import config as cfg
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+def limit_for(action, server=None):
+    """Returns the configured limit of the action, a per-server entry "action:country" wins.
+
+    Returns:
+        tuple: (scope name, number of requests, period in seconds)
+    """
+    if server is not None:
+        scope = f"{action}:{server.country}"
+        if scope in cfg.RATE_LIMITS:
+            return (scope,) + tuple(cfg.RATE_LIMITS[scope])
+    return (action,) + tuple(cfg.RATE_LIMITS[action])
+
+
+class GcraLimiter:
+    """Generic cell rate algorithm limiter.
+
+    Every key is represented by a single float, its theoretical arrival time
+    (TAT), so a check is O(1) and the memory per key is constant no matter how
+    many requests it made. ``limit`` requests may arrive at once, after that
+    one request per ``period / limit`` seconds is allowed. Keys whose TAT is
+    in the past are equivalent to unknown keys and are evicted in the
+    background.
+
+    Keys are spread over ``shards`` dicts with a lock each, so an eviction
+    pass only blocks the checks of the shard it is rebuilding.
+    """
+
+    def __init__(self, clock=time.monotonic, shards=64):
+        self._clock = clock
+        # [(lock, {scope name: {key: TAT}})]
+        self._shards = [(threading.Lock(), {}) for _ in range(shards)]
+        self._evictor_lock = threading.Lock()
+        self._evictor = None
+
+    def allow(self, action, key, server=None, now=None):
+        """Registers a request of key for the action and returns False if it exceeds the limit."""
+        scope, limit, period = limit_for(action, server)
+        if now is None:
+            now = self._clock()
+        interval = period / limit
+        lock, scopes = self._shards[hash(key) % len(self._shards)]
+        with lock:
+            tats = scopes.get(scope)
+            if tats is None:
+                tats = scopes[scope] = {}
+            tat = tats.get(key, now)
+            if tat < now:
+                tat = now
+            if tat + interval - now > period:
+                return False
+            tats[key] = tat + interval
+        self._start_evictor()
+        return True
+
+    def evict(self, now=None):
+        """Drops keys that are back to a full allowance, returns the number of dropped keys."""
+        if now is None:
+            now = self._clock()
+        evicted = 0
+        for lock, scopes in self._shards:
+            with lock:
+                for scope, tats in scopes.items():
+                    fresh = {key: tat for key, tat in tats.items() if tat > now}
+                    evicted += len(tats) - len(fresh)
+                    scopes[scope] = fresh
+        return evicted
+
+    def __len__(self):
+        total = 0
+        for lock, scopes in self._shards:
+            with lock:
+                total += sum(len(tats) for tats in scopes.values())
+        return total
+
+    def _start_evictor(self):
+        if self._evictor is not None:
+            return
+        with self._evictor_lock:
+            if self._evictor is not None:
+                return
+            self._evictor = threading.Thread(target=self._evict_forever, name="ratelimit-evictor", daemon=True)
+        self._evictor.start()
+
+    def _evict_forever(self):
+        while True:
+            time.sleep(cfg.RATE_LIMIT_EVICT_INTERVAL)
+            evicted = self.evict()
+            if evicted:
+                logger.debug("Evicted %d idle rate limit keys", evicted)
+
+
+class SqliteGcraLimiter:
+    """GCRA limiter keeping the TATs in SQLite, so replicas sharing the database share the limits.
+
+    TATs are wall clock times, every check is one transaction and keys back
+    to a full allowance are deleted by a range delete over the tat index.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            "scope TEXT NOT NULL, key TEXT NOT NULL, tat REAL NOT NULL, PRIMARY KEY (scope, key)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS rate_limits_tat ON rate_limits (tat)")
+        self._last_evict = 0.0
+
+    def allow(self, action, key, server=None, now=None):
+        """Registers a request of key for the action and returns False if it exceeds the limit."""
+        scope, limit, period = limit_for(action, server)
+        if now is None:
+            now = time.time()
+        interval = period / limit
+        key = str(key)
+        with self._db.transaction() as conn:
+            row = conn.execute("SELECT tat FROM rate_limits WHERE scope = ? AND key = ?", (scope, key)).fetchone()
+            tat = max(row[0], now) if row is not None else now
+            if tat + interval - now > period:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits (scope, key, tat) VALUES (?, ?, ?)", (scope, key, tat + interval)
+            )
+        if now - self._last_evict > cfg.RATE_LIMIT_EVICT_INTERVAL:
+            self._last_evict = now
+            self.evict(now)
+        return True
+
+    def evict(self, now=None):
+        """Drops keys that are back to a full allowance, returns the number of dropped keys."""
+        if now is None:
+            now = time.time()
+        with self._db.transaction() as conn:
+            return conn.execute("DELETE FROM rate_limits WHERE tat <= ?", (now,)).rowcount
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM rate_limits WHERE tat > ?", (time.time(),))[0][0]
+
+
+# Rate limiter of all users, replaced by configure() at startup
+limiter = GcraLimiter()
+
+
+def configure(backend):
+    """Selects the rate limit backend: "memory" or "sqlite" to share limits between replicas."""
+    global limiter
+    if backend == "sqlite":
+        limiter = SqliteGcraLimiter(storage.get_database())
+    elif backend == "memory":
+        limiter = GcraLimiter()
+    else:
+        raise ValueError(f"Unknown rate limit backend: {backend}")
+    logger.info("Using %s rate limit backend", backend)
@@ -0,0 +1,232 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import config as cfg
+import panel
+from servers import all_servers, servers_for
+
+logger = logging.getLogger(__name__)
+
+# Country code of the "fastest server" choice in the country menu
+AUTO_COUNTRY = "auto"
+
+
+class ServerHealth:
+    """Probe results of one server: health and a window of API latencies."""
+
+    __slots__ = ("samples", "failures", "last_error", "probing")
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        # Consecutive failed probes, reset by a successful one
+        self.failures = 0
+        self.last_error = None
+        self.probing = False
+
+    @property
+    def probed(self):
+        return bool(self.samples) or self.failures > 0
+
+    @property
+    def healthy(self):
+        """A server that was not probed yet counts as healthy."""
+        return self.failures < cfg.PROBE_FAILURE_THRESHOLD
+
+    def percentile(self, q):
+        """Returns the q-quantile of the probe latencies in seconds or None."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ServerRegistry:
+    """Health and latency of every panel in cfg.SERVERS.
+
+    A background thread probes all panels in parallel every
+    cfg.PROBE_INTERVAL seconds with a cfg.PROBE_TIMEOUT timeout. A panel
+    failing cfg.PROBE_FAILURE_THRESHOLD probes in a row is unhealthy until a
+    probe succeeds again, so users are not sent to it. A probe fetches a
+    single inbound set with ``probe_inbound``. Until one is known it fetches
+    the inbound list once and hands it to the ``on_inbounds`` listeners, so
+    that call warms the inbound cache instead of being thrown away.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._health = {}
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._inbound_listeners = []
+        self._probe_inbounds = {}
+
+    def on_inbounds(self, listener):
+        """Registers listener(server, data), called with the inbounds/list response of a successful probe."""
+        self._inbound_listeners.append(listener)
+
+    def probe_inbound(self, server, inbound_id):
+        """Sets the inbound the probes of the server fetch instead of the whole inbound list."""
+        self._probe_inbounds[server] = inbound_id
+
+    def _get(self, server):
+        health = self._health.get(server)
+        if health is None:
+            with self._lock:
+                health = self._health.setdefault(server, ServerHealth(cfg.PROBE_WINDOW))
+        return health
+
+    def record(self, server, latency=None, error=None):
+        """Records a probe result, latency in seconds on success or the error."""
+        health = self._get(server)
+        with self._lock:
+            was_healthy = health.healthy
+            if error is None:
+                health.samples.append(latency)
+                health.failures = 0
+                health.last_error = None
+            else:
+                health.failures += 1
+                health.last_error = str(error)
+            if was_healthy != health.healthy:
+                if health.healthy:
+                    logger.info("Server %s (%s) is healthy again", server.country, server.domain)
+                else:
+                    logger.warning(
+                        "Server %s (%s) is unhealthy: %s", server.country, server.domain, health.last_error
+                    )
+
+    def is_healthy(self, server):
+        health = self._health.get(server)
+        return health is None or health.healthy
+
+    def healthy_servers(self):
+        """Returns the healthy ServerTargets in the order of cfg.SERVERS."""
+        return [server for server in all_servers() if self.is_healthy(server)]
+
+    def fastest(self):
+        """Returns the healthy server with the lowest p50 latency, servers without samples come last.
+
+        Returns None if no server is healthy.
+        """
+        best = None
+        best_key = None
+        for server in self.healthy_servers():
+            health = self._health.get(server)
+            p50 = health.percentile(0.5) if health is not None else None
+            key = (p50 is None, p50 or 0.0)
+            if best_key is None or key < best_key:
+                best, best_key = server, key
+        return best
+
+    def snapshot(self):
+        """Returns country, health and p50/p95 latency in milliseconds per panel URL."""
+        result = {}
+        for server in all_servers():
+            health = self._health.get(server)
+            if health is None:
+                result[server.api_url] = {"country": server.country, "healthy": True, "probed": False}
+                continue
+            p50 = health.percentile(0.5)
+            p95 = health.percentile(0.95)
+            result[server.api_url] = {
+                "country": server.country,
+                "healthy": health.healthy,
+                "probed": health.probed,
+                "p50_ms": None if p50 is None else round(p50 * 1000, 1),
+                "p95_ms": None if p95 is None else round(p95 * 1000, 1),
+                "last_error": health.last_error,
+            }
+        return result
+
+    def _probe(self, server):
+        health = self._get(server)
+        inbound_id = self._probe_inbounds.get(server)
+        path = f"get/{inbound_id}" if inbound_id is not None else "list"
+        start = time.monotonic()
+        try:
+            response = panel.get_session(server).get(
+                f"{server.api_url}/panel/api/inbounds/{path}", timeout=cfg.PROBE_TIMEOUT
+            )
+            response.raise_for_status()
+            data = response.json()
+            if not data.get("success") and inbound_id is None:
+                raise ValueError("panel returned success=false")
+        except Exception as e:
+            self.record(server, error=e)
+        else:
+            self.record(server, latency=time.monotonic() - start)
+            if inbound_id is not None:
+                if not data.get("success"):
+                    # The panel is up but the inbound was deleted, the next probe lists the inbounds again
+                    self._probe_inbounds.pop(server, None)
+                return
+            for listener in self._inbound_listeners:
+                try:
+                    listener(server, data)
+                except Exception:
+                    logger.exception("Error when handling probed inbounds of server %s", server.country)
+        finally:
+            health.probing = False
+
+    def probe_all(self):
+        """Probes every server in parallel and waits for the results.
+
+        A probe that does not finish within cfg.PROBE_TIMEOUT counts as failed
+        right away, e.g. while the login to a dead panel hangs, and the server
+        is not probed again until that probe returns.
+        """
+        futures = {}
+        for server in all_servers():
+            health = self._get(server)
+            if health.probing:
+                continue
+            health.probing = True
+            futures[self._executor.submit(self._probe, server)] = server
+        _, not_done = wait(futures, timeout=cfg.PROBE_TIMEOUT)
+        for future in not_done:
+            self.record(futures[future], error="probe timed out")
+        logger.debug("Server health: %s", self.snapshot())
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.probe_all()
+            except Exception:
+                logger.exception("Error when probing servers")
+            self._stop.wait(cfg.PROBE_INTERVAL)
+
+    def start(self):
+        """Starts probing in a background thread."""
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, len(all_servers())) * 2, thread_name_prefix="probe"
+        )
+        self._thread = threading.Thread(target=self._run, name="server-probe", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+
+registry = ServerRegistry()
+
+
+def resolve_servers(country):
+    """Returns the healthy panels a request for the country can be placed on.
+
+    AUTO_COUNTRY resolves to the fastest healthy panel. The list is empty if
+    no panel is healthy and None if the country is not configured.
+    """
+    if country == AUTO_COUNTRY:
+        fastest = registry.fastest()
+        return [fastest] if fastest is not None else []
+    servers = servers_for(country)
+    if not servers:
+        return None
+    return [server for server in servers if registry.is_healthy(server)]
@@ -0,0 +1,76 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Cost classes of handlers: quick UI replies and work that waits on the panels or renders QR codes.
+# The dispatcher runs them on separate worker pools, see dispatcher.py
+CHEAP = "cheap"
+SLOW = "slow"
+
+# Key of the route stored in a trie node, no callback data character is empty
+_ROUTE = ""
+
+
+class Route:
+    """Handler registered for a key, with its cost class."""
+
+    __slots__ = ("key", "handler", "cost", "prefix")
+
+    def __init__(self, key, handler, cost, prefix):
+        self.key = key
+        self.handler = handler
+        self.cost = cost
+        self.prefix = prefix
+
+    def argument(self, value):
+        """Returns the part of value after the key of a prefix route, e.g. "nl" of "country_nl"."""
+        return value[len(self.key):] if self.prefix else ""
+
+
+class Router:
+    """Looks up the handler of callback data or a command.
+
+    Exact keys are a dict lookup. Prefix keys are kept in a character trie
+    and the longest registered prefix of the value wins, so lookups cost the
+    length of the value however many routes there are.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+
+    def add(self, key, handler, cost=CHEAP, prefix=False):
+        """Registers handler for key, or for every value starting with key if prefix is set."""
+        if cost not in (CHEAP, SLOW):
+            raise ValueError(f"Unknown cost class: {cost}")
+        route = Route(key, handler, cost, prefix)
+        if not prefix:
+            self._exact[key] = route
+            return route
+        if not key:
+            raise ValueError("Prefix routes need a non-empty key")
+        node = self._trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[_ROUTE] = route
+        return route
+
+    def route(self, key, cost=CHEAP, prefix=False):
+        """Decorator form of add."""
+        def register(handler):
+            self.add(key, handler, cost, prefix)
+            return handler
+        return register
+
+    def resolve(self, value):
+        """Returns the Route of value or None if nothing matches."""
+        route = self._exact.get(value)
+        if route is not None:
+            return route
+        node = self._trie
+        for char in value:
+            node = node.get(char)
+            if node is None:
+                break
+            route = node.get(_ROUTE, route)
+        return route
@@ -0,0 +1,76 @@
+from dataclasses import dataclass
+from urllib.parse import urlparse
+import config as cfg
+
+
+@dataclass(frozen=True)
+class ServerTarget:
+    """Immutable connection details of a single 3x-ui panel.
+
+    Attributes:
+        country: Country code the server is registered under in cfg.SERVERS
+        api_url: Base URL of the 3x-ui panel
+        domain: Host name clients connect to
+    """
+
+    country: str
+    api_url: str
+    domain: str
+
+    @classmethod
+    def from_url(cls, country, api_url):
+        """Builds a target from a panel URL, the VLESS domain is the URL host."""
+        api_url = api_url.rstrip("/")
+        return cls(country, api_url, urlparse(api_url).hostname)
+
+
+# (cfg.SERVERS mapping, {country: tuple of targets}), rebuilt whenever the mapping is replaced
+_cache = (None, {})
+
+
+def _targets_by_country():
+    """Returns a dict of country code to the ServerTargets of its panels.
+
+    A country in cfg.SERVERS maps to a panel URL or a list of panel URLs.
+    """
+    global _cache
+    source, targets = _cache
+    if cfg.SERVERS is not source:
+        source = cfg.SERVERS
+        targets = {
+            country: tuple(
+                ServerTarget.from_url(country, url)
+                for url in ([urls] if isinstance(urls, str) else urls)
+            )
+            for country, urls in source.items()
+        }
+        _cache = (source, targets)
+    return targets
+
+
+def all_servers():
+    """Returns the ServerTargets of every configured panel in the order of cfg.SERVERS."""
+    return [server for targets in _targets_by_country().values() for server in targets]
+
+
+def servers_for(country):
+    """Returns the ServerTargets of every panel of the country, empty if it is not configured."""
+    return _targets_by_country().get(country, ())
+
+
+def find_server(country, api_url=None):
+    """Returns the panel of the country with the api_url, the first panel if api_url is None."""
+    for server in servers_for(country):
+        if api_url is None or server.api_url == api_url:
+            return server
+    return None
+
+
+def get_server(country):
+    """Returns the ServerTarget of the first panel of the country or None if it is not configured."""
+    return find_server(country)
+
+
+def default_server():
+    """Returns the ServerTarget of cfg.DEFAULT_COUNTRY."""
+    return get_server(cfg.DEFAULT_COUNTRY)
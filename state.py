@@ -0,0 +1,190 @@
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+import config as cfg
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+class PendingSelection:
+    """Context of a user who has to pick one of their existing clients."""
+
+    __slots__ = (
+        "country", "inbound_id", "server_port", "public_key", "short_id", "sni",
+        "username", "matching_clients", "api_url",
+    )
+    kind = "pending_selection"
+
+    def __init__(
+        self, country, inbound_id, server_port, public_key, short_id, sni, username, matching_clients,
+        api_url=None,
+    ):
+        self.country = country
+        self.inbound_id = inbound_id
+        self.server_port = server_port
+        self.public_key = public_key
+        self.short_id = short_id
+        self.sni = sni
+        self.username = username
+        self.matching_clients = matching_clients
+        # Panel of the inbound, None selects the first panel of the country
+        self.api_url = api_url
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class DeliveredConfig:
+    """The last configuration delivered to a user."""
+
+    __slots__ = ("vless_link",)
+    kind = "delivered_config"
+
+    def __init__(self, vless_link):
+        self.vless_link = vless_link
+
+    def to_dict(self):
+        return {"vless_link": self.vless_link}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+RECORD_TYPES = {record.kind: record for record in (PendingSelection, DeliveredConfig)}
+
+
+class MemoryStateStore:
+    """In-memory per-chat state with expiry.
+
+    Expiry times are kept in a min-heap next to the records. Expired entries
+    are popped from the top of the heap on writes, which costs O(log n) per
+    expired record instead of a scan over every chat, and a read of an
+    expired record drops it directly.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def get(self, chat_id):
+        """Returns the record of the chat or None if there is none or it expired."""
+        entry = self._records.get(chat_id)
+        if entry is None:
+            return None
+        record, expires_at = entry
+        if expires_at <= time.time():
+            with self._lock:
+                if self._records.get(chat_id) is entry:
+                    del self._records[chat_id]
+            return None
+        return record
+
+    def put(self, chat_id, record, ttl=None):
+        """Stores the record of the chat for ttl seconds, cfg.STATE_TTL by default."""
+        now = time.time()
+        expires_at = now + (cfg.STATE_TTL if ttl is None else ttl)
+        with self._lock:
+            self._expire(now)
+            self._records[chat_id] = (record, expires_at)
+            heapq.heappush(self._heap, (expires_at, next(self._counter), chat_id))
+
+    def pop(self, chat_id):
+        """Removes and returns the record of the chat."""
+        with self._lock:
+            entry = self._records.pop(chat_id, None)
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def _expire(self, now):
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expires_at, _, chat_id = heapq.heappop(heap)
+            entry = self._records.get(chat_id)
+            # The heap may hold outdated expiry times of overwritten records
+            if entry is not None and entry[1] == expires_at:
+                del self._records[chat_id]
+
+    def __len__(self):
+        return len(self._records)
+
+
+class SqliteStateStore:
+    """Per-chat state in SQLite, so pending selections survive restarts.
+
+    Expired rows are removed with a range delete over the expires_at index.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_state ("
+            "chat_id INTEGER PRIMARY KEY, kind TEXT NOT NULL, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_state_expires_at ON conversation_state (expires_at)"
+        )
+
+    def get(self, chat_id):
+        rows = self._db.execute(
+            "SELECT kind, data FROM conversation_state WHERE chat_id = ? AND expires_at > ?",
+            (chat_id, time.time()),
+        )
+        if not rows:
+            return None
+        kind, data = rows[0]
+        return RECORD_TYPES[kind].from_dict(json.loads(data))
+
+    def put(self, chat_id, record, ttl=None):
+        now = time.time()
+        expires_at = now + (cfg.STATE_TTL if ttl is None else ttl)
+        with self._db.transaction() as conn:
+            conn.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO conversation_state (chat_id, kind, data, expires_at) VALUES (?, ?, ?, ?)",
+                (chat_id, record.kind, json.dumps(record.to_dict()), expires_at),
+            )
+
+    def pop(self, chat_id):
+        with self._db.transaction() as conn:
+            row = conn.execute(
+                "SELECT kind, data FROM conversation_state WHERE chat_id = ? AND expires_at > ?",
+                (chat_id, time.time()),
+            ).fetchone()
+            conn.execute("DELETE FROM conversation_state WHERE chat_id = ?", (chat_id,))
+        if row is None:
+            return None
+        kind, data = row
+        return RECORD_TYPES[kind].from_dict(json.loads(data))
+
+    def __len__(self):
+        return self._db.execute(
+            "SELECT COUNT(*) FROM conversation_state WHERE expires_at > ?", (time.time(),)
+        )[0][0]
+
+
+# Conversation state of all chats, replaced by configure() at startup
+store = MemoryStateStore()
+
+
+def configure(backend):
+    """Selects the state backend: "memory" or "sqlite"."""
+    global store
+    if backend == "sqlite":
+        store = SqliteStateStore(storage.get_database())
+    elif backend == "memory":
+        store = MemoryStateStore()
+    else:
+        raise ValueError(f"Unknown state backend: {backend}")
+    logger.info("Using %s conversation state backend", backend)
@@ -0,0 +1,64 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+import config as cfg
+
+
+class Database:
+    """SQLite connection shared by the bot's persistent stores.
+
+    The connection is used from many worker threads, every statement runs
+    under a lock and in autocommit mode unless it is part of ``transaction``.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._lock = threading.RLock()
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+    def execute(self, sql, params=()):
+        """Runs a statement and returns all resulting rows."""
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def executemany(self, sql, seq_of_params):
+        """Runs a statement for every parameter tuple."""
+        with self._lock:
+            self._conn.executemany(sql, seq_of_params)
+
+    @contextmanager
+    def transaction(self):
+        """Runs the statements of the block atomically, yields the raw connection."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def get_database():
+    """Returns the shared Database at cfg.DB_PATH, opening it on first use."""
+    global _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                _database = Database(cfg.DB_PATH)
+    return _database
@@ -0,0 +1,221 @@
+import base64
+import hashlib
+import logging
+import secrets
+import string
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config as cfg
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Characters of generated subIds, 3x-ui uses lowercase letters and digits as well
+SUB_ID_ALPHABET = string.ascii_lowercase + string.digits
+SUB_ID_LENGTH = 16
+
+
+def _new_sub_id():
+    return "".join(secrets.choice(SUB_ID_ALPHABET) for _ in range(SUB_ID_LENGTH))
+
+
+def _link_client(link):
+    """Returns the part of a link identifying the client: uuid, host, port and parameters, without the name."""
+    return link.partition("#")[0]
+
+
+class Subscription:
+    """Rendered subscription of a user: base64 body and its ETag."""
+
+    __slots__ = ("body", "etag", "expires_at")
+
+    def __init__(self, body, etag, expires_at):
+        self.body = body
+        self.etag = etag
+        self.expires_at = expires_at
+
+
+class SubscriptionStore:
+    """Subscription IDs of Telegram users and the vless links delivered to them.
+
+    Every client created for a user carries the user's subId, and every
+    delivered link is recorded, so GET /sub/<subId> returns the links of all
+    servers without calling a panel. Rendered subscriptions are kept in an
+    LRU cache for cfg.SUBSCRIPTION_CACHE_TTL seconds; links added in this
+    process invalidate the cached entry right away, other processes see them
+    once it expires.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions (chat_id INTEGER PRIMARY KEY, sub_id TEXT NOT NULL UNIQUE)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS subscription_links ("
+            "sub_id TEXT NOT NULL, link TEXT NOT NULL, added_at REAL NOT NULL, PRIMARY KEY (sub_id, link))"
+        )
+        self._lock = threading.Lock()
+        self._sub_ids = {}
+        self._rendered = OrderedDict()
+
+    def sub_id(self, chat_id):
+        """Returns the subscription ID of the user, assigning one on first use."""
+        return self.sub_ids([chat_id])[int(chat_id)]
+
+    def sub_ids(self, chat_ids):
+        """Returns {chat_id: subscription ID} of the users, assigning missing ones in one transaction."""
+        chat_ids = {int(chat_id) for chat_id in chat_ids}
+        result = {chat_id: self._sub_ids[chat_id] for chat_id in chat_ids if chat_id in self._sub_ids}
+        missing = [chat_id for chat_id in chat_ids if chat_id not in result]
+        if not missing:
+            return result
+        with self._db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO subscriptions (chat_id, sub_id) VALUES (?, ?)",
+                [(chat_id, _new_sub_id()) for chat_id in missing],
+            )
+            # Another process or thread may have assigned some of them first
+            for chat_id in missing:
+                result[chat_id] = conn.execute(
+                    "SELECT sub_id FROM subscriptions WHERE chat_id = ?", (chat_id,)
+                ).fetchone()[0]
+        with self._lock:
+            self._sub_ids.update((chat_id, result[chat_id]) for chat_id in missing)
+        return result
+
+    def add_links(self, entries):
+        """Records delivered links, entries are (sub_id, vless_link) pairs."""
+        entries = list(entries)
+        if not entries:
+            return
+        now = time.time()
+        with self._db.transaction() as conn:
+            for sub_id, link in entries:
+                # A client delivered again under another name replaces its earlier link in place
+                client = _link_client(link)
+                for (existing,) in conn.execute("SELECT link FROM subscription_links WHERE sub_id = ?", (sub_id,)):
+                    if existing != link and _link_client(existing) == client:
+                        conn.execute(
+                            "UPDATE subscription_links SET link = ? WHERE sub_id = ? AND link = ?",
+                            (link, sub_id, existing),
+                        )
+                        break
+                else:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO subscription_links (sub_id, link, added_at) VALUES (?, ?, ?)",
+                        (sub_id, link, now),
+                    )
+        with self._lock:
+            for sub_id, _ in entries:
+                self._rendered.pop(sub_id, None)
+
+    def add_link(self, chat_id, link):
+        """Records a link delivered to the user."""
+        self.add_links([(self.sub_id(chat_id), link)])
+
+    def links(self, sub_id):
+        """Returns the links of the subscription in the order they were delivered."""
+        rows = self._db.execute(
+            "SELECT link FROM subscription_links WHERE sub_id = ? ORDER BY added_at, link", (sub_id,)
+        )
+        return [row[0] for row in rows]
+
+    def get(self, sub_id):
+        """Returns the rendered Subscription or None if the subscription has no links."""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._rendered.get(sub_id)
+            if cached is not None and cached.expires_at > now:
+                self._rendered.move_to_end(sub_id)
+                return cached
+        links = self.links(sub_id)
+        if not links:
+            return None
+        body = base64.b64encode("\n".join(links).encode())
+        etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        rendered = Subscription(body, etag, now + cfg.SUBSCRIPTION_CACHE_TTL)
+        with self._lock:
+            self._rendered[sub_id] = rendered
+            self._rendered.move_to_end(sub_id)
+            while len(self._rendered) > cfg.SUBSCRIPTION_CACHE_SIZE:
+                self._rendered.popitem(last=False)
+        return rendered
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Returns the shared SubscriptionStore, creating its tables on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SubscriptionStore(storage.get_database())
+    return _store
+
+
+def subscription_url(sub_id):
+    """Returns the public URL of the subscription, or None if cfg.SUBSCRIPTION_URL is not set."""
+    if not cfg.SUBSCRIPTION_URL:
+        return None
+    return f"{cfg.SUBSCRIPTION_URL.rstrip('/')}/{sub_id}"
+
+
+def _etag_matches(if_none_match, etag):
+    """Checks an If-None-Match header against the ETag, weak validators match as well."""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class SubscriptionHandler(BaseHTTPRequestHandler):
+    """Serves GET <cfg.SUBSCRIPTION_PATH>/<subId> in the base64 subscription format."""
+
+    def log_message(self, format, *args):
+        logger.debug("Subscription %s - %s", self.address_string(), format % args)
+
+    def _reply(self, status, body=b"", headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        prefix = cfg.SUBSCRIPTION_PATH.rstrip("/") + "/"
+        path = self.path.split("?", 1)[0]
+        sub_id = path[len(prefix):] if path.startswith(prefix) else ""
+        if not sub_id or "/" in sub_id:
+            self._reply(404)
+            return
+        subscription = get_store().get(sub_id)
+        if subscription is None:
+            self._reply(404)
+            return
+        headers = [
+            ("ETag", subscription.etag),
+            ("Cache-Control", f"max-age={cfg.SUBSCRIPTION_CACHE_TTL}"),
+            # Hours between refreshes suggested to v2rayNG, Streisand and other clients
+            ("Profile-Update-Interval", str(cfg.SUBSCRIPTION_UPDATE_INTERVAL)),
+        ]
+        if _etag_matches(self.headers.get("If-None-Match"), subscription.etag):
+            self._reply(304, headers=headers)
+            return
+        self._reply(200, subscription.body, headers + [("Content-Type", "text/plain; charset=utf-8")])
+
+    do_HEAD = do_GET
+
+
+def create_server(host, port):
+    """Creates an HTTP server for subscription requests."""
+    server = ThreadingHTTPServer((host, port), SubscriptionHandler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,51 @@
+"""Checkpoints of broadcast.Broadcast against fakes.FakeBotApi."""
+import pytest
+
+import bot_api
+import broadcast
+import config as cfg
+import storage
+from fakes import FakeBotApi
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    monkeypatch.setattr(bot_api, "_client", None)
+    with FakeBotApi() as telegram:
+        monkeypatch.setattr(cfg, "TELEGRAM_API_URL", telegram.url)
+        yield telegram
+
+
+@pytest.fixture
+def db():
+    return storage.Database(":memory:")
+
+
+def test_recipients_are_delivered_once(telegram, db):
+    run = broadcast.Broadcast.create(db, "hello", [1, 2, 3])
+    report = run.run(concurrency=2)
+    assert (report["delivered"], report["errors"]) == (3, 0)
+    assert run.counts() == {"delivered": 3}
+    assert run.pending() == []
+    assert sorted(telegram.sent_by_chat) == [1, 2, 3]
+
+
+def test_unexpected_error_keeps_the_recipient_pending(telegram, db, monkeypatch):
+    send = broadcast.Broadcast._send
+
+    def broken_send(self, text, chat_id):
+        if chat_id == 2:
+            raise KeyError("result")
+        return send(self, text, chat_id)
+
+    monkeypatch.setattr(broadcast.Broadcast, "_send", broken_send)
+    run = broadcast.Broadcast.create(db, "hello", [1, 2, 3])
+    report = run.run(concurrency=2)
+    assert (report["delivered"], report["errors"]) == (2, 1)
+    # The checkpoint did not move past the recipient, --resume sends to it again
+    assert run.pending() == [2]
+
+    monkeypatch.setattr(broadcast.Broadcast, "_send", send)
+    resumed = broadcast.Broadcast.load(db, run.broadcast_id)
+    assert resumed.run(concurrency=2)["delivered"] == 1
+    assert resumed.counts() == {"delivered": 3}
@@ -0,0 +1,61 @@
+"""Per-chat ordering and bounds of dispatcher.Dispatcher."""
+import random
+import threading
+import time
+from collections import defaultdict
+
+from dispatcher import Dispatcher
+from fakes import message_update
+from router import CHEAP, SLOW
+
+
+def record_handler():
+    handled = defaultdict(list)
+    lock = threading.Lock()
+
+    def handle(update):
+        time.sleep(random.uniform(0, 0.002))
+        message = update["message"]
+        with lock:
+            handled[message["chat"]["id"]].append(int(message["text"]))
+
+    return handle, handled
+
+
+def test_updates_of_a_chat_run_in_order():
+    handle, handled = record_handler()
+    dispatcher = Dispatcher(handle, max_workers=8, max_pending=20)
+    for number in range(30):
+        for chat_id in range(1, 6):
+            assert dispatcher.submit(message_update(chat_id, str(number)))
+    assert dispatcher.drain(10)
+    dispatcher.shutdown()
+    assert dict(handled) == {chat_id: list(range(30)) for chat_id in range(1, 6)}
+
+
+def test_order_holds_across_cost_classes():
+    handle, handled = record_handler()
+    # Even updates are slow, so every chat keeps moving between the pools
+    dispatcher = Dispatcher(
+        handle, max_workers=4, max_pending=10, slow_workers=4, max_pending_slow=10,
+        classify=lambda update: SLOW if int(update["message"]["text"]) % 2 == 0 else CHEAP,
+    )
+    for number in range(30):
+        for chat_id in range(1, 4):
+            assert dispatcher.submit(message_update(chat_id, str(number)))
+    assert dispatcher.drain(10)
+    dispatcher.shutdown()
+    assert dict(handled) == {chat_id: list(range(30)) for chat_id in range(1, 4)}
+
+
+def test_submit_times_out_when_full():
+    release = threading.Event()
+    dispatcher = Dispatcher(lambda update: release.wait(10), max_workers=2, max_pending=2)
+    assert dispatcher.submit(message_update(1, "0"))
+    assert dispatcher.submit(message_update(2, "0"))
+    assert not dispatcher.submit(message_update(3, "0"), timeout=0.05)
+    assert dispatcher.pending == 2
+    release.set()
+    assert dispatcher.drain(10)
+    assert dispatcher.submit(message_update(3, "0"), timeout=1)
+    dispatcher.shutdown(10)
@@ -0,0 +1,95 @@
+"""Account creation and client selection end to end against fakes.FakePanel and fakes.FakeBotApi."""
+import time
+
+import pytest
+
+import config as cfg
+from fakes import FakeBotApi, FakePanel, callback_update, message_update
+
+EXISTING_CHAT = 1001
+NEW_CHAT = 2002
+EXISTING_CLIENT_ID = "00000000-0000-4000-0001-000000001001"
+
+
+@pytest.fixture(scope="module")
+def bot(tmp_path_factory):
+    """Runs the job workers against fresh fakes and a throwaway database, restoring the config afterwards."""
+    import bot_api
+    import file_id_cache
+    import jobs
+    import storage
+    import subscriptions
+    import updates_log
+
+    workdir = tmp_path_factory.mktemp("flow")
+    with pytest.MonkeyPatch.context() as mp:
+        # main logs to bot.log in the working directory
+        mp.chdir(workdir)
+        mp.setattr(cfg, "DB_PATH", str(workdir / "bot.db"))
+        mp.setattr(cfg, "QR_PROCESSES", 0)
+        mp.setattr(cfg, "RATE_LIMITS", {"create_account": (10 ** 9, 1)})
+        for name in ("TELEGRAM_GLOBAL_RATE", "TELEGRAM_CHAT_RATE", "TELEGRAM_GROUP_RATE",
+                     "TELEGRAM_CHAT_BURST", "TELEGRAM_GROUP_BURST"):
+            mp.setattr(cfg, name, 10 ** 6)
+        # Stores and clients opened before are bound to other settings
+        for module, name in ((storage, "_database"), (jobs, "_queue"), (updates_log, "_update_log"),
+                             (updates_log, "_idempotency_keys"), (subscriptions, "_store"),
+                             (file_id_cache, "_cache"), (bot_api, "_client")):
+            mp.setattr(module, name, None)
+        import main
+        import qr
+
+        panel = FakePanel()
+        panel.inbounds[1]["clients"].append({
+            "id": EXISTING_CLIENT_ID, "flow": "xtls-rprx-vision",
+            "email": f"user{EXISTING_CHAT}", "tgId": str(EXISTING_CHAT),
+        })
+        telegram = FakeBotApi()
+        with panel, telegram:
+            mp.setattr(cfg, "SERVERS", {"nl": panel.url})
+            mp.setattr(cfg, "DEFAULT_COUNTRY", "nl")
+            mp.setattr(cfg, "TELEGRAM_API_URL", telegram.url)
+            runner = main.start_jobs()
+            yield main, runner, panel, telegram
+            runner.stop()
+            qr.get_renderer().shutdown()
+
+
+def wait_for_sent(telegram, chat_id, method, matches=lambda params: True, timeout=10):
+    """Returns the params of the first method call to the chat that matches, None on timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for sent_method, params in list(telegram.sent_by_chat[chat_id]):
+            if sent_method == method and matches(params):
+                return params
+        time.sleep(0.01)
+    return None
+
+
+def test_new_user_gets_a_new_client(bot):
+    main, runner, panel, telegram = bot
+    main.process_update(callback_update(NEW_CHAT, "country_nl"))
+    assert runner.drain(10)
+
+    photo = wait_for_sent(telegram, NEW_CHAT, "sendPhoto")
+    assert photo is not None
+    added = [client for client in panel.clients(1) if client.get("tgId") in (NEW_CHAT, str(NEW_CHAT))]
+    assert len(added) == 1
+    assert added[0]["id"] in photo["caption"]
+
+
+def test_existing_user_selects_their_client(bot):
+    main, runner, panel, telegram = bot
+    clients_before = len(panel.clients(1))
+    main.process_update(callback_update(EXISTING_CHAT, "country_nl"))
+    assert runner.drain(10)
+    # The job stores the pending selection before it asks, so "1" can only go out after the prompt
+    prompt = wait_for_sent(telegram, EXISTING_CHAT, "sendMessage", lambda params: EXISTING_CLIENT_ID in params["text"])
+    assert prompt is not None
+
+    main.process_update(message_update(EXISTING_CHAT, "1"))
+    assert runner.drain(10)
+    photo = wait_for_sent(telegram, EXISTING_CHAT, "sendPhoto")
+    assert photo is not None
+    assert EXISTING_CLIENT_ID in photo["caption"]
+    assert len(panel.clients(1)) == clients_before
@@ -0,0 +1,136 @@
+"""Retries and claims of jobs.JobQueue and jobs.JobRunner."""
+import threading
+import time
+
+import pytest
+
+import config as cfg
+import jobs
+import storage
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(cfg, "JOB_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(cfg, "JOB_POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(cfg, "JOB_MAX_ATTEMPTS", 3)
+
+
+@pytest.fixture
+def db():
+    return storage.Database(":memory:")
+
+
+def run(queue, stages):
+    """Runs the jobs of the queue to the end, returns the (job, message) pairs of failed jobs."""
+    failed = []
+    runner = jobs.JobRunner(queue, stages, lambda job, message: failed.append((job, message)), workers=2)
+    runner.start()
+    assert runner.drain(10)
+    runner.stop()
+    return failed
+
+
+def status(db, job_id):
+    return db.execute("SELECT status, stage, error FROM provisioning_jobs WHERE id = ?", (job_id,))[0]
+
+
+def test_stages_run_in_order_with_their_context(db):
+    queue = jobs.JobQueue(db, "replica")
+    calls = []
+
+    def first(job):
+        calls.append("first")
+        job.context["seen"] = True
+        return "second"
+
+    def second(job):
+        calls.append(("second", job.context["seen"]))
+        return None
+
+    assert queue.submit(1, "first", {}, job_id="job")
+    assert not queue.submit(1, "first", {}, job_id="job")
+    assert run(queue, {"first": first, "second": second}) == []
+    assert calls == ["first", ("second", True)]
+    assert status(db, "job") == (jobs.DONE, None, None)
+
+
+def test_transient_errors_are_retried(db):
+    queue = jobs.JobQueue(db, "replica")
+    attempts = []
+
+    def flaky(job):
+        attempts.append(job.attempts)
+        if len(attempts) < 3:
+            raise jobs.RetryableError("panel busy")
+        return None
+
+    queue.submit(1, "flaky", {}, job_id="job")
+    assert run(queue, {"flaky": flaky}) == []
+    assert attempts == [0, 1, 2]
+    assert status(db, "job")[0] == jobs.DONE
+
+
+def test_retries_run_out(db):
+    queue = jobs.JobQueue(db, "replica")
+    attempts = []
+
+    def broken(job):
+        attempts.append(job.attempts)
+        raise jobs.RetryableError("panel down")
+
+    queue.submit(1, "broken", {}, job_id="job")
+    failed = run(queue, {"broken": broken})
+    assert attempts == [0, 1, 2]
+    assert [(job.id, message) for job, message in failed] == [("job", None)]
+    assert status(db, "job") == (jobs.FAILED, "broken", "panel down")
+
+
+def test_job_failed_is_not_retried(db):
+    queue = jobs.JobQueue(db, "replica")
+
+    def rejected(job):
+        raise jobs.JobFailed("No free inbound")
+
+    queue.submit(1, "rejected", {}, job_id="job")
+    failed = run(queue, {"rejected": rejected})
+    assert [(job.id, message) for job, message in failed] == [("job", "No free inbound")]
+    assert status(db, "job")[0] == jobs.FAILED
+
+
+def test_claim_is_taken_over_once_it_expires(db, monkeypatch):
+    monkeypatch.setattr(cfg, "JOB_CLAIM_TTL", 0.2)
+    first = jobs.JobQueue(db, "first")
+    second = jobs.JobQueue(db, "second")
+    first.submit(1, "stage", {"step": 1}, job_id="job")
+
+    job = first.claim()
+    assert job.id == "job"
+    assert second.claim() is None
+    time.sleep(0.25)
+    taken_over = second.claim()
+    assert (taken_over.id, taken_over.context) == ("job", {"step": 1})
+    assert first.claim() is None
+
+
+def test_claims_are_exclusive_between_threads(db):
+    queue = jobs.JobQueue(db, "replica")
+    for number in range(20):
+        queue.submit(number, "stage", {}, job_id=str(number))
+    claimed = []
+    lock = threading.Lock()
+
+    def claim_all():
+        while True:
+            job = queue.claim()
+            if job is None:
+                return
+            with lock:
+                claimed.append(job.id)
+
+    threads = [threading.Thread(target=claim_all) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed, key=int) == [str(number) for number in range(20)]
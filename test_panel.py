@@ -0,0 +1,60 @@
+"""Login, relogin and counters of panel.PanelSession against fakes.FakePanel."""
+import pytest
+import requests
+
+import config as cfg
+import panel
+from fakes import FakePanel
+from servers import ServerTarget
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    monkeypatch.setattr(cfg, "API_USERNAME", "admin")
+    monkeypatch.setattr(cfg, "API_PASSWORD", "secret")
+    with FakePanel(username="admin", password="secret") as fake:
+        yield fake
+
+
+def list_url(fake):
+    return f"{fake.url}/panel/api/inbounds/list"
+
+
+def test_expired_session_logs_in_again(fake):
+    session = panel.PanelSession(ServerTarget.from_url("nl", fake.url))
+    assert session.get(list_url(fake)).json()["success"]
+    fake.expire_sessions()
+    assert session.get(list_url(fake)).json()["success"]
+    assert session.stats == {"logins": 2, "reuses": 1, "relogins": 1, "failures": 0}
+
+
+def test_relogin_replaces_the_cookie(fake):
+    session = panel.PanelSession(ServerTarget.from_url("nl", fake.url))
+    session.get(list_url(fake))
+    old_cookie = session._session.cookies.get("3x-ui")
+    fake.expire_sessions()
+    session.get(list_url(fake))
+    assert session._session.cookies.get("3x-ui") not in (None, old_cookie)
+    assert len(session._session.cookies) == 1
+
+
+def test_failed_relogin_is_counted_once_and_keeps_the_jar(fake, monkeypatch):
+    session = panel.PanelSession(ServerTarget.from_url("nl", fake.url))
+    session.get(list_url(fake))
+    old_cookie = session._session.cookies.get("3x-ui")
+    fake.expire_sessions()
+    monkeypatch.setattr(cfg, "API_PASSWORD", "wrong")
+    with pytest.raises(requests.exceptions.RequestException):
+        session.get(list_url(fake))
+    assert session.stats["failures"] == 1
+    # Other workers share the jar, a login does not empty it while their requests are in flight
+    assert session._session.cookies.get("3x-ui") == old_cookie
+
+
+def test_failed_request_is_counted_once(fake):
+    session = panel.PanelSession(ServerTarget.from_url("nl", fake.url))
+    session.ensure_login()
+    fake.latency = 0.5
+    with pytest.raises(requests.exceptions.RequestException):
+        session.get(list_url(fake), timeout=0.1)
+    assert session.stats["failures"] == 1
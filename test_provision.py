@@ -0,0 +1,68 @@
+"""Bulk provisioning of provision.py against fakes.FakePanel."""
+import json
+import os
+
+import pytest
+
+import config as cfg
+import provision
+import storage
+import subscriptions
+import vpn
+from fakes import FakePanel
+
+
+@pytest.fixture
+def fake(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "_database", storage.Database(str(tmp_path / "bot.db")))
+    monkeypatch.setattr(subscriptions, "_store", None)
+    with FakePanel(inbounds=2) as fake:
+        monkeypatch.setattr(cfg, "SERVERS", {"nl": fake.url})
+        monkeypatch.setattr(cfg, "DEFAULT_COUNTRY", "nl")
+        yield fake
+
+
+def write_users(tmp_path, usernames):
+    path = tmp_path / "users.jsonl"
+    path.write_text("".join(json.dumps({"username": name}) + "\n" for name in usernames), encoding="utf-8")
+    return str(path)
+
+
+def manifest(output_dir):
+    with open(os.path.join(output_dir, "manifest.jsonl"), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_users_are_added_with_qr_codes(fake, tmp_path):
+    output_dir = str(tmp_path / "out")
+    report = provision.provision(write_users(tmp_path, ["ann", "bob", "cid"]), output_dir, chunk_size=2, processes=1)
+    assert (report["added"], report["errors"], report["qr_rendered"], report["qr_failed"]) == (3, 0, 3, 0)
+    users = manifest(output_dir)
+    assert [user["status"] for user in users] == ["added"] * 3
+    assert all(os.path.exists(os.path.join(output_dir, user["qr"])) for user in users)
+
+
+def test_unexpected_panel_error_is_recorded(fake, tmp_path, monkeypatch):
+    def broken_add_clients(session, server, inbound_id, clients):
+        raise KeyError("obj")
+
+    monkeypatch.setattr(vpn, "add_clients", broken_add_clients)
+    output_dir = str(tmp_path / "out")
+    report = provision.provision(write_users(tmp_path, ["ann", "bob"]), output_dir, processes=1)
+    assert report["errors"] >= 1
+    assert report["added"] == 0
+    users = manifest(output_dir)
+    # The rows stay pending for --resume, with the error that stopped them
+    assert [user["status"] for user in users] == ["pending", "pending"]
+    assert all("KeyError" in user["error"] for user in users)
+
+
+def test_failed_qr_code_is_recorded(fake, tmp_path):
+    output_dir = str(tmp_path / "out")
+    # The link of this user is too long for a QR code
+    report = provision.provision(write_users(tmp_path, ["ann", "x" * 3000]), output_dir, processes=1)
+    assert (report["added"], report["qr_rendered"], report["qr_failed"]) == (2, 1, 1)
+    ok, too_long = manifest(output_dir)
+    assert os.path.exists(os.path.join(output_dir, ok["qr"]))
+    assert too_long["qr"] is None
+    assert too_long["qr_error"]
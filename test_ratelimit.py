@@ -0,0 +1,56 @@
+"""GCRA limiters of ratelimit.py, in memory and in SQLite."""
+import pytest
+
+import config as cfg
+import ratelimit
+import storage
+
+
+class Server:
+    country = "nl"
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(cfg, "RATE_LIMITS", {"create_account": (3, 60), "create_account:nl": (1, 60)})
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def limiter(request):
+    if request.param == "memory":
+        return ratelimit.GcraLimiter(clock=lambda: 0.0)
+    return ratelimit.SqliteGcraLimiter(storage.Database(":memory:"))
+
+
+def test_burst_then_one_request_per_interval(limiter):
+    assert [limiter.allow("create_account", 1, now=1000.0) for _ in range(4)] == [True, True, True, False]
+    # 3 requests per 60s: the next one is allowed 20s after the burst
+    assert not limiter.allow("create_account", 1, now=1019.0)
+    assert limiter.allow("create_account", 1, now=1020.0)
+    assert not limiter.allow("create_account", 1, now=1020.0)
+
+
+def test_keys_are_limited_independently(limiter):
+    for _ in range(3):
+        assert limiter.allow("create_account", 1, now=1000.0)
+    assert not limiter.allow("create_account", 1, now=1000.0)
+    assert limiter.allow("create_account", 2, now=1000.0)
+
+
+def test_server_specific_limit_wins(limiter):
+    assert limiter.allow("create_account", 1, Server(), now=1000.0)
+    assert not limiter.allow("create_account", 1, Server(), now=1000.0)
+    # The per-country scope does not use up the global allowance
+    assert limiter.allow("create_account", 1, now=1000.0)
+
+
+def test_evict_drops_keys_back_to_full_allowance():
+    limiter = ratelimit.GcraLimiter(clock=lambda: 0.0)
+    limiter.allow("create_account", 1, now=0.0)
+    limiter.allow("create_account", 2, now=50.0)
+    assert len(limiter) == 2
+    # Key 1 is at full allowance again 20s after its only request, key 2 at 70s
+    assert limiter.evict(now=30.0) == 1
+    assert len(limiter) == 1
+    assert limiter.evict(now=70.0) == 1
+    assert len(limiter) == 0
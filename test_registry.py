@@ -0,0 +1,54 @@
+"""Health probes of registry.ServerRegistry against fakes.FakePanel."""
+import pytest
+
+import config as cfg
+import vpn
+from fakes import FakePanel
+from registry import registry
+from servers import ServerTarget
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    with FakePanel(inbounds=2) as fake:
+        monkeypatch.setattr(cfg, "SERVERS", {"nl": fake.url})
+        yield fake
+
+
+def test_first_probe_warms_the_cache_and_later_probes_fetch_one_inbound(fake):
+    server = ServerTarget.from_url("nl", fake.url)
+    registry._probe(server)
+    assert fake.calls["/panel/api/inbounds/list"] == 1
+    assert [inbound.id for inbound in vpn.inbound_cache.get(server)] == [1, 2]
+
+    registry._probe(server)
+    registry._probe(server)
+    assert fake.calls["/panel/api/inbounds/list"] == 1
+    assert fake.calls["/panel/api/inbounds/get"] == 2
+    assert registry.snapshot()[server.api_url]["healthy"]
+
+
+def test_deleted_probe_inbound_lists_again(fake):
+    server = ServerTarget.from_url("nl", fake.url)
+    registry._probe(server)
+    with fake._lock:
+        del fake.inbounds[1]
+    registry._probe(server)
+    assert registry.is_healthy(server)
+    registry._probe(server)
+    assert fake.calls["/panel/api/inbounds/list"] == 2
+    # The new list names a probe inbound that still exists
+    registry._probe(server)
+    assert fake.calls["/panel/api/inbounds/get"] == 2
+
+
+def test_failed_probes_make_the_server_unhealthy(fake, monkeypatch):
+    monkeypatch.setattr(cfg, "PROBE_TIMEOUT", 0.2)
+    server = ServerTarget.from_url("nl", fake.url)
+    registry._probe(server)
+    fake.fail_next(cfg.PROBE_FAILURE_THRESHOLD)
+    for _ in range(cfg.PROBE_FAILURE_THRESHOLD):
+        registry._probe(server)
+    assert not registry.is_healthy(server)
+    registry._probe(server)
+    assert registry.is_healthy(server)
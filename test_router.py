@@ -0,0 +1,46 @@
+"""Route lookup of router.Router."""
+import pytest
+
+from router import CHEAP, SLOW, Router
+
+
+@pytest.fixture
+def router():
+    router = Router()
+    router.add("help", "help")
+    router.add("help_", "help_platform", prefix=True)
+    router.add("country_", "country", SLOW, prefix=True)
+    router.add("country_x", "country_x", prefix=True)
+    return router
+
+
+def test_exact_key(router):
+    route = router.resolve("help")
+    assert route.handler == "help"
+    assert route.argument("help") == ""
+
+
+def test_prefix_key_with_argument(router):
+    route = router.resolve("country_nl")
+    assert (route.handler, route.cost) == ("country", SLOW)
+    assert route.argument("country_nl") == "nl"
+
+
+def test_longest_prefix_wins(router):
+    assert router.resolve("country_xy").handler == "country_x"
+    assert router.resolve("country_").handler == "country"
+    assert router.resolve("help_ios").handler == "help_platform"
+
+
+def test_no_match(router):
+    assert router.resolve("") is None
+    assert router.resolve("count") is None
+    assert router.resolve("unknown") is None
+
+
+def test_invalid_routes():
+    router = Router()
+    with pytest.raises(ValueError):
+        router.add("get", "get", cost="expensive")
+    with pytest.raises(ValueError):
+        router.add("", "all", CHEAP, prefix=True)
@@ -0,0 +1,74 @@
+"""ETags and links of subscriptions.SubscriptionStore and the subscription endpoint."""
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+import storage
+import subscriptions
+
+LINK = "vless://00000000-0000-4000-0000-000000000001@nl.example.com:443?security=reality#user1"
+
+
+@pytest.fixture
+def store():
+    return subscriptions.SubscriptionStore(storage.Database(":memory:"))
+
+
+def test_etag_is_stable_until_links_change(store):
+    sub_id = store.sub_id(1)
+    assert store.sub_id(1) == sub_id
+    assert store.get(sub_id) is None
+
+    store.add_link(1, LINK)
+    first = store.get(sub_id)
+    assert store.get(sub_id).etag == first.etag
+    store.add_link(1, LINK)
+    assert store.get(sub_id).etag == first.etag
+
+    store.add_link(1, LINK.replace("nl.example.com", "de.example.com"))
+    assert store.get(sub_id).etag != first.etag
+    assert len(store.links(sub_id)) == 2
+
+
+def test_renamed_client_keeps_one_link(store):
+    sub_id = store.sub_id(1)
+    store.add_link(1, LINK)
+    store.add_link(1, LINK.replace("#user1", "#user1_renamed"))
+    assert store.links(sub_id) == [LINK.replace("#user1", "#user1_renamed")]
+
+
+@pytest.mark.parametrize("header, matches", [
+    (None, False),
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"other", "abc"', True),
+    ("*", True),
+    ('"other"', False),
+])
+def test_etag_matches(header, matches):
+    assert subscriptions._etag_matches(header, '"abc"') is matches
+
+
+def test_endpoint_answers_304_for_a_known_etag(store, monkeypatch):
+    monkeypatch.setattr(subscriptions, "_store", store)
+    sub_id = store.sub_id(1)
+    store.add_link(1, LINK)
+    server = subscriptions.create_server("127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/sub/{sub_id}"
+    try:
+        with urllib.request.urlopen(url) as response:
+            etag = response.headers["ETag"]
+            assert response.read() == store.get(sub_id).body
+        request = urllib.request.Request(url, headers={"If-None-Match": etag})
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(request)
+        assert error.value.code == 304
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + "x")
+        assert error.value.code == 404
+    finally:
+        server.shutdown()
+        server.server_close()
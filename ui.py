@@ -1,31 +1,71 @@
+import json
 import logging
+import threading
+from urllib.parse import urlencode
 import core
 import platform_help
+from registry import registry, AUTO_COUNTRY
+from servers import all_servers
+
+
+class Reply:
+    """A fixed reply whose keyboard and form fields are serialized once.
+
+    ``markup`` is the reply_markup JSON, ``fields`` the form-encoded
+    parse_mode, text and reply_markup fields, so sending it only prepends the
+    chat ID. The text may be left out and passed per message, e.g. for
+    templates with the user's name.
+    """
+
+    __slots__ = ("text", "markup", "fields")
+
+    def __init__(self, text=None, markup=None):
+        self.text = text
+        self.markup = None if markup is None else json.dumps(markup)
+        fields = {"parse_mode": "Markdown"}
+        if text is not None:
+            fields["text"] = text
+        if self.markup is not None:
+            fields["reply_markup"] = self.markup
+        self.fields = urlencode(fields)
+
+    def body(self, chat_id, text=None):
+        """Returns the form-encoded sendMessage body for the chat."""
+        body = f"chat_id={int(chat_id)}&{self.fields}"
+        if text is not None:
+            body += "&" + urlencode({"text": text})
+        return body.encode()
+
+
+MAIN_MENU = {
+    "inline_keyboard": [
+        [{"text": "Получить VPN", "callback_data": "get"}],
+        [{"text": "Помощь в настройке VPN", "callback_data": "help"}],
+    ]
+}
+
+HELP_MENU = {
+    "inline_keyboard": [
+        [{"text": "Android", "callback_data": "help_android"}],
+        [{"text": "iOS", "callback_data": "help_ios"}],
+        [{"text": "Windows", "callback_data": "help_windows"}],
+        [{"text": "macOS", "callback_data": "help_macos"}],
+        [{"text": "Назад", "callback_data": "back"}],
+    ]
+}
+
+_main_menu = json.dumps(MAIN_MENU)
+_help_menu = json.dumps(HELP_MENU)
 
 
 def main_menu():
-    """Returns the main menu keyboard with VPN setup and help options."""
-    keyboard = {
-        "inline_keyboard": [
-            [{"text": "Получить VPN", "callback_data": "get"}],
-            [{"text": "Помощь в настройке VPN", "callback_data": "help"}],
-        ]
-    }
-    return keyboard
+    """Returns the serialized main menu keyboard with VPN setup and help options."""
+    return _main_menu
 
 
 def help_menu():
-    """Returns the help menu keyboard with platform selection options."""
-    keyboard = {
-        "inline_keyboard": [
-            [{"text": "Android", "callback_data": "help_android"}],
-            [{"text": "iOS", "callback_data": "help_ios"}],
-            [{"text": "Windows", "callback_data": "help_windows"}],
-            [{"text": "macOS", "callback_data": "help_macos"}],
-            [{"text": "Назад", "callback_data": "back"}],
-        ]
-    }
-    return keyboard
+    """Returns the serialized help menu keyboard with platform selection options."""
+    return _help_menu
 
 
 def request_contact(chat_id):
@@ -38,16 +78,73 @@ def request_contact(chat_id):
     return keyboard
 
 
+# Button labels of known country codes, other countries are shown by their code
+COUNTRY_NAMES = {
+    "nl": "🇳🇱 Нидерланды",
+    "fr": "🇫🇷 Франция",
+    "de": "🇩🇪 Германия",
+    "fi": "🇫🇮 Финляндия",
+    "ru": "🇷🇺 Россия",
+    "us": "🇺🇸 США",
+}
+
+# (listed servers, serialized keyboard) of the last country menu
+_country_menu = (None, None)
+_country_menu_lock = threading.Lock()
+
+
+def _build_country_menu(servers):
+    # A country is listed once however many of its panels are healthy
+    countries = list(dict.fromkeys(server.country for server in servers))
+    rows = []
+    if len(servers) > 1:
+        rows.append([{"text": "⚡ Самый быстрый", "callback_data": f"country_{AUTO_COUNTRY}"}])
+    for country in countries:
+        text = COUNTRY_NAMES.get(country, country.upper())
+        rows.append([{"text": text, "callback_data": f"country_{country}"}])
+    rows.append([{"text": "Назад", "callback_data": "back"}])
+    return json.dumps({"inline_keyboard": rows})
+
+
 def country_menu():
-    """Returns the country selection menu for VPN server location."""
-    keyboard = {
-        "inline_keyboard": [
-            [{"text": "🇳🇱 Нидерланды", "callback_data": "country_nl"}],
-            [{"text": "🇫🇷 Франция", "callback_data": "country_fr"}],
-            [{"text": "Назад", "callback_data": "back"}],
-        ]
-    }
-    return keyboard
+    """Returns the serialized country selection menu built from the healthy servers.
+
+    An option for the fastest server is added when there is more than one.
+    All servers are listed while none of them is healthy. The keyboard is
+    rebuilt only when the listed servers change, e.g. when cfg.SERVERS is
+    replaced or a panel becomes unhealthy.
+    """
+    global _country_menu
+    servers = tuple(registry.healthy_servers() or all_servers())
+    listed, markup = _country_menu
+    if listed == servers:
+        return markup
+    markup = _build_country_menu(servers)
+    with _country_menu_lock:
+        _country_menu = (servers, markup)
+    return markup
+
+
+HELP_FOOTER = "\nБольше клиентов можете найти на [этом сайте](https://itdog.info/klienty-vless-shadowsocks-trojan-xray-sing-box-dlya-windows-android-ios-macos-linux/#v2box---v2ray-client)."
+
+# Replies without per-user content, serialized once at import
+MAIN_MENU_HINT = Reply("Пожалуйста, используйте меню для навигации.", MAIN_MENU)
+HELP_COMMAND = Reply("Используйте меню для навигации по боту.", MAIN_MENU)
+BACK = Reply("Возврат в главное меню.", MAIN_MENU)
+UNKNOWN_COMMAND = Reply("Неизвестная команда.", MAIN_MENU)
+CONTACT_NOT_NEEDED = Reply(
+    "Запрос контакта больше не требуется. Используйте кнопку 'Получить VPN' в главном меню.", MAIN_MENU
+)
+PLATFORM_MENU = Reply("Выберите вашу платформу:", HELP_MENU)
+# Welcome message template, the text is formatted per user
+WELCOME = Reply(markup=MAIN_MENU)
+WELCOME_TEXT = "Здравствуйте, {full_name}!\n\nЯ помогу вам настроить доступ к VLESS VPN."
+
+PLATFORM_HELP = {
+    platform.value.platform: Reply(platform.value.instructions + HELP_FOOTER, HELP_MENU)
+    for platform in platform_help.Platform
+}
+UNKNOWN_PLATFORM = Reply("Неизвестная платформа" + HELP_FOOTER, HELP_MENU)
 
 
 def send_platform_help(chat_id, platform_name: str):
@@ -55,10 +152,4 @@ def send_platform_help(chat_id, platform_name: str):
     logging.info(
         "Sending help for platform %s to user %s", platform_name, chat_id
     )
-    platform = platform_help.Platform.platform_name_to_enum(platform_name).value
-    if platform is None:
-        help_text = "Неизвестная платформа"
-    else:
-        help_text = platform.instructions
-    help_text+="\nБольше клиентов можете найти на [этом сайте](https://itdog.info/klienty-vless-shadowsocks-trojan-xray-sing-box-dlya-windows-android-ios-macos-linux/#v2box---v2ray-client)."
-    core.send_message(chat_id, help_text, reply_markup=help_menu())
+    core.send_reply(chat_id, PLATFORM_HELP.get(platform_name.lower(), UNKNOWN_PLATFORM))
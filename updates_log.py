@@ -0,0 +1,138 @@
+import json
+import logging
+import threading
+import time
+import config as cfg
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateLog:
+    """Persistent polling offset and log of accepted updates.
+
+    Every update is recorded with its payload before it is dispatched and
+    marked done once it was handled. A redelivered update_id is recognized
+    and skipped, and updates that were accepted but not finished before a
+    crash can be dispatched again on startup.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS bot_offset (id INTEGER PRIMARY KEY CHECK (id = 1), update_offset INTEGER NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS processed_updates ("
+            "update_id INTEGER PRIMARY KEY, payload TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0, "
+            "accepted_at REAL NOT NULL)"
+        )
+        self._last_prune = 0.0
+        self._lock = threading.Lock()
+
+    def load_offset(self):
+        """Returns the persisted getUpdates offset or None."""
+        rows = self._db.execute("SELECT update_offset FROM bot_offset WHERE id = 1")
+        return rows[0][0] if rows else None
+
+    def save_offset(self, offset):
+        self._db.execute(
+            "INSERT OR REPLACE INTO bot_offset (id, update_offset) VALUES (1, ?)", (offset,)
+        )
+        self._prune()
+
+    def record(self, update):
+        """Records an accepted update, returns False if it was seen before."""
+        with self._db.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO processed_updates (update_id, payload, accepted_at) VALUES (?, ?, ?)",
+                (update["update_id"], json.dumps(update), time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def forget(self, update_id):
+        """Removes an update that could not be dispatched, so a redelivery is handled."""
+        self._db.execute("DELETE FROM processed_updates WHERE update_id = ? AND done = 0", (update_id,))
+
+    def mark_done(self, update_id):
+        self._db.execute("UPDATE processed_updates SET done = 1 WHERE update_id = ?", (update_id,))
+
+    def unfinished(self):
+        """Returns updates that were accepted but not handled, oldest first."""
+        rows = self._db.execute(
+            "SELECT payload FROM processed_updates WHERE done = 0 ORDER BY update_id"
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def _prune(self):
+        """Drops log entries older than cfg.UPDATE_LOG_RETENTION, at most once a minute."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < 60:
+                return
+            self._last_prune = now
+        self._db.execute(
+            "DELETE FROM processed_updates WHERE done = 1 AND accepted_at < ?",
+            (now - cfg.UPDATE_LOG_RETENTION,),
+        )
+
+
+class IdempotencyKeys:
+    """Maps idempotency keys of client creations to the created client."""
+
+    def __init__(self, db):
+        self._db = db
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency_keys ("
+            "key TEXT PRIMARY KEY, country TEXT NOT NULL, inbound_id INTEGER NOT NULL, "
+            "client_uuid TEXT NOT NULL, created_at REAL NOT NULL, api_url TEXT)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(idempotency_keys)")}
+        if "api_url" not in columns:
+            # Databases created before countries could have several panels
+            self._db.execute("ALTER TABLE idempotency_keys ADD COLUMN api_url TEXT")
+
+    def get(self, key):
+        """Returns (country, inbound_id, client_uuid, api_url) recorded for the key or None."""
+        rows = self._db.execute(
+            "SELECT country, inbound_id, client_uuid, api_url FROM idempotency_keys WHERE key = ?", (key,)
+        )
+        return tuple(rows[0]) if rows else None
+
+    def put(self, key, country, inbound_id, client_uuid, api_url=None):
+        now = time.time()
+        with self._db.transaction() as conn:
+            # Keys only protect against redelivery, which Telegram stops after a day
+            conn.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < ?", (now - cfg.UPDATE_LOG_RETENTION,)
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency_keys (key, country, inbound_id, client_uuid, created_at, api_url) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, country, inbound_id, client_uuid, now, api_url),
+            )
+
+
+_update_log = None
+_idempotency_keys = None
+_lock = threading.Lock()
+
+
+def get_update_log():
+    """Returns the shared UpdateLog, creating its tables on first use."""
+    global _update_log
+    if _update_log is None:
+        with _lock:
+            if _update_log is None:
+                _update_log = UpdateLog(storage.get_database())
+    return _update_log
+
+
+def get_idempotency_keys():
+    """Returns the shared IdempotencyKeys, creating its table on first use."""
+    global _idempotency_keys
+    if _idempotency_keys is None:
+        with _lock:
+            if _idempotency_keys is None:
+                _idempotency_keys = IdempotencyKeys(storage.get_database())
+    return _idempotency_keys
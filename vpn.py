@@ -1,81 +1,57 @@
 import requests
 import json
+from contextlib import contextmanager
 import uuid
-from datetime import datetime, timedelta
-from io import BytesIO
-import qrcode
+from datetime import datetime
 import logging
 import config as cfg
 import core
+import panel
+import qr
+import file_id_cache
+import jobs
+import ratelimit
+import state
+import subscriptions
+import updates_log
+from state import PendingSelection, DeliveredConfig
 import random
 import string
+from registry import registry, resolve_servers
+from servers import find_server
+from placement import placement
+from metrics import inc, span
+import ui
+from inbound_cache import InboundCache, RealityInbound
+from client_index import ClientIndex
 
 logger = logging.getLogger(__name__)
 
 
-def cleanup_expired_user_data(now):
-    """Removes expired records from cfg.user_data."""
-    expired_chat_ids = [
-        cid for cid, data in cfg.user_data.items()
-        if now - data['last_request_time'] > timedelta(minutes=2)
-    ]
-    for cid in expired_chat_ids:
-        del cfg.user_data[cid]
+def check_rate_limit(chat_id, server=None, action="create_account"):
+    """Checks if user has exceeded the rate limit of the action, see cfg.RATE_LIMITS."""
+    if ratelimit.limiter.allow(action, chat_id, server):
+        return True
+    inc("rate_limit_rejections", action=action, country=server.country if server is not None else "")
+    return False
 
 
-def check_rate_limit(chat_id, now):
-    """Checks if user has exceeded rate limit (3 requests per hour)."""
-    if chat_id not in cfg.user_requests:
-        cfg.user_requests[chat_id] = []
-    
-    # Remove requests older than 1 hour
-    cfg.user_requests[chat_id] = [
-        req_time for req_time in cfg.user_requests[chat_id]
-        if now - req_time < timedelta(hours=1)
-    ]
-    
-    # Check if user has made 3 or more requests in the last hour
-    if len(cfg.user_requests[chat_id]) >= 3:
-        return False
-    
-    # Add current request timestamp
-    cfg.user_requests[chat_id].append(now)
-    return True
+def rate_limit_message(server=None, action="create_account"):
+    """Returns the message for a user who exceeded the rate limit of the action."""
+    _, limit, period = ratelimit.limit_for(action, server)
+    hours = period / 3600
+    period_text = "час" if hours == 1 else f"{hours:g} ч."
+    return f"Вы превысили лимит запросов. Максимально {limit} запроса в {period_text}. Пожалуйста, подождите."
 
 
 def login_api(session):
-    """Authenticates with the 3xui API and returns the result."""
-    login_url = f"{cfg.API_URL}/login"
-    login_data = {"username": cfg.API_USERNAME, "password": cfg.API_PASSWORD}
-    logger.debug("Authenticating with 3xui API")
-    response = session.post(login_url, data=login_data)
-    response.raise_for_status()
-    result = response.json()
-    logger.debug("3xui API login result: success=%s", result.get('success'))
-    if not result.get('success'):
-        logger.error("Failed to login to 3xui API: %s", result.get('msg'))
-        return False, result.get('msg')
-    return True, None
+    """Makes sure the shared 3xui session of the server is authenticated and returns the result."""
+    return session.ensure_login()
 
 
-def get_vless_inbound(session, chat_id):
-    """Gets inbound configuration with required VLESS+Reality parameters."""
-    inbounds_url = f"{cfg.API_URL}/panel/api/inbounds/list"
-    logger.debug("Getting list of inbounds")
-    response = session.get(inbounds_url)
-    response.raise_for_status()
-    data = response.json()
-    logger.debug("Retrieved %d inbounds, success=%s", len(data.get('obj', [])), data.get('success'))
-    if not data.get('success'):
-        logger.error("Failed to get list of inbounds: %s", data.get('msg'))
-        core.send_message(chat_id, "Не удалось получить список inbounds.")
-        return None
-    inbounds = data.get('obj', [])
-    if not inbounds:
-        logger.error("No available inbounds")
-        core.send_message(chat_id, "Нет доступных inbounds для добавления пользователя.")
-        return None
-    
+def parse_reality_inbounds(inbounds):
+    """Returns RealityInbound parameters of every VLESS inbound with xtls-rprx-vision and reality."""
+    result = []
     for inbound in inbounds:
         if inbound.get('protocol') == 'vless':
             settings = json.loads(inbound.get('settings', '{}'))
@@ -92,130 +68,546 @@ def get_vless_inbound(session, chat_id):
                         short_id_list = reality_settings.get('shortIds', [])
                         short_id = short_id_list[0] if short_id_list else ""
                         sni = reality_settings.get('serverNames', [''])[0]
-                        return inbound_id, server_port, public_key, short_id, sni
-    
-    logger.error("No available VLESS inbounds with required parameters")
-    core.send_message(
-        chat_id,
-        "Нет доступных VLESS inbounds с flow=xtls-rprx-vision для добавления пользователя."
-    )
-    return None
+                        result.append(RealityInbound(
+                            inbound_id, server_port, public_key, short_id, sni,
+                            len(clients), inbound.get('up') or 0, inbound.get('down') or 0,
+                        ))
+    return result
 
 
-def get_existing_client(session, inbound_id, username, chat_id):
-    """Checks if a client with the given email exists in the inbound."""
-    inbound_details_url = f"{cfg.API_URL}/panel/api/inbounds/get/{inbound_id}"
-    logger.debug("Getting inbound details")
-    response = session.get(inbound_details_url)
+def load_reality_inbounds(session, server):
+    """Downloads the inbound list of the server, caches and returns its Reality inbounds.
+
+    Returns:
+        tuple: (list of RealityInbound or None, error message for the user)
+    """
+    inbounds_url = f"{server.api_url}/panel/api/inbounds/list"
+    logger.debug("Getting list of inbounds")
+    with span("inbound_fetch"):
+        response = session.get(inbounds_url)
     response.raise_for_status()
-    data = response.json()
-    logger.debug("Retrieved inbound details, success=%s", data.get('success'))
+    return reality_inbounds_from_list(server, response.json())
+
+
+def reality_inbounds_from_list(server, data):
+    """Caches and returns the Reality inbounds of an inbounds/list response of the server.
+
+    Returns:
+        tuple: (list of RealityInbound or None, error message for the user)
+    """
+    logger.debug("Retrieved %d inbounds, success=%s", len(data.get('obj') or []), data.get('success'))
     if not data.get('success'):
-        logger.error("Failed to get inbound details: %s", data.get('msg'))
-        core.send_message(chat_id, "Не удалось получить детали inbound.")
-        return None, None
-    inbound_obj = data.get('obj', {})
-    settings = json.loads(inbound_obj.get('settings', '{}'))
-    clients = settings.get('clients', [])
-    for client in clients:
-        if client.get('email') == username:
-            return True, client.get('id')
-    return False, None
-
-def get_matching_clients(session, inbound_id, username, chat_id):
-    """Gets a list of clients from inbound whose email matches the username."""
-    inbound_details_url = f"{cfg.API_URL}/panel/api/inbounds/get/{inbound_id}"
-    logger.debug("Getting inbound details to find existing clients")
-    response = session.get(inbound_details_url)
+        logger.error("Failed to get list of inbounds: %s", data.get('msg'))
+        return None, "Не удалось получить список inbounds."
+    inbounds = data.get('obj') or []
+    if not inbounds:
+        logger.error("No available inbounds")
+        return None, "Нет доступных inbounds для добавления пользователя."
+    reality_inbounds = parse_reality_inbounds(inbounds)
+    if not reality_inbounds:
+        logger.error("No available VLESS inbounds with required parameters")
+        return None, "Нет доступных VLESS inbounds с flow=xtls-rprx-vision для добавления пользователя."
+    inbound_cache.put(server, reality_inbounds)
+    # Later health probes fetch just this inbound
+    registry.probe_inbound(server, reality_inbounds[0].id)
+    return reality_inbounds, None
+
+
+def _refresh_inbounds(server):
+    """Reloads the inbounds of the server in the background."""
+    load_reality_inbounds(panel.get_session(server), server)
+
+
+inbound_cache = InboundCache(_refresh_inbounds)
+# The first health probe of a panel lists its inbounds, which warms the cache
+registry.on_inbounds(reality_inbounds_from_list)
+
+
+def get_reality_inbounds(server):
+    """Returns the cached Reality inbounds of the server, loading them on a cache miss.
+
+    Returns:
+        tuple: (list of RealityInbound or None, error message for the user)
+    """
+    reality_inbounds = inbound_cache.get(server)
+    if reality_inbounds is not None:
+        return reality_inbounds, None
+    return load_reality_inbounds(panel.get_session(server), server)
+
+
+def find_inbound(inbounds_by_server, api_url, inbound_id):
+    """Returns (server, RealityInbound) of the inbound in a placement candidate dict or None."""
+    for server, inbounds in inbounds_by_server.items():
+        if server.api_url == api_url:
+            for inbound in inbounds:
+                if inbound.id == inbound_id:
+                    return server, inbound
+    return None
+
+
+def find_placement(servers, chat_id, prefer=None):
+    """Chooses the panel and Reality inbound a new client of the user is added to.
+
+    Every qualifying inbound of every given panel is a candidate, see
+    placement.py. prefer is (api_url, inbound_id) of the client a retried
+    request created before, it is kept while it is still a candidate.
+
+    Returns:
+        tuple: ((ServerTarget, RealityInbound) or None, error message for the user)
+
+    Raises:
+        requests.exceptions.RequestException: If none of the panels could be reached
+    """
+    inbounds_by_server = {}
+    error_msg = "Нет доступных VLESS inbounds с flow=xtls-rprx-vision для добавления пользователя."
+    unreachable = None
+    for server in servers:
+        try:
+            reality_inbounds, server_error = get_reality_inbounds(server)
+        except requests.exceptions.RequestException as e:
+            logger.error("Error when accessing 3xui API of server %s: %s", server.api_url, e)
+            _record_failure(server, e)
+            unreachable = e
+            continue
+        if reality_inbounds is None:
+            error_msg = server_error
+            continue
+        inbounds_by_server[server] = reality_inbounds
+    if not inbounds_by_server and unreachable is not None:
+        raise unreachable
+    if prefer is not None:
+        preferred = find_inbound(inbounds_by_server, *prefer)
+        if preferred is not None:
+            return preferred, None
+    return placement.choose(inbounds_by_server, chat_id), error_msg
+
+
+def _is_missing_inbound(msg):
+    """Checks if a panel error message says the inbound does not exist."""
+    return "not found" in (msg or "").lower()
+
+
+def load_inbound_clients(session, server, inbound_id):
+    """Downloads the clients of the inbound and rebuilds its index.
+
+    Returns:
+        InboundClients: Index of the inbound or None if the panel returned an error
+    """
+    inbound_details_url = f"{server.api_url}/panel/api/inbounds/get/{inbound_id}"
+    logger.debug("Getting inbound details to index clients")
+    with span("client_fetch"):
+        response = session.get(inbound_details_url)
     response.raise_for_status()
-    data = response.json()
+    return index_inbound_clients(server, inbound_id, response.json())
+
+
+def index_inbound_clients(server, inbound_id, data):
+    """Rebuilds the client index of the inbound from an inbounds/get response.
+
+    Returns:
+        InboundClients: Index of the inbound or None if the panel returned an error
+    """
     logger.debug("Retrieved inbound details, success=%s", data.get('success'))
     if not data.get('success'):
         logger.error("Failed to get inbound details: %s", data.get('msg'))
-        core.send_message(chat_id, "Не удалось получить детали inbound.")
-        return []
-    inbound_obj = data.get('obj', {})
+        if _is_missing_inbound(data.get('msg')):
+            inbound_cache.invalidate(server)
+            client_index.invalidate(server, inbound_id)
+        return None
+    inbound_obj = data.get('obj') or {}
     settings = json.loads(inbound_obj.get('settings', '{}'))
-    clients = settings.get('clients', [])
-    matching_clients = [client for client in clients if client.get('email') == username]
-    return matching_clients
+    return client_index.put(server, inbound_id, settings.get('clients', []))
+
+
+def _reload_inbound_clients(server, inbound_id):
+    """Reconciles the client index of the inbound with the panel in the background."""
+    load_inbound_clients(panel.get_session(server), server, inbound_id)
+
+
+client_index = ClientIndex(_reload_inbound_clients)
+
+
+def _get_inbound_clients(session, server, inbound_id, chat_id):
+    """Returns the indexed clients of the inbound, loading them from the panel on first use."""
+    clients = client_index.get(server, inbound_id)
+    if clients is None:
+        clients = load_inbound_clients(session, server, inbound_id)
+        if clients is None:
+            core.send_message(chat_id, "Не удалось получить детали inbound.")
+    return clients
 
 
-def send_vpn_configuration(chat_id, client_uuid, server_port, public_key, sni, short_id, username, now):
-    """Generates a link, QR code and sends them to the user, also updates user data."""
-    vless_link = (
-        f"vless://{client_uuid}@{cfg.SERVER_DOMAIN}:{server_port}?type=tcp&security=reality&pbk={public_key}"
+def get_existing_client(session, server, inbound_id, username, chat_id):
+    """Checks if a client with the given email exists in the inbound."""
+    clients = _get_inbound_clients(session, server, inbound_id, chat_id)
+    if clients is None:
+        return None, None
+    client = clients.by_email.get(username)
+    if client is None:
+        return False, None
+    return True, client.get('id')
+
+
+def get_matching_clients(session, server, inbound_id, chat_id):
+    """Gets a list of clients from inbound that belong to the Telegram user."""
+    clients = _get_inbound_clients(session, server, inbound_id, chat_id)
+    if clients is None:
+        return []
+    return list(clients.by_tg_id.get(str(chat_id), []))
+
+
+def send_qr_photo(chat_id, vless_link, caption):
+    """Sends the QR code of the link, reusing the Telegram file_id of an earlier upload.
+
+    Returns:
+        bool: False if Telegram did not accept the photo
+    """
+    file_ids = file_id_cache.get_cache()
+    file_id = file_ids.get(vless_link)
+    if file_id is not None:
+        with span("photo_resend"):
+            response = core.send_photo(chat_id, file_id, caption=caption)
+        if response is not None:
+            return True
+        logger.warning("Cached file_id was rejected, uploading QR code again")
+        file_ids.discard(vless_link)
+    photo = qr.qr_photo(vless_link)
+    with span("upload"):
+        response = core.send_photo(chat_id, photo, caption=caption)
+    file_id = file_id_cache.photo_file_id(response)
+    if file_id is not None:
+        file_ids.put(vless_link, file_id)
+    return response is not None
+
+
+def build_vless_link(server, client_uuid, server_port, public_key, sni, short_id, username):
+    """Builds the VLESS+Reality link of a client."""
+    return (
+        f"vless://{client_uuid}@{server.domain}:{server_port}?type=tcp&security=reality&pbk={public_key}"
         f"&fp=chrome&sni={sni}&sid={short_id}&spx=%2F&flow=xtls-rprx-vision#{username}"
     )
-    hidden_vless_link = f"```{vless_link}```"
 
-    qr = qrcode.make(vless_link)
-    bio = BytesIO()
-    bio.name = "qr.png"
-    qr.save(bio, "PNG")
-    bio.seek(0)
-
-    core.send_photo(
-        chat_id,
-        bio,
-        caption=(
-            f"Ваш VPN настроен. Сканируйте QR-код или используйте ссылку ниже для настройки клиента.\n{hidden_vless_link}"
-        )
+
+def configuration_caption(vless_link, sub_url=None):
+    """Returns the caption of the QR code photo with the hidden link and the subscription URL if there is one."""
+    hidden_vless_link = f"```{vless_link}```"
+    caption = (
+        f"Ваш VPN настроен. Сканируйте QR-код или используйте ссылку ниже для настройки клиента.\n{hidden_vless_link}"
     )
-    cfg.user_data[chat_id] = {"last_request_time": now, "vless_link": vless_link}
+    if sub_url is not None:
+        caption += f"\nПодписка со всеми вашими серверами:\n`{sub_url}`"
+    return caption
 
 
-def add_new_client(session, inbound_id, chat_id, username):
-    """Adds a new client to the inbound via 3xui API."""
-    add_client_url = f"{cfg.API_URL}/panel/api/inbounds/addClient"
-    client_uuid = str(uuid.uuid4())
-    client_email = username
-    client_limit_ip = 0  # No IP restrictions
-    client_total_gb = 0  # Traffic limit: 0 means unlimited
-    expiry_time = 0  # No expiration date
+def record_configuration(chat_id, vless_link):
+    """Adds the link to the user's subscription and returns the subscription URL or None."""
+    store = subscriptions.get_store()
+    store.add_link(chat_id, vless_link)
+    return subscriptions.subscription_url(store.sub_id(chat_id))
 
-    client_settings = {
-        "clients": [
-            {
-                "id": client_uuid,
-                "flow": "xtls-rprx-vision",
-                "email": client_email,
-                "limitIp": client_limit_ip,
-                "totalGB": client_total_gb,
-                "expiryTime": expiry_time,
-                "enable": True,
-                "tgId": str(chat_id),
-                "subId": "",
-            }
-        ]
-    }
+
+def add_clients(session, server, inbound_id, clients):
+    """Adds clients to the inbound with a single addClient call.
+
+    Returns:
+        str: Error message of the panel or None if the clients were added
+    """
+    add_client_url = f"{server.api_url}/panel/api/inbounds/addClient"
+    client_settings = {"clients": clients}
     payload = {"id": inbound_id, "settings": json.dumps(client_settings)}
     headers = {"Content-Type": "application/json"}
 
-    logger.debug("Adding client to inbound")
-    response = session.post(add_client_url, json=payload, headers=headers)
+    logger.debug("Adding %d clients to inbound", len(clients))
+    with span("add_client"):
+        response = session.post(add_client_url, json=payload, headers=headers)
     response.raise_for_status()
-    data = response.json()
+    return clients_added(server, inbound_id, clients, response.json())
+
+
+def new_client(chat_id, username, sub_id=""):
+    """Returns the settings of a new client of the Telegram user with the user's subscription ID."""
+    client_limit_ip = 0  # No IP restrictions
+    client_total_gb = 0  # Traffic limit: 0 means unlimited
+    expiry_time = 0  # No expiration date
+    return {
+        "id": str(uuid.uuid4()),
+        "flow": "xtls-rprx-vision",
+        "email": username,
+        "limitIp": client_limit_ip,
+        "totalGB": client_total_gb,
+        "expiryTime": expiry_time,
+        "enable": True,
+        "tgId": str(chat_id),
+        "subId": sub_id,
+    }
+
+
+def idempotent_client_uuid(idempotency_key, server, inbound_id):
+    """Returns the uuid of the client created earlier on the inbound with the key, or None."""
+    existing = updates_log.get_idempotency_keys().get(idempotency_key)
+    if existing is None:
+        return None
+    country, existing_inbound_id, client_uuid, api_url = existing
+    if (api_url or server.api_url) != server.api_url or country != server.country:
+        return None
+    if existing_inbound_id != inbound_id:
+        return None
+    return client_uuid
+
+
+def idempotent_placement(idempotency_key):
+    """Returns (api_url, inbound_id) of the client created earlier with the key, or None."""
+    existing = updates_log.get_idempotency_keys().get(idempotency_key)
+    if existing is None or existing[3] is None:
+        return None
+    return existing[3], existing[1]
+
+
+def clients_added(server, inbound_id, clients, data):
+    """Records the result of an addClient response.
+
+    Returns:
+        str: Error message of the panel or None if the clients were added
+    """
     logger.debug("Add client result: success=%s", data.get('success'))
     if not data.get('success'):
         logger.error("Failed to add client: %s", data.get('msg'))
-        core.send_message(chat_id, f"Не удалось добавить клиента: {data.get('msg')}")
-        return None
-    logger.info("Client successfully added for user %s", chat_id)
-    return client_uuid
+        if _is_missing_inbound(data.get('msg')):
+            inbound_cache.invalidate(server)
+            client_index.invalidate(server, inbound_id)
+        return data.get('msg') or "неизвестная ошибка"
+    placed_inbound = None
+    for inbound in inbound_cache.get(server) or ():
+        if inbound.id == inbound_id:
+            placed_inbound = inbound
+    for client in clients:
+        client_index.add_client(server, inbound_id, client)
+        if placed_inbound is not None:
+            placement.record(server, placed_inbound)
+    return None
+
+
+def _record_failure(server, error):
+    """Counts an unreachable panel like a failed probe, so the next users are not sent to it."""
+    inc("panel_failures", country=server.country)
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        registry.record(server, error=error)
+
+
+UNAVAILABLE_MESSAGE = "Сервер временно недоступен. Выберите другую страну или попробуйте позже."
+WORKING_MESSAGE = "⏳ Создаём вашу VPN-конфигурацию, пришлём её через несколько секунд."
+FAILED_MESSAGE = "Не удалось создать VPN-конфигурацию: сервер не отвечает. Пожалуйста, попробуйте позже."
+
+# Stages of a provisioning job, see jobs.py
+LOGIN = "login"
+RESOLVE_INBOUND = "resolve_inbound"
+ADD_CLIENT = "add_client"
+RENDER = "render"
+DELIVER = "deliver"
+
+
+@contextmanager
+def _panel_errors(server):
+    """Counts a failed panel call of a stage before the job retries it."""
+    try:
+        yield
+    except requests.exceptions.RequestException as e:
+        logger.error("Error when accessing 3xui API of server %s: %s", server.api_url, e)
+        _record_failure(server, e)
+        raise
+
+
+def _job_servers(job):
+    """Returns the panels of the country the job may still be placed on."""
+    country = job.context["country"]
+    servers = [find_server(country, api_url) for api_url in job.context["servers"]]
+    return [server for server in servers if server is not None]
+
+
+def _job_server(job):
+    """Returns the panel the job was placed on."""
+    server = find_server(job.context["country"], job.context["api_url"])
+    if server is None:
+        # The panel was removed from cfg.SERVERS while the job waited
+        raise jobs.JobFailed(UNAVAILABLE_MESSAGE)
+    return server
+
+
+def login_stage(job):
+    """Logs in to the panels of the country, panels rejecting the credentials are dropped."""
+    logged_in = []
+    unreachable = None
+    for server in _job_servers(job):
+        try:
+            success, _ = login_api(panel.get_session(server))
+        except requests.exceptions.RequestException as e:
+            logger.error("Error when logging in to 3xui API of server %s: %s", server.api_url, e)
+            _record_failure(server, e)
+            unreachable = e
+            continue
+        if success:
+            logged_in.append(server.api_url)
+    if not logged_in:
+        if unreachable is not None:
+            raise unreachable
+        raise jobs.JobFailed("Не удалось войти в API 3xui. Проверьте логин и пароль.")
+    job.context["servers"] = logged_in
+    return RESOLVE_INBOUND
+
+
+def resolve_inbound_stage(job):
+    """Places the client, or asks the user to pick one of the clients they already have."""
+    context = job.context
+    retried = context.get("retried", False)
+    prefer = idempotent_placement(context.get("idempotency_key")) if retried else None
+    placed, error_msg = find_placement(_job_servers(job), job.chat_id, prefer)
+    if placed is None:
+        raise jobs.JobFailed(error_msg)
+    server, inbound = placed
+    context.update(
+        api_url=server.api_url, inbound_id=inbound.id, server_port=inbound.port,
+        public_key=inbound.public_key, short_id=inbound.short_id, sni=inbound.sni,
+    )
+    # A retried request already created its client, deliver it instead of asking
+    if retried:
+        return ADD_CLIENT
+    with _panel_errors(server):
+        clients = client_index.get(server, inbound.id) or load_inbound_clients(
+            panel.get_session(server), server, inbound.id
+        )
+    if clients is None:
+        raise jobs.JobFailed("Не удалось получить детали inbound.")
+    matching_clients = list(clients.by_tg_id.get(str(job.chat_id), []))
+    if not matching_clients:
+        return ADD_CLIENT
+    # Save context for subsequent user selection processing
+    state.store.put(job.chat_id, PendingSelection(
+        server.country, inbound.id, inbound.port, inbound.public_key, inbound.short_id, inbound.sni,
+        context["email"], matching_clients, server.api_url,
+    ))
+    msg = "Найдены следующие существующие клиенты с вашими данными:\n"
+    for i, client in enumerate(matching_clients, start=1):
+        msg += f"{i}. ID: {client.get('id')}\n"
+    msg += "\nВведите номер клиента для использования или введите 'новый' для создания нового клиента."
+    core.send_message(job.chat_id, msg)
+    return None
+
+
+def add_client_stage(job):
+    """Adds the client to the inbound, at most once however often the stage runs.
+
+    A redelivered request with the same idempotency key reuses the client it
+    created before if it still exists.
+    """
+    context = job.context
+    server = _job_server(job)
+    inbound_id = context["inbound_id"]
+    idempotency_key = context.get("idempotency_key")
+    session = panel.get_session(server)
+    with _panel_errors(server):
+        if idempotency_key is not None:
+            client_uuid = idempotent_client_uuid(idempotency_key, server, inbound_id)
+            if client_uuid is not None:
+                clients = client_index.get(server, inbound_id) or load_inbound_clients(session, server, inbound_id)
+                if clients is not None and client_uuid in clients.by_uuid:
+                    logger.info("Reusing client created earlier for idempotency key %s", idempotency_key)
+                    context["client_uuid"] = client_uuid
+                    return RENDER
+        client = context.get("client")
+        if client is None:
+            client = new_client(job.chat_id, context["email"], subscriptions.get_store().sub_id(job.chat_id))
+            # Saved before the call, so a retry after a timeout looks for this client instead of adding another
+            context["client"] = client
+            job.checkpoint()
+        else:
+            clients = load_inbound_clients(session, server, inbound_id)
+            if clients is not None and client["id"] in clients.by_uuid:
+                logger.info("Client of job %s was added by an earlier attempt", job.id)
+                context["client_uuid"] = client["id"]
+                return RENDER
+        error_msg = add_clients(session, server, inbound_id, [client])
+    if error_msg is not None:
+        raise jobs.JobFailed(f"Не удалось добавить клиента: {error_msg}")
+    if idempotency_key is not None:
+        updates_log.get_idempotency_keys().put(
+            idempotency_key, server.country, inbound_id, client["id"], server.api_url
+        )
+    logger.info("Client successfully added for user %s", job.chat_id)
+    context["client_uuid"] = client["id"]
+    return RENDER
+
+
+def render_stage(job):
+    """Builds the link, adds it to the user's subscription and renders its QR code."""
+    context = job.context
+    vless_link = build_vless_link(
+        _job_server(job), context["client_uuid"], context["server_port"], context["public_key"],
+        context["sni"], context["short_id"], context["email"],
+    )
+    context["vless_link"] = vless_link
+    context["sub_url"] = record_configuration(job.chat_id, vless_link)
+    # A link uploaded before is sent by its file_id and needs no render
+    if file_id_cache.get_cache().get(vless_link) is None:
+        qr.get_renderer().render(vless_link)
+    return DELIVER
+
+
+def deliver_stage(job):
+    """Sends the QR code and link to the user and remembers the delivered config."""
+    vless_link = job.context["vless_link"]
+    if not send_qr_photo(job.chat_id, vless_link, configuration_caption(vless_link, job.context["sub_url"])):
+        raise jobs.RetryableError("Telegram did not accept the configuration photo")
+    state.store.put(job.chat_id, DeliveredConfig(vless_link))
+    return None
+
+
+PROVISIONING_STAGES = {
+    LOGIN: login_stage,
+    RESOLVE_INBOUND: resolve_inbound_stage,
+    ADD_CLIENT: add_client_stage,
+    RENDER: render_stage,
+    DELIVER: deliver_stage,
+}
+
+
+def provisioning_failed(job, message):
+    """Tells the user a provisioning job failed, without the details of panel errors."""
+    core.send_message(job.chat_id, message or FAILED_MESSAGE)
+
+
+def submit_provisioning(chat_id, stage, context, job_id=None):
+    """Tells the user the configuration is on its way and queues a job starting at the stage."""
+    if not jobs.get_queue().submit(chat_id, stage, context, job_id):
+        # A redelivered request, its user was answered the first time
+        logger.info("Provisioning job %s was queued before", job_id)
+        return
+    core.send_message(chat_id, WORKING_MESSAGE)
+
 
+def create_vpn_account(chat_id, telegram_username, country="nl", idempotency_key=None):
+    """Queues the creation of a VPN account for the user, see PROVISIONING_STAGES.
 
-def create_vpn_account(chat_id, telegram_username, country="nl"):
-    """Creates a VPN account for the user."""
+    idempotency_key identifies the request, e.g. the callback query ID, so a
+    redelivered request neither queues a second job nor creates a second
+    client.
+    """
     logger.info("Creating VPN account for user %s with country %s", chat_id, country)
     now = datetime.utcnow()
     
-    # Check rate limit (3 requests per hour)
-    if not check_rate_limit(chat_id, now):
-        core.send_message(
-            chat_id,
-            "Вы превысили лимит запросов. Максимально 3 запроса в час. Пожалуйста, подождите.",
-        )
+    # Resolve the panels of the selected country, every call below talks to one explicitly
+    servers = resolve_servers(country)
+    if servers is None:
+        core.send_message(chat_id, "Неизвестная страна. Используется сервер по умолчанию.")
+        servers = resolve_servers(cfg.DEFAULT_COUNTRY) or []
+    # Answer right away instead of waiting for a dead panel to time out
+    if not servers:
+        core.send_message(chat_id, UNAVAILABLE_MESSAGE, reply_markup=ui.country_menu())
+        return
+    
+    # Check rate limit of the selected country, a retried request was already counted
+    retried = idempotency_key is not None and updates_log.get_idempotency_keys().get(idempotency_key) is not None
+    if not retried and not check_rate_limit(chat_id, servers[0]):
+        core.send_message(chat_id, rate_limit_message(servers[0]))
         return
     
     # Generate unique email for 3x-ui
@@ -225,81 +617,11 @@ def create_vpn_account(chat_id, telegram_username, country="nl"):
     else:
         # Use telegram user ID if username is not available
         email = f"user{chat_id}_{timestamp}"
-    
-    # Cleanup expired records
-    cleanup_expired_user_data(now)
-    
-    # Set API URL and SERVER_DOMAIN based on selected country
-    if country in cfg.SERVERS:
-        original_api_url = cfg.API_URL
-        original_server_domain = cfg.SERVER_DOMAIN
-        cfg.API_URL = cfg.SERVERS[country]
-        # Extract domain from API URL
-        from urllib.parse import urlparse
-        parsed_url = urlparse(cfg.API_URL)
-        cfg.SERVER_DOMAIN = parsed_url.hostname
-    else:
-        core.send_message(chat_id, "Неизвестная страна. Используется сервер по умолчанию.")
-        country = cfg.DEFAULT_COUNTRY
-    
-    session = requests.Session()
-    try:
-        success, error_msg = login_api(session)
-        if not success:
-            core.send_message(chat_id, "Не удалось войти в API 3xui. Проверьте логин и пароль.")
-            return
-    except requests.exceptions.RequestException as e:
-        logger.error("Error when accessing 3xui API: %s", e)
-        core.send_message(chat_id, f"Ошибка при обращении к API 3xui: {e}")
-        # Restore original values on error
-        if country in cfg.SERVERS:
-            cfg.API_URL = original_api_url
-            cfg.SERVER_DOMAIN = original_server_domain
-        return
-    
-    inbound_config = get_vless_inbound(session, chat_id)
-    if inbound_config is None:
-        # Restore original values on error
-        if country in cfg.SERVERS:
-            cfg.API_URL = original_api_url
-            cfg.SERVER_DOMAIN = original_server_domain
-        return
-    inbound_id, server_port, public_key, short_id, sni = inbound_config
-    
-    # Get list of existing clients matching user data
-    matching_clients = get_matching_clients(session, inbound_id, email, chat_id)
-    if matching_clients:
-        # Save context for subsequent user selection processing
-        cfg.user_data[chat_id] = {
-            "last_request_time": now,
-            "inbound_id": inbound_id,
-            "server_port": server_port,
-            "public_key": public_key,
-            "short_id": short_id,
-            "sni": sni,
-            "username": email,
-            "matching_clients": matching_clients,
-            "country": country,
-            "original_api_url": original_api_url if country in cfg.SERVERS else None,
-            "original_server_domain": original_server_domain if country in cfg.SERVERS else None
-        }
-        msg = "Найдены следующие существующие клиенты с вашими данными:\n"
-        for i, client in enumerate(matching_clients, start=1):
-            msg += f"{i}. ID: {client.get('id')}\n"
-        msg += "\nВведите номер клиента для использования или введите 'новый' для создания нового клиента."
-        core.send_message(chat_id, msg)
-        return
-    else:
-        try:
-            client_uuid = add_new_client(session, inbound_id, chat_id, email)
-            if client_uuid is None:
-                return
-            send_vpn_configuration(chat_id, client_uuid, server_port, public_key, sni, short_id, email, now)
-        except requests.exceptions.RequestException as e:
-            logger.error("Error when adding client: %s", e)
-            core.send_message(chat_id, f"Ошибка при добавлении клиента: {e}")
-        finally:
-            # Restore original values
-            if country in cfg.SERVERS:
-                cfg.API_URL = original_api_url
-                cfg.SERVER_DOMAIN = original_server_domain
+
+    submit_provisioning(chat_id, LOGIN, {
+        "country": servers[0].country,
+        "servers": [server.api_url for server in servers],
+        "email": email,
+        "idempotency_key": idempotency_key,
+        "retried": retried,
+    }, job_id=idempotency_key)
@@ -0,0 +1,58 @@
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import config as cfg
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts Telegram update POSTs and hands them to the accept callback."""
+
+    # Set by create_server: accept(update, timeout) -> bool
+    accept = None
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook %s - %s", self.address_string(), format % args)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path != cfg.WEBHOOK_PATH:
+            self._reply(404)
+            return
+        if cfg.WEBHOOK_SECRET and not hmac.compare_digest(
+            self.headers.get(SECRET_HEADER, ""), cfg.WEBHOOK_SECRET
+        ):
+            logger.warning("Rejected webhook request with invalid secret token from %s", self.address_string())
+            self._reply(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            update = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            logger.error("Invalid webhook payload: %s", e)
+            self._reply(400)
+            return
+        if not isinstance(update, dict) or "update_id" not in update:
+            self._reply(400)
+            return
+        # Telegram retries the delivery when it does not get a 2xx answer
+        if not self.accept(update, cfg.WEBHOOK_ACCEPT_TIMEOUT):
+            self._reply(503)
+            return
+        self._reply(200)
+
+
+def create_server(accept, host, port):
+    """Creates an HTTP server that feeds Telegram webhook updates to accept(update, timeout)."""
+    handler = type("BoundWebhookHandler", (WebhookHandler,), {"accept": staticmethod(accept)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server